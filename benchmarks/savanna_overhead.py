@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the overhead of savanna itself, independent of the codes it
+runs.
+
+For each size, a group with that many one node pipelines running a trivial
+executable is generated, and savanna is run on it on the local machine with
+runner none. The savanna process is sampled while it runs, and the launches
+and node releases are read from its trace file (see codar/savanna/trace.py).
+The report has, for each size:
+
+    launches/s      pipelines started per second, from the first launch to
+                    the last
+    release->launch percentiles of the time from a node being released to
+                    the next pipeline being started on it, in ms
+    peak rss        peak resident set size of the savanna process, in MB
+    peak threads    peak number of threads of the savanna process
+    status write    mean time to save the workflow status, in ms
+
+Each size is run several times, and the result has the best value of each
+metric over the repeats, which is less affected by other activity on the
+machine than a single run, along with the worst value. It is appended as a JSON line to the results file, along with the
+git commit, and compared with the last result on the same host for the
+same size and node count. A metric is flagged as a regression when its best
+value is worse than the last best by more than the regression threshold,
+and worse than the last worst, so a change within the run to run variation
+is not flagged. Latency metrics vary more from run to run than throughput
+and memory, so they have a wider threshold. The exit status is 1 if there
+are any regressions. Usage:
+
+    python benchmarks/savanna_overhead.py --sizes 100 1000 10000 100000
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+
+import psutil
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_RESULTS = os.path.join(BENCH_DIR, 'results',
+                               'savanna_overhead.jsonl')
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+# Relative change in a metric compared to the last result that is reported
+# as a regression, for throughput and memory metrics and for latencies
+REGRESSION_THRESHOLD = 0.2
+LATENCY_REGRESSION_THRESHOLD = 0.5
+
+# Metrics compared with earlier results, whether higher is better and
+# whether they are latencies
+COMPARED_METRICS = [('launches_per_second', True, False),
+                    ('release_to_launch_p50_ms', False, True),
+                    ('release_to_launch_p99_ms', False, True),
+                    ('peak_rss_mb', False, False),
+                    ('peak_threads', False, False),
+                    ('status_write_ms', False, True)]
+
+# Metrics of a result that are the best over the repeats, and whether
+# higher is better
+BEST_METRICS = [('elapsed', False), ('launches_per_second', True),
+                ('release_to_launch_p50_ms', False),
+                ('release_to_launch_p90_ms', False),
+                ('release_to_launch_p99_ms', False),
+                ('release_to_launch_max_ms', False),
+                ('peak_rss_mb', False), ('peak_threads', False),
+                ('status_write_ms', False)]
+
+DEFAULT_REPEAT = 5
+
+SAMPLE_INTERVAL = 0.1
+
+
+def make_group(group_dir, size, exe):
+    """Write a fobs file with size one node pipelines running exe."""
+    os.makedirs(group_dir)
+    fobs_path = os.path.join(group_dir, 'fobs.json')
+    with open(fobs_path, 'w') as f:
+        f.write('[\n')
+        for i in range(size):
+            pipe_id = 'run-%d.iteration-0' % i
+            working_dir = os.path.join(group_dir, pipe_id)
+            os.mkdir(working_dir)
+            runs = [dict(name='noop', exe=exe, args=[], sched_args=None,
+                         nprocs=1, timeout=60)]
+            data = dict(id=pipe_id, runs=runs, working_dir=working_dir,
+                        apps_dir=group_dir, machine_name='local',
+                        total_nodes=1, node_layout=[{'noop': 1}])
+            f.write(json.dumps(data))
+            f.write(',\n' if i < size - 1 else '\n')
+        f.write(']\n')
+    return fobs_path
+
+
+def run_savanna(group_dir, fobs_path, max_nodes):
+    """Run savanna on the group, and return a dict with the elapsed time,
+    the return code, and the peak rss and threads of the savanna process."""
+    trace_path = os.path.join(group_dir, 'trace.json')
+    args = [sys.executable, '-m', 'codar.savanna.main',
+            '--max-nodes', str(max_nodes), '--processes-per-node', '1',
+            '--runner', 'none', '--machine-name', 'local',
+            '--producer-input-file', fobs_path,
+            '--status-file', os.path.join(group_dir,
+                                          'codar.workflow.status.json'),
+            '--log-file', os.path.join(group_dir, 'codar.FOBrun.log'),
+            '--log-level', 'WARNING',
+            '--trace-file', trace_path]
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    peak_rss = peak_threads = 0
+    start = time.time()
+    p = subprocess.Popen(args, cwd=group_dir, env=env)
+    proc = psutil.Process(p.pid)
+    while p.poll() is None:
+        try:
+            with proc.oneshot():
+                peak_rss = max(peak_rss, proc.memory_info().rss)
+                peak_threads = max(peak_threads, proc.num_threads())
+        except psutil.Error:
+            pass
+        time.sleep(SAMPLE_INTERVAL)
+    elapsed = time.time() - start
+    return dict(returncode=p.returncode, elapsed=elapsed,
+                peak_rss_mb=round(peak_rss / 2**20, 1),
+                peak_threads=peak_threads, trace_path=trace_path)
+
+
+def load_trace(path):
+    """Load a trace file, which is missing the closing bracket if savanna
+    did not exit cleanly."""
+    with open(path) as f:
+        text = f.read().rstrip()
+    if not text.endswith(']'):
+        text += ']'
+    return json.loads(text)
+
+
+def analyze_trace(events):
+    """Get the launch rate, and the times from node release to the next
+    launch on the node in seconds, from the trace events."""
+    launches = []
+    node_spans = {}
+    for e in events:
+        if e['ph'] != 'X':
+            continue
+        if e['pid'] == 0:
+            node_spans.setdefault(e['tid'], []).append((e['ts'],
+                                                        e['ts'] + e['dur']))
+        elif e['name'] == 'queued':
+            launches.append(e['ts'] + e['dur'])
+    gaps = []
+    for spans in node_spans.values():
+        spans.sort()
+        for (_, released), (assigned, _) in zip(spans, spans[1:]):
+            gaps.append((assigned - released) / 1e6)
+    rate = None
+    if len(launches) > 1:
+        span = (max(launches) - min(launches)) / 1e6
+        if span > 0:
+            rate = (len(launches) - 1) / span
+    return len(launches), rate, gaps
+
+
+def status_write_time(group_dir):
+    """Mean time to save the status, from the status journal metrics, or
+    None if not available."""
+    metrics_path = os.path.join(group_dir, 'codar.savanna.metrics.prom')
+    values = {}
+    try:
+        with open(metrics_path) as f:
+            for line in f:
+                if line.startswith('savanna_status_write_seconds'):
+                    name, value = line.split()
+                    values[name] = float(value)
+    except OSError:
+        return None
+    count = values.get('savanna_status_write_seconds_count')
+    if not count:
+        return None
+    return values['savanna_status_write_seconds_sum'] / count
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    i = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[i]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+            stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(size, max_nodes, work_dir, exe):
+    group_dir = os.path.join(work_dir, 'group-%d' % size)
+    shutil.rmtree(group_dir, ignore_errors=True)
+    fobs_path = make_group(group_dir, size, exe)
+    run = run_savanna(group_dir, fobs_path, max_nodes)
+    launches, rate, gaps = analyze_trace(load_trace(run['trace_path']))
+    ms = lambda t: None if t is None else round(t * 1000, 3)
+    status_write = status_write_time(group_dir)
+    return dict(size=size, max_nodes=max_nodes, commit=git_commit(),
+                host=socket.gethostname(), date=time.strftime('%Y-%m-%d'),
+                returncode=run['returncode'],
+                elapsed=round(run['elapsed'], 2), launches=launches,
+                launches_per_second=rate and round(rate, 1),
+                release_to_launch_p50_ms=ms(percentile(gaps, 50)),
+                release_to_launch_p90_ms=ms(percentile(gaps, 90)),
+                release_to_launch_p99_ms=ms(percentile(gaps, 99)),
+                release_to_launch_max_ms=ms(max(gaps, default=None)),
+                peak_rss_mb=run['peak_rss_mb'],
+                peak_threads=run['peak_threads'],
+                status_write_ms=ms(status_write))
+
+
+def benchmark_repeated(size, max_nodes, work_dir, exe, repeat):
+    """Run the benchmark of a size repeat times, and get a result with the
+    best value of each metric, and the worst in result['worst']. The return
+    code is the first non zero one."""
+    runs = [benchmark(size, max_nodes, work_dir, exe)
+            for _ in range(repeat)]
+    result = dict(runs[0], repeat=repeat)
+    result['returncode'] = next((r['returncode'] for r in runs
+                                 if r['returncode']), 0)
+    result['worst'] = {}
+    for name, higher_is_better in BEST_METRICS:
+        values = [r[name] for r in runs if r[name] is not None]
+        best, worst = (max, min) if higher_is_better else (min, max)
+        result[name] = best(values) if values else None
+        result['worst'][name] = worst(values) if values else None
+    return result
+
+
+def load_results(path):
+    results = []
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    results.append(json.loads(line))
+    except OSError:
+        pass
+    return results
+
+
+def compare(result, previous, threshold, latency_threshold):
+    """Get a list of messages for the metrics with a best value that is
+    worse than the best of the previous result by more than threshold, or
+    latency_threshold for latencies, and worse than the worst of the
+    previous result."""
+    messages = []
+    for name, higher_is_better, is_latency in COMPARED_METRICS:
+        new, old = result.get(name), previous.get(name)
+        if not new or not old:
+            continue
+        old_worst = previous.get('worst', {}).get(name, old)
+        change = (new - old) / old
+        if higher_is_better:
+            change = -change
+            overlaps = new >= old_worst
+        else:
+            overlaps = new <= old_worst
+        if (not overlaps
+                and change > (latency_threshold if is_latency
+                              else threshold)):
+            messages.append('%s %s -> %s (%+.0f%%)'
+                            % (name, old, new, 100 * (new - old) / old))
+    return messages
+
+
+def print_result(r):
+    print('%7d pipelines on %d nodes, best of %d: %s s, %s launches/s, '
+          'release->launch p50 %s p99 %s max %s ms, '
+          'peak rss %s MB, peak threads %s, status write %s ms'
+          % (r['size'], r['max_nodes'], r['repeat'], r['elapsed'],
+             r['launches_per_second'], r['release_to_launch_p50_ms'],
+             r['release_to_launch_p99_ms'], r['release_to_launch_max_ms'],
+             r['peak_rss_mb'], r['peak_threads'], r['status_write_ms']))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Measure the overhead of savanna on synthetic groups')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='number of pipelines of each benchmark group')
+    parser.add_argument('--max-nodes', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='number of runs of each size, the metrics are '
+                             'the best over the runs')
+    parser.add_argument('--exe', default=shutil.which('true') or '/bin/true',
+                        help='executable run by each pipeline')
+    parser.add_argument('--work-dir',
+                        help='directory for the generated groups, a '
+                             'temporary directory that is removed at the '
+                             'end by default')
+    parser.add_argument('--results', default=DEFAULT_RESULTS,
+                        help='JSON lines file the results are appended to')
+    parser.add_argument('--threshold', type=float,
+                        default=REGRESSION_THRESHOLD,
+                        help='relative change reported as a regression')
+    parser.add_argument('--latency-threshold', type=float,
+                        default=LATENCY_REGRESSION_THRESHOLD,
+                        help='relative change in a latency reported as a '
+                             'regression')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='savanna-bench-')
+    history = load_results(args.results)
+    regressions = 0
+    try:
+        for size in args.sizes:
+            result = benchmark_repeated(size, args.max_nodes, work_dir,
+                                        args.exe, args.repeat)
+            print_result(result)
+            previous = [r for r in history if r['size'] == size
+                        and r['max_nodes'] == args.max_nodes
+                        and r.get('host') == result['host']]
+            if previous:
+                for message in compare(result, previous[-1], args.threshold,
+                                       args.latency_threshold):
+                    print('  REGRESSION since %s: %s'
+                          % (previous[-1].get('commit'), message))
+                    regressions += 1
+            if args.results:
+                os.makedirs(os.path.dirname(os.path.abspath(args.results)),
+                            exist_ok=True)
+                with open(args.results, 'a') as f:
+                    f.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+Combined submission of several sweep groups of a campaign in one batch job.
+Savanna schedules the pipelines of all the groups on the nodes of the job,
+giving each group a share of the nodes proportional to its weight while
+several groups have pipelines waiting, and saves the status of each group
+in its own directory.
+
+The combined submission is a directory next to the groups, with the
+scheduler scripts of the groups and a group-env.sh based on the one of the
+first group. It is submitted like a group, with its submit.sh or run-all.sh.
+The groups get a file naming the combined submission, so they are not
+submitted on their own, and cheetah status reads the job id, log and
+walltime from the combined submission directory.
+"""
+import os
+import re
+import shutil
+
+from codar.cheetah import exc
+from codar.cheetah.helpers import parse_timedelta_seconds
+
+# Written in each group of a combined submission, with the name of the
+# combined submission directory
+COMBINED_NAME = 'codar.cheetah.combined.txt'
+
+# Written in the combined submission directory, with the name and weight of
+# each group
+GROUPS_NAME = 'codar.cheetah.combined-groups.txt'
+
+GROUP_ENV_NAME = 'group-env.sh'
+
+# Scripts copied from the first group, the batch script is run-group.*
+GROUP_SCRIPTS = ['submit.sh', 'cancel.sh', 'status.sh', 'wait.sh']
+
+_EXPORT_RE = re.compile(r'^export (\w+)="(.*)"$')
+
+
+def combine_groups(user_dir, name, groups, weights=None, nodes=None,
+                   walltime=None):
+    """Create the combined submission directory name in the campaign user
+    directory, for the sweep groups with the given names. weights are the
+    shares of the nodes of the groups, equal by default. The job has the
+    max nodes of the groups and the sum of their walltimes by default.
+    Returns the path of the combined submission directory. Raises
+    CheetahException if the groups can't be combined."""
+    if len(groups) < 2:
+        raise exc.CheetahException('at least two groups are needed')
+    if len(set(groups)) != len(groups):
+        raise exc.CheetahException('groups must be different')
+    if weights is None:
+        weights = [1] * len(groups)
+    if len(weights) != len(groups) or any(w <= 0 for w in weights):
+        raise exc.CheetahException('expected a positive weight for each '
+                                   'group')
+    combined_dir = os.path.join(user_dir, name)
+    if os.path.exists(combined_dir):
+        raise exc.CheetahException("'%s' already exists" % combined_dir)
+
+    group_envs = []
+    for group in groups:
+        group_dir = os.path.join(user_dir, group)
+        if not os.path.isfile(os.path.join(group_dir, 'fobs.json')):
+            raise exc.CheetahException("'%s' is not a sweep group directory"
+                                       % group_dir)
+        combined_with = read_combined_name(group_dir)
+        if combined_with is not None:
+            raise exc.CheetahException("group '%s' is already part of "
+                                       "combined submission '%s'"
+                                       % (group, combined_with))
+        group_envs.append(read_group_env(group_dir))
+
+    for var in ('CODAR_CHEETAH_MACHINE_NAME',
+                'CODAR_CHEETAH_GROUP_PROCESSES_PER_NODE'):
+        values = set(env.get(var) for env in group_envs)
+        if len(values) > 1:
+            raise exc.CheetahException('groups must have the same %s, got %s'
+                                       % (var, ', '.join(sorted(values))))
+
+    if nodes is None:
+        nodes = max(int(env['CODAR_CHEETAH_GROUP_NODES'])
+                    for env in group_envs)
+    if walltime is None:
+        walltime = sum(int(env['CODAR_CHEETAH_GROUP_WALLTIME'])
+                       for env in group_envs)
+    else:
+        walltime = parse_timedelta_seconds(walltime)
+
+    input_args = (['--producer-input-file']
+                  + ['../%s/fobs.json' % group for group in groups]
+                  + ['--group-weights'] + ['%g' % w for w in weights])
+    env = dict(group_envs[0])
+    env.update(CODAR_CHEETAH_GROUP_NAME=name,
+               CODAR_CHEETAH_GROUP_NODES=str(nodes),
+               # used as the node count by the local scheduler scripts
+               CODAR_CHEETAH_GROUP_MAX_PROCS=str(nodes),
+               CODAR_CHEETAH_GROUP_WALLTIME=str(walltime),
+               CODAR_CHEETAH_GROUP_INPUT_ARGS=' '.join(input_args))
+
+    first_dir = os.path.join(user_dir, groups[0])
+    os.makedirs(combined_dir)
+    # submit.sh reads the status files of the groups listed in GROUPS_NAME
+    # to skip the submission once all their experiments have been run
+    for script in sorted(os.listdir(first_dir)):
+        if script in GROUP_SCRIPTS or script.startswith('run-group.'):
+            shutil.copy2(os.path.join(first_dir, script), combined_dir)
+    with open(os.path.join(combined_dir, GROUP_ENV_NAME), 'w') as f:
+        f.write('\n')
+        for var, value in env.items():
+            f.write('export %s="%s"\n' % (var, value))
+    with open(os.path.join(combined_dir, GROUPS_NAME), 'w') as f:
+        for group, weight in zip(groups, weights):
+            f.write('%s %g\n' % (group, weight))
+    for group in groups:
+        with open(os.path.join(user_dir, group, COMBINED_NAME), 'w') as f:
+            f.write(name + '\n')
+    return combined_dir
+
+
+def read_group_env(group_dir):
+    """Get the variables exported by the group-env.sh of a group, as written
+    by the launcher."""
+    env = {}
+    with open(os.path.join(group_dir, GROUP_ENV_NAME)) as f:
+        for line in f:
+            m = _EXPORT_RE.match(line.strip())
+            if m:
+                env[m.group(1)] = m.group(2)
+    return env
+
+
+def read_combined_name(group_dir):
+    """Get the name of the combined submission the group is part of, or None
+    if it is submitted on its own."""
+    try:
+        with open(os.path.join(group_dir, COMBINED_NAME)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def read_combined_groups(combined_dir):
+    """Get the list of (group, weight) pairs of a combined submission, or
+    None if the directory is not a combined submission."""
+    try:
+        with open(os.path.join(combined_dir, GROUPS_NAME)) as f:
+            lines = f.read().split('\n')
+    except FileNotFoundError:
+        return None
+    groups = []
+    for line in lines:
+        if line.strip():
+            group, weight = line.split()
+            groups.append((group, float(weight)))
+    return groups
@@ -4,17 +4,33 @@ cd "$(dirname $0)"
 source ../campaign-env.sh
 source group-env.sh
 
+# Groups that are part of a combined submission are submitted with it
+if [ -f codar.cheetah.combined.txt ]; then
+    echo "Group is part of combined submission $(cat codar.cheetah.combined.txt). Skipping group .."
+    exit
+fi
+
 if [ -f "$CODAR_CHEETAH_MACHINE_CONFIG" ]; then
     source "$CODAR_CHEETAH_MACHINE_CONFIG"
 fi
 
-# Don't submit job if all experiments have been run
-if [ -f codar.workflow.status.json ]; then
-    grep state codar.workflow.status.json | grep -q 'not_started'
-    if [ $? != 0 ]; then
-        echo "No more experiments remaining. Skipping group .."
-        exit
+# Don't submit job if all experiments have been run. A combined submission
+# has no status file of its own, check the ones of its groups.
+status_files=codar.workflow.status.json
+if [ -f codar.cheetah.combined-groups.txt ]; then
+    status_files=$(awk '{ print "../" $1 "/codar.workflow.status.json" }' \
+                   codar.cheetah.combined-groups.txt)
+fi
+all_done=1
+for status_file in $status_files; do
+    if [ ! -f "$status_file" ] \
+       || grep state "$status_file" | grep -q 'not_started'; then
+        all_done=0
     fi
+done
+if [ $all_done = 1 ]; then
+    echo "No more experiments remaining. Skipping group .."
+    exit
 fi
 
 # Copy the env setup to the Sweep Group
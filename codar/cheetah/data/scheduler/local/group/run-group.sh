@@ -9,16 +9,21 @@ if [ -n "$CODAR_CHEETAH_UMASK" ]; then
     umask "$CODAR_CHEETAH_UMASK"
 fi
 
+# Combined submissions of several groups set the fobs files to read, see
+# cheetah combine-groups
+if [ -z "$CODAR_CHEETAH_GROUP_INPUT_ARGS" ]; then
+    CODAR_CHEETAH_GROUP_INPUT_ARGS="--producer-input-file=fobs.json --status-file=codar.workflow.status.json"
+fi
+
 start=$(date +%s)
 
 # Main application run
 "$CODAR_PYTHON" "$CODAR_WORKFLOW_SCRIPT" --runner=$CODAR_WORKFLOW_RUNNER \
  --max-nodes=$CODAR_CHEETAH_GROUP_MAX_PROCS \
  --processes-per-node=1 \
- --producer-input-file=fobs.json \
+ $CODAR_CHEETAH_GROUP_INPUT_ARGS \
  --log-file=codar.FOBrun.log \
  --machine-name=$CODAR_CHEETAH_MACHINE_NAME \
- --status-file=codar.workflow.status.json \
  --log-level=$CODAR_CHEETAH_WORKFLOW_LOG_LEVEL
 
 end=$(date +%s)
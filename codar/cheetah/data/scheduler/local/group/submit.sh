@@ -4,6 +4,12 @@ cd "$(dirname $0)"
 source ../campaign-env.sh
 source group-env.sh
 
+# Groups that are part of a combined submission are submitted with it
+if [ -f codar.cheetah.combined.txt ]; then
+    echo "Group is part of combined submission $(cat codar.cheetah.combined.txt). Skipping group .."
+    exit
+fi
+
 if [ -f "$CODAR_CHEETAH_MACHINE_CONFIG" ]; then
     source "$CODAR_CHEETAH_MACHINE_CONFIG"
 fi
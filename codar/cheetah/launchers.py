@@ -22,6 +22,7 @@ from codar.cheetah.parameters import SymLink
 from codar.cheetah.adios2_interface import get_adios_version
 from codar.cheetah import adios2_interface as adios2
 from codar.cheetah import error_messages as err
+from codar.savanna.utils import find_exe
 
 
 class Launcher(object):
@@ -68,7 +69,8 @@ class Launcher(object):
                                run_post_process_script=None,
                                run_post_process_stop_on_failure=False,
                                scheduler_options=None,
-                               run_dir_setup_script=None):
+                               run_dir_setup_script=None,
+                               pin_exe_paths=False):
         """Copy scripts for the appropriate scheduler to group directory,
         and write environment configuration. Returns required number of nodes,
         which will be calculated if the passed nodes is None"""
@@ -84,8 +86,10 @@ class Launcher(object):
         fobs_path = os.path.join(self.output_directory, 'fobs.json')
         min_nodes = 1
 
+        # fobs.json is a JSON list with one pipeline per line, so savanna
+        # can read it one pipeline at a time
         f = open(fobs_path, 'w')
-        fob_list = []
+        f.write('[\n')
         for i, run in enumerate(runs):
             # TODO: abstract this to higher levels
             os.makedirs(run.run_path, exist_ok=True)
@@ -304,7 +308,13 @@ class Launcher(object):
                 if timeout is not None:
                     rc.timeout = parse_timedelta_seconds(timeout)
 
-                fob_runs.append(rc.as_fob_data())
+                fob_run = rc.as_fob_data()
+                if pin_exe_paths:
+                    exe_path = find_exe(rc.exe, app_dir, rc.env)
+                    if exe_path is not None:
+                        fob_run['exe'] = exe_path
+                        fob_run['exe_pinned'] = True
+                fob_runs.append(fob_run)
 
             fob = dict(id=run.run_id, launch_mode=launch_mode, runs=fob_runs,
                        working_dir=run.run_path, apps_dir=app_dir,
@@ -317,7 +327,9 @@ class Launcher(object):
                        total_nodes=run.total_nodes,
                        machine_name=machine.name,
                        tau_profiling=tau_profiling, tau_tracing=tau_tracing)
-            fob_list.append(fob)
+            if i > 0:
+                f.write(',\n')
+            f.write(json.dumps(fob, sort_keys=True))
 
             # write to file run dir
             run_fob_path = os.path.join(run.run_path,
@@ -334,8 +346,7 @@ class Launcher(object):
             # in the creation of the run dir.
             self._get_pre_submit_dir_size(run)
 
-        # Write fob_list to group-level json file
-        f.write(json.dumps(fob_list, sort_keys=True, indent=4))
+        f.write('\n]\n')
         f.close()
 
         if nodes is None:
@@ -21,7 +21,7 @@ from collections import OrderedDict
 import warnings
 import pdb
 
-from codar.savanna import machines
+from codar.savanna import machines, dag
 from codar.savanna.node_layout import NodeLayout
 from codar.cheetah import parameters, config, templates, exc, machine_launchers
 from codar.cheetah.launchers import Launcher
@@ -84,6 +84,13 @@ class Campaign(object):
     # @TODO: This must be per sweep group
     run_dir_setup_script = None
 
+    # Optional. If True, the path of each code exe is resolved when the
+    # campaign is created, searching the app dir and then $PATH, and saved in
+    # the FOB file so the workflow engine doesn't need to search for it on
+    # the compute nodes. Codes that are not found are resolved at run time
+    # as usual.
+    pin_exe_paths = False
+
     # Schedular options. Not used when using machine 'local', required
     # when using super computers.
     scheduler_options = {}
@@ -383,7 +390,8 @@ class Campaign(object):
                 run_post_process_stop_on_failure=
                     self.run_post_process_stop_group_on_failure,
                 scheduler_options=self.machine_scheduler_options,
-                run_dir_setup_script=self.run_dir_setup_script)
+                run_dir_setup_script=self.run_dir_setup_script,
+                pin_exe_paths=self.pin_exe_paths)
 
         # TODO: track directories and ids and add to this file
         all_params_json_path = os.path.join(output_dir, "params.json")
@@ -495,6 +503,7 @@ class Run(object):
                     "Cannot read {}".format(env_fpath)
 
             sleep_after = self.codes[target].get('sleep_after', 0)
+            memory_per_node = self.codes[target].get('memory_per_node')
             runner_override = self.codes[target].get('runner_override', False)
             assert type(runner_override) == bool, \
                 "The runner_override property for the " + target + " codes " \
@@ -546,32 +555,42 @@ class Run(object):
                                 linked_with_sosflow=linked_with_sosflow,
                                 adios_xml_file=adios_xml_file,
                                 hostfile=self.instance.get_hostfile(target),
-                                runner_override=runner_override)
+                                runner_override=runner_override,
+                                memory_per_node=memory_per_node)
             comps.append(comp)
         return comps
 
     def _populate_rc_dependency(self, rc_dependency):
         """
         Retrieve the object reference for RCs and populate their
-        after_rc_done field with object references
+        after_rc_done field with object references. A code can depend on
+        a single code or on a list of codes.
         """
         if rc_dependency is not None:
             for k,v in rc_dependency.items():
                 assert type(k) is str, "rc_dependency dictionary key must " \
                                         "be code name"
                 assert v is not None, "Dict value cannot be None"
-                assert type(v) is str, "rc_dependency dictionary value must " \
-                                       "be a string"
+                if type(v) is str:
+                    v = [v]
+                assert type(v) in (list, tuple) and v and \
+                    all(type(name) is str for name in v), \
+                    "rc_dependency dictionary value must be a string or " \
+                    "a list of strings"
 
                 k_rc = self._get_rc_by_name(k)
-                v_rc = self._get_rc_by_name(v)
-                k_rc.after_rc_done = v_rc
-
-                # k_rc = self._get_rc_by_name(k)
-                # assert k_rc is not None, "RC {0} not found".format(k)
-                # v_rc = self._get_rc_by_name(v)
-                # assert v_rc is not None, "RC {0} not found".format(v)
-                # k_rc.after_rc_done = v_rc
+                for name in v:
+                    v_rc = self._get_rc_by_name(name)
+                    if v_rc not in k_rc.after_rc_done:
+                        k_rc.after_rc_done.append(v_rc)
+
+            try:
+                dag.topological_sort(self.run_components,
+                                     lambda rc: rc.after_rc_done,
+                                     lambda rc: rc.name)
+            except dag.CyclicDependencyError as e:
+                raise exc.CampaignParseError(
+                    'Invalid rc_dependency: %s' % str(e))
 
     def get_fob_data_list(self):
         return [comp.as_fob_data() for comp in self.run_components]
@@ -647,33 +666,26 @@ class Run(object):
         self.total_nodes = sum(group_max_nodes)
 
     def _group_codes_by_dependencies(self, code_groups):
-        """Group RCs based upon the dependencies.
+        """Group RCs based upon the dependencies, so that a code that runs
+        after another code is placed on the same nodes. A code that depends
+        on several codes is placed with the first of them.
         Input is a list of dictionaries where the key is the code and value
         is the no. of ranks on a node"""
 
-        def parse_dicts(l_d):
-            for d in l_d:
-                for rc_name in d:
-                    rc = self._get_rc_by_name(rc_name)
-                    if rc.after_rc_done:
-                        if rc.after_rc_done.name not in list(d.keys()):
-                            target_d = None
-                            for d2 in l_d:
-                                if rc.after_rc_done.name in list(d2.keys()):
-                                    target_d = d2
-                                    break
-                            assert target_d is not None, \
-                                "Internal dependency management error! " \
-                                "Could not find rc {} in codes".format(
-                                    rc.after_rc_done.name)
-                            target_d[rc_name] = d[rc_name]
-                            del d[rc_name]
-                            return False
-            return True
-
-        done = False
-        while not done:
-            done = parse_dicts(code_groups)
+        def get_parents(rc_name):
+            rc = self._get_rc_by_name(rc_name)
+            return [parent.name for parent in rc.after_rc_done]
+
+        try:
+            group_of = dag.group_with_parents(code_groups, get_parents)
+        except KeyError as e:
+            raise CheetahException("Internal dependency management error! "
+                                   "Could not find rc {} in codes".format(e))
+        for i, d in enumerate(code_groups):
+            for rc_name in list(d.keys()):
+                target = group_of[rc_name]
+                if target != i:
+                    code_groups[target][rc_name] = d.pop(rc_name)
 
     def get_app_param_dict(self):
         """Return dictionary containing only the app parameters
@@ -686,7 +698,7 @@ class RunComponent(object):
                  component_inputs=None, sleep_after=None,
                  linked_with_sosflow=False, adios_xml_file=None,
                  env=None, env_file=None, timeout=None, hostfile=None,
-                 runner_override=False):
+                 runner_override=False, memory_per_node=None):
         self.name = name
         self.exe = exe
         self.args = args
@@ -701,9 +713,13 @@ class RunComponent(object):
         self.linked_with_sosflow = linked_with_sosflow
         self.adios_xml_file = adios_xml_file
         self.hostfile = hostfile
-        self.after_rc_done = None
+        # run components that must be done before this one is started
+        self.after_rc_done = []
         self.runner_override = runner_override
         self.num_nodes = 0
+        # MB needed on each node the code runs on, used by savanna to place
+        # pipelines on nodes
+        self.memory_per_node = memory_per_node
 
     def as_fob_data(self):
         data = dict(name=self.name,
@@ -725,8 +741,12 @@ class RunComponent(object):
             data['env_file'] = self.env_file
         if self.timeout:
             data['timeout'] = self.timeout
+        if self.memory_per_node:
+            data['memory_per_node'] = self.memory_per_node
         if self.hostfile:
             data['hostfile'] = self.working_dir + "/" + self.hostfile
-        if self.after_rc_done:
-            data['after_rc_done'] = self.after_rc_done.name
+        if len(self.after_rc_done) == 1:
+            data['after_rc_done'] = self.after_rc_done[0].name
+        elif self.after_rc_done:
+            data['after_rc_done'] = [rc.name for rc in self.after_rc_done]
         return data
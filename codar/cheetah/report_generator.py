@@ -21,6 +21,11 @@ from codar.cheetah.helpers import get_immediate_subdirs, \
                                   require_campaign_directory, find_subdir_path
 from codar.cheetah.error_messages import e_msg
 from codar.savanna import tau
+from codar.savanna.status import load_workflow_status
+from codar.savanna.environment import load_environment_index
+from codar.savanna.metadata import load_metadata, OUTPUT_SIZES_NAME
+from codar.savanna.usage import summarize_usage
+from codar.savanna.utils import USAGE_NAME
 
 _log = logging.getLogger(' ')
 
@@ -88,17 +93,25 @@ class _RunParser:
         # Serialize nested dict and add to list of parsed run dicts
         self.serialize_params_nested_dict(run_params_dict)
 
-    def get_cheetah_perf_data(self, run_dir):
+    def get_cheetah_perf_data(self, run_dir, metadata=None):
         """
         Read codar.savanna.total.workflow and the codar.workflow.walltime.<rc>
-        files
+        files, or the walltimes in the metadata store of the group if savanna
+        was run with --metadata-store
         """
 
+        run_id = os.path.basename(os.path.normpath(run_dir))
+
         # Get the total workflow runtime
         total_runtime = "N/A"
         total_time_fname = "codar.savanna.total.walltime"
         total_runtime_path = os.path.join(run_dir, total_time_fname)
-        if os.path.isfile(total_runtime_path):
+        walltime = None
+        if metadata is not None:
+            walltime = metadata.pipeline_walltime(run_id)
+        if walltime is not None:
+            total_runtime = str(round(walltime, 2))
+        elif os.path.isfile(total_runtime_path):
             with open(total_runtime_path) as f:
                 line = f.readline()
                 total_runtime = str(round(float(line),2))
@@ -112,7 +125,13 @@ class _RunParser:
             walltime_fname = "codar.workflow.walltime." + rc_name
             filepath = os.path.join(run_dir, walltime_fname)
             #pdb.set_trace()
-            if os.path.isfile(filepath):
+            walltime = None
+            if metadata is not None:
+                walltime = metadata.run_walltime(run_id, rc_name)
+            if walltime is not None:
+                self.serialized_run_params[rc_name + "__walltime_savanna"] =\
+                    str(round(walltime, 2))
+            elif os.path.isfile(filepath):
             # if Path(filepath).is_file():
                 with open(filepath) as f:
                     line = f.readline()
@@ -120,20 +139,50 @@ class _RunParser:
                 self.serialized_run_params[rc_name + "__walltime_savanna"] =\
                     walltime_str
 
+        # Summarize the resource usage samples of each component, if
+        # savanna was run with --usage-sample-interval
+        for rc_name in self.rc_names:
+            rc_dir = self.rc_working_dir.get(rc_name) or run_dir
+            usage_path = os.path.join(rc_dir, USAGE_NAME + "." + rc_name
+                                      + ".csv")
+            if not os.path.isfile(usage_path):
+                continue
+            usage = summarize_usage(usage_path)
+            if usage is None:
+                continue
+            for key, value in usage.items():
+                self.serialized_run_params[rc_name + "__" + key +
+                                           "_savanna"] = value
+
         _log.debug("Cheetah perf data obtained in {}".format(run_dir))
 
-    def read_adios_output_file_sizes(self):
+    def read_environment_snapshots(self, env_index):
+        """Add the id of the environment snapshot each rc was launched with,
+        so runs can be grouped by environment. The full environment can be
+        shown with cheetah status --show-environment."""
+        run_id = os.path.basename(os.path.normpath(self.run_dir))
+        for rc_name in self.rc_names:
+            entry = env_index.get((run_id, rc_name))
+            if entry is not None:
+                self.serialized_run_params[rc_name + "__environment"] = \
+                    entry['snapshot']
+
+    def read_adios_output_file_sizes(self, metadata=None):
         """
 
         :return:
         """
 
-        # @TODO: The name of the file must be fetched from somewhere
-        md_fname = ".codar.adios_file_sizes.out.json"
-        adios_filesizes_json = os.path.join(self.run_dir, md_fname)
-        if Path(adios_filesizes_json).is_file():
+        run_id = os.path.basename(os.path.normpath(self.run_dir))
+        adios_sizes_d = None
+        if metadata is not None:
+            adios_sizes_d = metadata.pipelines.get(run_id, {}).get(
+                                                            'output_sizes')
+        adios_filesizes_json = os.path.join(self.run_dir, OUTPUT_SIZES_NAME)
+        if adios_sizes_d is None and Path(adios_filesizes_json).is_file():
             with open(adios_filesizes_json, 'r') as f:
                 adios_sizes_d = json.load(f)
+        if adios_sizes_d is not None:
             file_count = 0
             for key, value in adios_sizes_d.items():
                 file_count = file_count + 1
@@ -362,8 +411,7 @@ class _ReportGenerator:
 
         # Read status file
         try:
-            with open(status_file, 'r') as f:
-                status_json = json.load(f)
+            status_json = load_workflow_status(status_file)
         except:
             _log.error("Could not read status file {}".format(status_file))
             return
@@ -374,10 +422,17 @@ class _ReportGenerator:
             if status_json[run_dir]['state'] == 'done':
                 run_status[run_dir] = status_json[run_dir]['reason']
 
+        # Environment snapshot index and metadata store, shared by all runs
+        # in the group
+        env_index = load_environment_index(group_dir)
+        metadata = load_metadata(group_dir)
+
         for run_dir, exit_status in run_status.items():
-            self.parse_run_dir(os.path.join(group_dir,run_dir), exit_status)
+            self.parse_run_dir(os.path.join(group_dir,run_dir), exit_status,
+                               env_index, metadata)
 
-    def parse_run_dir(self, run_dir, exit_status):
+    def parse_run_dir(self, run_dir, exit_status, env_index=None,
+                      metadata=None):
         """
         Parse run directory of a sweep group
         """
@@ -412,14 +467,18 @@ class _ReportGenerator:
 
         # Get timing information if the experiment was successful,
         # else leave the fields blank
-        rp.get_cheetah_perf_data(run_dir)
+        rp.get_cheetah_perf_data(run_dir, metadata)
+
+        # Get the environment snapshot of each rc
+        if env_index:
+            rp.read_environment_snapshots(env_index)
 
         # Get the sizes of the output adios files.
         # The sizes were calculated by the post-processing function
         # after the run finished.
         # For every file, create two columns: 'adios_file_1' and
         # 'adios_file_1_size', and so on.
-        rp.read_adios_output_file_sizes()
+        rp.read_adios_output_file_sizes(metadata)
 
         # Collect tau metrics
         if self.tau_metrics:
@@ -10,6 +10,13 @@ import glob
 
 from codar.cheetah.helpers import get_immediate_subdirs, \
                                   require_campaign_directory
+from codar.savanna.status import load_workflow_status, group_pipeline_id
+from codar.savanna.producer import read_fobs
+from codar.savanna.environment import load_environment_index, \
+                                      load_run_environment
+from codar.savanna.capture import CAPTURE_SUFFIX, open_output
+from codar.savanna.metadata import load_metadata
+from codar.cheetah.combine import read_combined_groups, read_combined_name
 
 
 def print_campaign_status(campaign_directory, filter_user=None,
@@ -19,7 +26,7 @@ def print_campaign_status(campaign_directory, filter_user=None,
                           run_summary=False,
                           print_logs=False, log_level='DEBUG',
                           return_codes=False, print_output=False,
-                          show_parameters=False):
+                          show_parameters=False, show_environment=False):
     require_campaign_directory(campaign_directory)
     user_dirs = get_immediate_subdirs(campaign_directory)
     for user in user_dirs:
@@ -32,7 +39,23 @@ def print_campaign_status(campaign_directory, filter_user=None,
                 continue
             user_group = user + '/' + group
             group_dir = os.path.join(user_dir, group)
-            jobid_file_path = os.path.join(group_dir,
+            combined_groups = read_combined_groups(group_dir)
+            if combined_groups is not None:
+                print(user_group, ':', 'COMBINED SUBMISSION of',
+                      ', '.join(name for name, _ in combined_groups))
+                continue
+
+            # groups that are part of a combined submission are run by its
+            # job, which writes the job id, log and walltime files. The
+            # pipeline ids in the log are prefixed with the group name.
+            job_dir = group_dir
+            log_filter_run = filter_run
+            combined_name = read_combined_name(group_dir)
+            if combined_name is not None:
+                job_dir = os.path.join(user_dir, combined_name)
+                log_filter_run = [group_pipeline_id(group, run)
+                                  for run in filter_run or ['']]
+            jobid_file_path = os.path.join(job_dir,
                                            'codar.cheetah.jobid.txt')
             if not os.path.exists(jobid_file_path):
                 print(user_group, ':', 'NOT SUBMITTED')
@@ -44,10 +67,10 @@ def print_campaign_status(campaign_directory, filter_user=None,
 
             fob_file_path = os.path.join(group_dir, 'fobs.json')
             code_names = _get_group_code_names(fob_file_path)
-            log_file_path = os.path.join(group_dir, 'codar.FOBrun.log')
+            log_file_path = os.path.join(job_dir, 'codar.FOBrun.log')
             status_file_path = os.path.join(group_dir,
                                             'codar.workflow.status.json')
-            walltime_file_path = os.path.join(group_dir,
+            walltime_file_path = os.path.join(job_dir,
                                               'codar.cheetah.walltime.txt')
             if os.path.exists(status_file_path):
                 status_data, state_counts, reason_counts, rc_counts = \
@@ -85,19 +108,24 @@ def print_campaign_status(campaign_directory, filter_user=None,
                                         print_parameters=show_parameters,
                                         code_names=code_names)
                 if print_logs:
-                    _print_fobrun_log(log_file_path, log_level, filter_run)
+                    _print_fobrun_log(log_file_path, log_level,
+                                      log_filter_run)
                 if print_output:
                     _print_group_code_output(group_dir, filter_run,
                                              filter_code)
+                if show_environment:
+                    _print_group_environment(group_dir, status_data.keys(),
+                                             code_names, filter_run,
+                                             filter_code)
             else:
                 print(user_group, ':', 'NOT STARTED')
 
 
 def _get_group_code_names(fob_file_path):
     """Extract code names from first run in fobs file."""
-    with open(fob_file_path) as f:
-        data = json.load(f)[0]
+    for _, data in read_fobs(fob_file_path):
         return [r['name'] for r in data['runs']]
+    return []
 
 
 def _print_fobrun_log(log_file_path, log_level, filter_run=None):
@@ -121,6 +149,31 @@ def _print_fobrun_log(log_file_path, log_level, filter_run=None):
             print(' ', line)
 
 
+def _print_group_environment(group_dir, run_names, code_names,
+                             filter_run=None, filter_code=None):
+    """Print the environment each code was launched with, rebuilt from the
+    group environment snapshots."""
+    index = load_environment_index(group_dir)
+    for run_name in sorted(run_names):
+        if filter_run and run_name not in filter_run:
+            continue
+        for code in code_names:
+            if filter_code and code not in filter_code:
+                continue
+            env = load_run_environment(group_dir, run_name, code, index)
+            if env is None:
+                continue
+            entry = index.get((run_name, code))
+            if entry is not None:
+                print('>>>', run_name, code, 'environment (snapshot %s)'
+                      % entry['snapshot'][:12])
+            else:
+                print('>>>', run_name, code, 'environment')
+            for k in sorted(env.keys()):
+                print('%s=%s' % (k, env[k]))
+            print()
+
+
 def _print_group_code_output(group_dir, filter_run=None, filter_code=None):
     run_dirs = get_immediate_subdirs(group_dir)
     for run_name in run_dirs:
@@ -140,16 +193,14 @@ def _print_run_code_output(run_name, run_dir, filter_code=None):
 
     outputs = defaultdict(dict) # key is code name, values are
                                 # dict { 'out': '...', 'err': '...'}
-    for fpath in out_files:
-        fname = os.path.basename(fpath)
-        parts = fname.split('.')
-        code = parts[-1]
-        outputs[code]['out'] = fpath
-    for fpath in err_files:
-        fname = os.path.basename(fpath)
-        parts = fname.split('.')
-        code = parts[-1]
-        outputs[code]['err'] = fpath
+    for k, fpaths in ('out', out_files), ('err', err_files):
+        for fpath in fpaths:
+            # output captured by savanna --output-cap is compressed
+            fname = os.path.basename(fpath)
+            if fname.endswith(CAPTURE_SUFFIX):
+                fname = fname[:-len(CAPTURE_SUFFIX)]
+            code = fname.split('.')[-1]
+            outputs[code][k] = fpath
 
     for code in sorted(outputs.keys()):
         if filter_code and code not in filter_code:
@@ -159,10 +210,14 @@ def _print_run_code_output(run_name, run_dir, filter_code=None):
                 continue
             fpath = outputs[code][k]
             size = os.path.getsize(fpath)
-            print('>>>', run_name, code, 'std' + k, '(%d bytes)' % size)
+            if fpath.endswith(CAPTURE_SUFFIX):
+                print('>>>', run_name, code, 'std' + k,
+                      '(%d bytes compressed)' % size)
+            else:
+                print('>>>', run_name, code, 'std' + k, '(%d bytes)' % size)
             # TODO: Encountering non utf-8 chars is unlikely,
             # but may get binary data, should handle that case better.
-            with open(fpath, encoding='utf-8', errors='backslashreplace') as f:
+            with open_output(fpath) as f:
                 for line in f:
                     # Hack to make utf-8 work even if python terminal
                     # default is ascii (seems necessary on cori for example).
@@ -174,6 +229,11 @@ def _print_run_code_output(run_name, run_dir, filter_code=None):
 
 
 def _parse_fobrun_log_line(line):
+    if line.startswith('{'):
+        # savanna --log-format=json
+        data = json.loads(line)
+        return (str(data['time']), _numeric_log_level(data['level']),
+                data['message'])
     dt_string = line[:24]
     level, message = line[24:].split(':', 1)
     level = _numeric_log_level(level)
@@ -192,8 +252,7 @@ def get_workflow_status(status_file_path, print_counts=False, indent=0,
                         print_parameters=False,
                         filter_code=None, run_summary=False,
                         code_names=None):
-    with open(status_file_path) as f:
-        status_data = json.load(f)
+    status_data = load_workflow_status(status_file_path)
 
     group_path = os.path.dirname(status_file_path)
 
@@ -233,6 +292,8 @@ def get_workflow_status(status_file_path, print_counts=False, indent=0,
         print()
 
     if print_return_codes or print_parameters or run_summary:
+        # walltimes of the codes, if savanna was run with --metadata-store
+        metadata = load_metadata(group_path)
         for run_name in sorted(status_data.keys()):
             if filter_run and run_name not in filter_run:
                 continue
@@ -243,6 +304,9 @@ def get_workflow_status(status_file_path, print_counts=False, indent=0,
                 sr_string = run_data['state'] + '; ' + reason
             else:
                 sr_string = run_data['state']
+            if run_data.get('output_accounting'):
+                sr_string += ('; output accounting '
+                              + run_data['output_accounting'])
             print(prefix + run_name + ':', sr_string)
             if not (print_return_codes or print_parameters):
                 continue
@@ -250,6 +314,7 @@ def get_workflow_status(status_file_path, print_counts=False, indent=0,
             param_json_path = os.path.join(run_path,
                                            'codar.cheetah.run-params.json')
             rc = run_data.get('return_codes', {})
+            run_states = run_data.get('runs', {})
             with open(param_json_path) as f:
                 all_params = json.load(f)
                 for code_name in code_names:
@@ -257,8 +322,15 @@ def get_workflow_status(status_file_path, print_counts=False, indent=0,
                         continue
                     # Note: return code could be None for some codes, so
                     # must use %s instead of %d
-                    print('%s%s: %s'
-                          % (prefix * 2, code_name, rc.get(code_name)))
+                    run_state = run_states.get(code_name)
+                    walltime = None
+                    if metadata is not None:
+                        walltime = metadata.run_walltime(run_name, code_name)
+                    print('%s%s: %s%s%s'
+                          % (prefix * 2, code_name, rc.get(code_name),
+                             ' (%s)' % run_state if run_state else '',
+                             ' %.2fs' % walltime if walltime is not None
+                             else ''))
                     if print_parameters:
                         code_params = all_params.get(code_name)
                         if not code_params:
@@ -1,5 +1,5 @@
 """Classes for running pipelines of MPI tasks based on a specified
-total process limit. The system is designed to use two + N threads:
+total process limit. The system is designed to use a fixed number of threads:
 
 1. consumer thread: get pipelines from queue and execute them when process
    slots become available. Stops when a None pipeline is received.
@@ -7,9 +7,10 @@ total process limit. The system is designed to use two + N threads:
 2. producer thread: add pipelines to queue. Can be from file or from network
    service.
 
-3. monitor threads: each process spawned by the consumer thread has a monitor
-   thread that blocks on the processes completing with a timeout, and kills the
-   process if it's not done after the timeout is reached.
+3. reaper thread: waits for all processes spawned by the consumer thread to
+   exit, and runs the timers that kill processes after their timeout is
+   reached. Launching processes and handling their completion is done by a
+   fixed size pool of worker threads, see codar.savanna.reaper.
 """
 
 from codar.savanna.pipeline import Pipeline
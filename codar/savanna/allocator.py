@@ -0,0 +1,276 @@
+"""
+Allocation of the nodes in the job to pipelines.
+
+Nodes are identified by the strings '1'..'N', the relative node names used
+in ERF files and node layouts. The allocator keeps a bitmap of free nodes
+and gives each pipeline a range of consecutive nodes when possible, so the
+ranks of a pipeline are not scattered across the job after hours of
+pipelines starting and finishing with different sizes.
+
+Nodes can be grouped by the network topology, e.g. by switch or dragonfly
+group, with a topology file. Each line of the file lists the nodes in one
+group, as node numbers or ranges, e.g.:
+
+    # group 0, nodes on switch A
+    1-16
+    17-24 33-40
+
+Pipelines are placed within a single group if possible. Nodes that are not
+listed form one more group.
+"""
+
+import logging
+
+
+_log = logging.getLogger('codar.savanna.allocator')
+
+
+class NodeAllocator(object):
+    """Bitmap allocator for the nodes of a job. Not thread safe, the
+    consumer calls it with free_cv acquired.
+
+    allocate picks, in order of preference:
+    1. the smallest range of consecutive free nodes within a group that is
+       big enough (best fit), using the start of the range;
+    2. the group with the fewest free nodes that has enough, taking its
+       longest free ranges first;
+    3. nodes from several groups, taking the groups with the most free
+       nodes first.
+
+    capacity is the (cpus, gpus, memory) of each node, see resources.py.
+    If share is True, pipelines that don't need all of a node can be
+    placed on nodes that are already in use by other pipelines, as long as
+    there are enough cpus, gpus and memory left. Partially used nodes are
+    filled first, so whole nodes stay free for big pipelines.
+    """
+
+    def __init__(self, max_nodes, groups=None, capacity=(None, None, None),
+                 share=False):
+        self.max_nodes = max_nodes
+        self.capacity = tuple(capacity)
+        self.share = share
+        self._free = bytearray(b'\x01') * max_nodes
+        self.free_count = max_nodes
+        if groups is None:
+            groups = [list(range(max_nodes))]
+        else:
+            groups = _complete_groups(groups, max_nodes)
+        # lists of node indexes
+        self.groups = groups
+        self._group_of = [0] * max_nodes
+        for i, group in enumerate(groups):
+            for node in group:
+                self._group_of[node] = i
+        # with sharing, the resources used on each node and the per node
+        # resources held by each owner: { owner: { node: used } }
+        self._used = [(0, 0, 0)] * max_nodes
+        self._holds = {}
+
+    @classmethod
+    def from_topology_file(cls, max_nodes, path, **kwargs):
+        return cls(max_nodes, read_topology_file(path), **kwargs)
+
+    def fits(self, resources):
+        """True if the resources can be allocated on an empty job."""
+        return (resources.nodes <= self.max_nodes
+                and resources.fits_node(self.capacity))
+
+    def usable_count(self):
+        """Number of nodes that could be given to a pipeline now: free
+        nodes, and with sharing, nodes with cpus left."""
+        if not self.share:
+            return self.free_count
+        cpus = self.capacity[0]
+        return sum(1 for used in self._used
+                   if cpus is None or used[0] < cpus)
+
+    def can_allocate(self, resources):
+        """True if allocate would succeed for the resources."""
+        if not self.share:
+            return resources.nodes <= self.free_count
+        return len(self._shared_candidates(resources)) + self.free_count \
+            >= resources.nodes
+
+    def allocate(self, n, resources=None, owner=None):
+        """Mark n nodes as used by owner and return their names in topology
+        order, or None if there are not enough free nodes. With sharing,
+        resources is the Resources needed by the owner and nodes in use
+        with enough resources left can be returned."""
+        if self.share and resources is not None:
+            return self._allocate_shared(n, resources, owner)
+        if n > self.free_count:
+            return None
+        if n == 0:
+            return []
+        nodes = self._allocate_free(n)
+        for node in nodes:
+            self._free[node] = 0
+        self.free_count -= n
+        return [str(node + 1) for node in nodes]
+
+    def free(self, names, owner=None):
+        """Return nodes to the free pool. Raises ValueError if a node is
+        already free."""
+        nodes = [int(name) - 1 for name in names]
+        holds = self._holds.get(owner) if self.share else None
+        if holds is not None:
+            for node in nodes:
+                if node not in holds:
+                    raise ValueError('node %d is not used by %s'
+                                     % (node + 1, owner))
+            for node in nodes:
+                used = holds.pop(node)
+                self._used[node] = tuple(a - b for a, b in
+                                         zip(self._used[node], used))
+                if not any(self._used[node]):
+                    self._free[node] = 1
+                    self.free_count += 1
+            if not holds:
+                del self._holds[owner]
+            return
+        for node in nodes:
+            if self._free[node]:
+                raise ValueError('node %d is already free' % (node + 1))
+        for node in nodes:
+            self._free[node] = 1
+        self.free_count += len(nodes)
+
+    def _allocate_free(self, n):
+        """Pick n free nodes, without marking them as used."""
+        if n == 0:
+            return []
+        runs = self._free_runs()
+        fits = [run for run in runs if len(run[1]) >= n]
+        if fits:
+            _, nodes = min(fits, key=lambda run: len(run[1]))
+            return nodes[:n]
+
+        by_group = {}
+        for group, nodes in runs:
+            by_group.setdefault(group, []).append(nodes)
+        group_free = dict((g, sum(len(r) for r in group_runs))
+                          for g, group_runs in by_group.items())
+        fits = [g for g, count in group_free.items() if count >= n]
+        if fits:
+            groups = [min(fits, key=lambda g: (group_free[g], g))]
+        else:
+            groups = sorted(group_free, key=lambda g: -group_free[g])
+        nodes = []
+        for g in groups:
+            for run in sorted(by_group[g], key=len, reverse=True):
+                nodes.extend(run[:n - len(nodes)])
+                if len(nodes) == n:
+                    break
+            if len(nodes) == n:
+                break
+        return self._sort(nodes)
+
+    def _shared_candidates(self, resources):
+        """Nodes in use that have enough resources left, in topology
+        order. Pipelines that need whole nodes can't share."""
+        if resources.cpus is None:
+            return []
+        need = resources.per_node(self.capacity)
+        return [node for group in self.groups for node in group
+                if not self._free[node]
+                and all(cap is None or used + n <= cap for used, n, cap
+                        in zip(self._used[node], need, self.capacity))]
+
+    def _allocate_shared(self, n, resources, owner):
+        if not resources.fits_node(self.capacity):
+            return None
+        shared = self._shared_candidates(resources)[:n]
+        if len(shared) + self.free_count < n:
+            return None
+        nodes = shared + self._allocate_free(n - len(shared))
+        need = resources.per_node(self.capacity)
+        holds = self._holds.setdefault(owner, {})
+        for node in nodes:
+            if self._free[node]:
+                self._free[node] = 0
+                self.free_count -= 1
+            self._used[node] = tuple(a + b for a, b in
+                                     zip(self._used[node], need))
+            holds[node] = need
+        return [str(node + 1) for node in self._sort(nodes)]
+
+    def largest_free_range(self):
+        return max((len(nodes) for _, nodes in self._free_runs()),
+                   default=0)
+
+    def fragmentation(self):
+        """Fraction of the free nodes that are not in the largest free range,
+        from 0 when the free nodes are consecutive to almost 1 when no two
+        free nodes are next to each other."""
+        if self.free_count == 0:
+            return 0.0
+        return 1 - self.largest_free_range() / self.free_count
+
+    def _free_runs(self):
+        """List of (group index, [node, ...]) for the maximal ranges of
+        consecutive free nodes within each group."""
+        runs = []
+        for g, group in enumerate(self.groups):
+            run = []
+            prev = None
+            for node in group:
+                if self._free[node] and (prev is None or node == prev + 1):
+                    run.append(node)
+                else:
+                    if run:
+                        runs.append((g, run))
+                    run = [node] if self._free[node] else []
+                prev = node
+            if run:
+                runs.append((g, run))
+        return runs
+
+    def _sort(self, nodes):
+        order = dict((node, i) for i, node in
+                     enumerate(n for group in self.groups for n in group))
+        return sorted(nodes, key=order.get)
+
+
+def read_topology_file(path):
+    """Parse a topology file into a list of groups of node indexes, see
+    the module docstring for the format."""
+    groups = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            group = []
+            for item in line.split():
+                first, _, last = item.partition('-')
+                try:
+                    first = int(first)
+                    last = int(last) if last else first
+                except ValueError:
+                    raise ValueError('invalid node range %r in %s'
+                                     % (item, path))
+                group.extend(range(first - 1, last))
+            groups.append(group)
+    return groups
+
+
+def _complete_groups(groups, max_nodes):
+    """Drop nodes that are not in the job or are listed twice, and add a
+    group with the nodes that are not listed."""
+    seen = set()
+    complete = []
+    for group in groups:
+        nodes = []
+        for node in group:
+            if 0 <= node < max_nodes and node not in seen:
+                seen.add(node)
+                nodes.append(node)
+        if nodes:
+            complete.append(nodes)
+    rest = [node for node in range(max_nodes) if node not in seen]
+    if rest:
+        if len(rest) < max_nodes:
+            _log.warning('%d nodes are not in the topology file',
+                         len(rest))
+        complete.append(rest)
+    return complete
@@ -0,0 +1,76 @@
+from codar.savanna.allocator import NodeAllocator, read_topology_file
+from codar.savanna.resources import Resources, layout_resources
+
+
+def test_best_fit():
+    a = NodeAllocator(10)
+    assert a.allocate(3) == ['1', '2', '3']
+    assert a.allocate(2) == ['4', '5']
+    assert a.allocate(5) == ['6', '7', '8', '9', '10']
+    assert a.allocate(1) is None
+    a.free(['4', '5'])
+    a.free(['8', '9', '10'])
+    # the 2 node hole is the best fit
+    assert a.allocate(2) == ['4', '5']
+    assert a.fragmentation() == 0
+    a.free(['1', '2', '3', '4', '5'])
+    assert a.largest_free_range() == 5
+    assert a.fragmentation() == 3 / 8
+    # no range of 7 nodes, use the biggest ranges
+    assert a.allocate(7) == ['1', '2', '3', '4', '5', '8', '9']
+
+
+def test_double_free():
+    a = NodeAllocator(2)
+    a.allocate(1)
+    try:
+        a.free(['2'])
+    except ValueError as e:
+        assert 'already free' in str(e)
+    else:
+        assert False, 'expected ValueError, got no error'
+
+
+def test_topology_groups(tmpdir):
+    path = str(tmpdir.join('topology.txt'))
+    with open(path, 'w') as f:
+        f.write('# two switches\n1-4\n5 6 7-8\n')
+    assert read_topology_file(path) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    a = NodeAllocator.from_topology_file(10, path)
+    # unlisted nodes 9 and 10 form a group
+    assert a.allocate(2) == ['9', '10']
+    assert a.allocate(3) == ['1', '2', '3']
+    # 4 is free but in another group than 5-8
+    assert a.allocate(4) == ['5', '6', '7', '8']
+    assert a.allocate(1) == ['4']
+
+
+def test_shared_nodes():
+    a = NodeAllocator(3, capacity=(4, 2, 100), share=True)
+    gpu_pipe = Resources(2, 1, 2, 10)
+    cpu_pipe = Resources(2, 3, 0, 50)
+    whole = Resources(1, None, 0, 0)
+    assert a.allocate(2, gpu_pipe, 'gpu') == ['1', '2']
+    # fills the nodes used by gpu first
+    assert a.can_allocate(cpu_pipe)
+    assert a.allocate(2, cpu_pipe, 'cpu') == ['1', '2']
+    assert a.free_count == 1
+    assert a.usable_count() == 1
+    assert not a.can_allocate(gpu_pipe)
+    assert a.allocate(1, whole, 'whole') == ['3']
+    a.free(['1', '2'], 'gpu')
+    assert a.free_count == 0
+    a.free(['1', '2'], 'cpu')
+    assert a.free_count == 2
+    assert not a.fits(Resources(1, 1, 3, 0))
+
+
+def test_layout_resources():
+    layout = [{'__info_type__': 'NodeConfig',
+               'cpu': ['sim:0', 'sim:1', 'ana:0', None],
+               'gpu': [['sim:0'], None, None]}]
+    assert layout_resources(2, layout, {'sim': 100, 'viz': 5}) == \
+        Resources(2, 3, 1, 105)
+    assert layout_resources(1, [{'sim': 4}, {'ana': 2}], {'ana': 10}) == \
+        Resources(1, 4, 0, 10)
+    assert layout_resources(3, None) == Resources(3, None, 0, 0)
@@ -0,0 +1,244 @@
+"""
+Optional capture of the stdout and stderr of runs through pipes, for codes
+that write more output than is worth keeping on a shared filesystem, e.g.
+MPI codes logging from every rank.
+
+When enabled, the output of each run is read from a pipe and written to a
+gzip file, the usual stdout or stderr file name with CAPTURE_SUFFIX. Only
+the first and last bytes of the output are kept, up to max_bytes in total,
+with a line saying how many bytes were left out in between. The head is
+compressed as it is read and the tail is kept in memory until the end, so
+memory use is bounded by the size of the tail.
+
+A single collector thread reads the pipes of all runs, like the reaper
+does for the processes, so the number of threads does not grow with the
+number of concurrent runs. Closing a capture does not wait for the end of
+the output, which may be held back by a process that left the process
+group of the run, use the done callbacks of the capture instead. Use
+open_output to read captured or plain output files.
+"""
+
+import os
+import time
+import gzip
+import heapq
+import itertools
+import selectors
+import threading
+import logging
+from collections import deque
+
+
+CAPTURE_SUFFIX = '.gz'
+
+# Bytes read from a pipe at a time
+READ_SIZE = 65536
+
+COMPRESS_LEVEL = 6
+
+# Max seconds to wait for the end of the output once the process group of a
+# run is gone, in case a process that left the group keeps the pipe open
+CLOSE_TIMEOUT = 5.0
+
+OMITTED_LINE = b'\n[savanna: %d bytes of output omitted]\n'
+
+
+_log = logging.getLogger('codar.savanna.capture')
+
+
+class OutputCapture(object):
+    """Gzip file with the output read from a pipe, keeping the first half
+    of max_bytes and the last half. Written by the collector thread, use
+    wait or add_done_callback to know when the file is complete."""
+
+    def __init__(self, path, max_bytes, compresslevel=COMPRESS_LEVEL):
+        self.path = path
+        self.head_bytes = max_bytes // 2
+        self.tail_bytes = max_bytes - self.head_bytes
+        self.total_bytes = 0
+        self.omitted_bytes = 0
+        self._head_written = 0
+        self._tail = deque()
+        self._tail_size = 0
+        self._file = gzip.open(path, 'wb', compresslevel)
+        self._failed = False
+        self._done = threading.Event()
+        self._callbacks_lock = threading.Lock()
+        self._callbacks = []
+
+    def write(self, data):
+        self.total_bytes += len(data)
+        head_left = self.head_bytes - self._head_written
+        if head_left > 0:
+            self._write(data[:head_left])
+            self._head_written += min(head_left, len(data))
+            data = data[head_left:]
+        if not data:
+            return
+        self._tail.append(data)
+        self._tail_size += len(data)
+        # drop the chunks that are entirely before the tail
+        while (self._tail
+               and self._tail_size - len(self._tail[0]) >= self.tail_bytes):
+            self._tail_size -= len(self._tail.popleft())
+
+    def close(self):
+        """Write the tail and close the file."""
+        tail = b''.join(self._tail)
+        tail = tail[max(0, len(tail) - self.tail_bytes):]
+        self._tail.clear()
+        self.omitted_bytes = (self.total_bytes - self._head_written
+                              - len(tail))
+        if self.omitted_bytes:
+            self._write(OMITTED_LINE % self.omitted_bytes)
+        self._write(tail)
+        try:
+            self._file.close()
+        except OSError:
+            _log.exception('failed to close %s', self.path)
+        with self._callbacks_lock:
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            fn(self)
+
+    def wait(self, timeout=None):
+        """Wait until the end of the output has been written. Returns False
+        if the timeout expired first."""
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, fn):
+        """Call fn(capture) once the end of the output has been written, in
+        the collector thread, or right away if it already has. fn must not
+        block."""
+        with self._callbacks_lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _write(self, data):
+        if self._failed or not data:
+            return
+        try:
+            self._file.write(data)
+        except OSError:
+            # keep reading, so the code does not block on a full pipe
+            _log.exception('failed to write %s, discarding output',
+                           self.path)
+            self._failed = True
+
+
+class OutputCollector(object):
+    """Thread reading the pipes of the runs with captured output. The
+    thread is started when the first pipe is opened."""
+
+    def __init__(self, max_bytes, compresslevel=COMPRESS_LEVEL):
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        self._lock = threading.Lock()
+        self._thread = None
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        # pipes to start reading and captures to stop reading, handled
+        # by the collector thread
+        self._new_pipes = []
+        self._fds = {}
+        # heap of (time, seq, capture) to stop reading captures still open
+        self._deadlines = []
+        self._seq = itertools.count()
+
+    def open_pipe(self, path):
+        """Create a pipe with its output captured in path. Returns the
+        write end, to be passed to the process and closed by the caller
+        once it is started, and the OutputCapture."""
+        capture = OutputCapture(path, self.max_bytes, self.compresslevel)
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        with self._lock:
+            self._new_pipes.append((read_fd, capture))
+        self._wakeup()
+        return write_fd, capture
+
+    def close_capture(self, capture, timeout=CLOSE_TIMEOUT):
+        """Stop reading the output of capture if its end does not come
+        within timeout seconds. Returns immediately."""
+        if capture.wait(0):
+            return
+        with self._lock:
+            heapq.heappush(self._deadlines, (time.time() + timeout,
+                                             next(self._seq), capture))
+        self._wakeup()
+
+    def _wakeup(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='Thread-capture',
+                                                daemon=True)
+                self._thread.start()
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            # pipe is full, so the collector will wake up anyway
+            pass
+
+    def _run(self):
+        while True:
+            now = time.time()
+            abandoned = []
+            with self._lock:
+                new_pipes = self._new_pipes
+                self._new_pipes = []
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    abandoned.append(heapq.heappop(self._deadlines)[2])
+                timeout = None
+                if self._deadlines:
+                    timeout = self._deadlines[0][0] - now
+            for fd, capture in new_pipes:
+                self._fds[capture] = fd
+                self._selector.register(fd, selectors.EVENT_READ, capture)
+            for capture in abandoned:
+                if capture in self._fds:
+                    _log.warning('output of %s still open, closing it',
+                                 capture.path)
+                    self._finish(capture)
+
+            for key, _ in self._selector.select(timeout):
+                if key.fileobj == self._wakeup_r:
+                    self._drain_wakeup()
+                    continue
+                try:
+                    data = os.read(key.fileobj, READ_SIZE)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b''
+                if data:
+                    key.data.write(data)
+                else:
+                    self._finish(key.data)
+
+    def _finish(self, capture):
+        fd = self._fds.pop(capture)
+        self._selector.unregister(fd)
+        os.close(fd)
+        capture.close()
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def open_output(path, errors='backslashreplace'):
+    """Open a run output file for reading as text, captured or not."""
+    if path.endswith(CAPTURE_SUFFIX):
+        return gzip.open(path, 'rt', encoding='utf-8', errors=errors)
+    return open(path, encoding='utf-8', errors=errors)
@@ -0,0 +1,81 @@
+import os
+import gzip
+import time
+import subprocess
+
+from codar.savanna.capture import OutputCapture, OutputCollector, \
+    open_output, OMITTED_LINE
+
+
+def test_capture_head_tail(tmpdir):
+    path = str(tmpdir.join('out.gz'))
+    capture = OutputCapture(path, 10)
+    for chunk in b'abc', b'defgh', b'ijklmnopq', b'rs', b'tuvwxyz':
+        capture.write(chunk)
+    capture.close()
+    assert capture.wait(0)
+    assert capture.total_bytes == 26
+    assert capture.omitted_bytes == 16
+    with gzip.open(path) as f:
+        assert f.read() == b'abcde' + OMITTED_LINE % 16 + b'vwxyz'
+
+    # nothing is left out when the output fits
+    capture = OutputCapture(path, 10)
+    capture.write(b'0123')
+    capture.write(b'4567')
+    capture.close()
+    assert capture.omitted_bytes == 0
+    with open_output(path) as f:
+        assert f.read() == '01234567'
+
+
+def test_collector_pipes(tmpdir):
+    collector = OutputCollector(1000)
+    out_path = str(tmpdir.join('stdout.gz'))
+    err_path = str(tmpdir.join('stderr.gz'))
+    out, out_capture = collector.open_pipe(out_path)
+    err, err_capture = collector.open_pipe(err_path)
+    try:
+        p = subprocess.Popen(['sh', '-c', 'seq 100000; echo failed >&2'],
+                             stdout=out, stderr=err)
+    finally:
+        os.close(out)
+        os.close(err)
+    p.wait()
+    collector.close_capture(out_capture)
+    collector.close_capture(err_capture)
+    assert out_capture.wait(5) and err_capture.wait(5)
+
+    with open_output(out_path) as f:
+        lines = f.read().split('\n')
+    assert lines[:3] == ['1', '2', '3']
+    assert lines[-2:] == ['100000', '']
+    assert out_capture.omitted_bytes > 0
+    assert len(gzip.open(out_path).read()) < 1100
+    with open_output(err_path) as f:
+        assert f.read() == 'failed\n'
+
+
+def test_collector_close_timeout(tmpdir):
+    collector = OutputCollector(1000)
+    path = str(tmpdir.join('stdout.gz'))
+    out, capture = collector.open_pipe(path)
+    try:
+        # keeps the pipe open, like a process that left the process group
+        p = subprocess.Popen(['sleep', '30'], stdout=out)
+    finally:
+        os.close(out)
+    try:
+        closed = []
+        start = time.time()
+        collector.close_capture(capture, timeout=0.2)
+        capture.add_done_callback(closed.append)
+        assert not closed
+        assert capture.wait(5)
+        assert closed == [capture]
+        assert time.time() - start < 5
+    finally:
+        p.kill()
+        p.wait()
+    with open_output(path) as f:
+        assert f.read() == ''
@@ -2,20 +2,51 @@
 specified total process limit."""
 
 import threading
+import heapq
+from collections import deque
+import time
 import os
 import json
 import logging
 from shutil import copyfile
 from pathlib import Path
-from queue import Queue
 
 from codar.cheetah.helpers import get_file_size
-from codar.savanna import status
-from codar.savanna.scheduler import JobList
+from codar.savanna import status, machines, trace
+from codar.savanna.scheduler import JobList, BackfillJobList, \
+    FairShare, FairShareJobList
+from codar.savanna.estimator import WalltimeEstimator
+from codar.savanna.producer import PipelineDescriptor
+from codar.savanna.reaper import WorkerPool
+from codar.savanna.allocator import NodeAllocator
+from codar.savanna.metrics import MetricsRegistry, MetricsPublisher
+from codar.savanna.usage import UsageSampler
+from codar.savanna.logs import log_fields
+from codar.savanna.capture import OutputCollector
+from codar.savanna.metadata import close_metadata_stores, OUTPUT_SIZES_NAME
 
 
 _log = logging.getLogger('codar.savanna.consumer')
 
+# Default max seconds to wait for pipelines to exit after kill_all
+KILL_TIMEOUT = 60
+
+# Threads for computing the size of pipeline output files after the
+# pipeline nodes have been released
+OUTPUT_ACCOUNTING_THREADS = 4
+
+# Default seconds before the job deadline that pipelines must be done by, to
+# leave time to kill what is still running and save the status
+WALLTIME_MARGIN = 60
+
+
+def _machine_gpus_per_node(machine_name):
+    """GPUs per node of the machine, or None if not known."""
+    try:
+        return len(machines.get_by_name(machine_name).node_class().gpu)
+    except Exception:
+        return None
+
 
 class PipelineRunner(object):
     """Runner that assumes a homogonous set of nodes. Now only support only
@@ -24,55 +55,252 @@ class PipelineRunner(object):
 
     Threading model: assumes there could be multiple producer threads calling
     add_pipeline, e.g. if using a dynamic job submission model based on
-    results of previous jobs. Pipelines and each Run in a pipeline are all
-    executed in separate threads, so their notification callbacks execute in
-    separate threads, and their threads must be joined before exiting. The
-    stop and kill_all methods could be called from any of the producer,
-    Pipeline or Run threads."""
+    results of previous jobs. The Runs of all pipelines are monitored by the
+    reaper, so their notification callbacks execute in reaper worker
+    threads, and pipelines must be joined before exiting. The stop and
+    kill_all methods could be called from any of the producer or reaper
+    threads.
+
+    add_pipeline accepts Pipeline objects or PipelineDescriptor objects,
+    which are only loaded into a Pipeline when they are started. Producers
+    that choose new pipelines from the results of earlier ones can register
+    a function with add_done_callback to be told when each pipeline leaves
+    the consumer, see AdaptiveProducer.
+
+    The scheduling policy is either 'greedy', which starts the biggest
+    pipeline that fits whenever nodes are freed, or 'backfill', which
+    reserves nodes for the biggest waiting pipeline and only starts smaller
+    pipelines ahead of it if their estimated walltime doesn't delay it.
+
+    When a pipeline is done its nodes are released first, and the output
+    files are scanned afterwards in a fixed size pool of threads. The
+    pipeline status has output_accounting set to pending until the scan is
+    done, and run_pipelines waits for pending scans before returning.
+
+    If the deadline of the batch job is known, pipelines are only started
+    if their estimated walltime, or the bound from their run timeouts, ends
+    at least walltime_margin seconds before it, so near the end only short
+    pipelines are started. Pipelines that can no longer fit are removed
+    from the queue and stay not_started for the next submission. Pipelines
+    with no estimate and no timeouts are always started.
+
+    Pipelines from several sweep groups can share the nodes of the job. The
+    pipeline ids are then prefixed with the group name (see
+    Pipeline.local_id), group_status_files maps each group to its status
+    file, and group_weights to its share of the nodes, see
+    FairShareJobList. Groups have weight 1 by default.
+
+    If output_cap is set, the stdout and stderr of the runs are captured in
+    gzip files keeping at most output_cap bytes of each, see capture.py.
+
+    If metadata_store is True, the return codes, walltimes and output sizes
+    of the pipelines are saved in the metadata store of their group rather
+    than in files in their working dir, see metadata.py."""
 
     def __init__(self, runner, max_nodes, machine_name, processes_per_node,
-                 status_file=None):
+                 status_file=None, scheduling_policy='greedy',
+                 kill_timeout=KILL_TIMEOUT,
+                 output_accounting_threads=OUTPUT_ACCOUNTING_THREADS,
+                 node_topology_file=None, gpus_per_node=None,
+                 memory_per_node=None, share_nodes=False,
+                 metrics_file=None, metrics_port=None,
+                 usage_sample_interval=None, trace_file=None,
+                 clock=time.time, deadline=None,
+                 walltime_margin=WALLTIME_MARGIN, group_status_files=None,
+                 group_weights=None, output_cap=None,
+                 metadata_store=False):
         self.max_nodes = max_nodes
+        self.kill_timeout = kill_timeout
         self.machine_name = machine_name
         self.ppn = processes_per_node
         self.runner = runner
-
-        if status_file is not None:
+        # time source for scheduling decisions, replaced by the simulator
+        self._clock = clock
+        # time by which pipelines must be done, or None if not known
+        self.deadline = deadline
+        self.walltime_margin = walltime_margin
+        # estimated walltime of queued pipelines by id, if there is a
+        # deadline or the backfill policy is used, and heap of the (latest
+        # start time, id) of the ones with an estimate, if there is a
+        # deadline. Protected by free_cv.
+        self._queued_walltimes = {}
+        self._latest_starts = []
+
+        if group_status_files is not None:
+            self._status = status.GroupWorkflowStatus(group_status_files)
+        elif status_file is not None:
             self._status = status.WorkflowStatus(status_file)
         else:
             self._status = None
 
         self.job_list_cv = threading.Condition()
         costfn = lambda pipe_or_run: pipe_or_run.get_nodes_used()
-        self.job_list = JobList(costfn)
+        self.scheduling_policy = scheduling_policy
+        self._estimator = WalltimeEstimator()
+        if scheduling_policy == 'greedy':
+            make_list = lambda: JobList(costfn)
+        elif scheduling_policy == 'backfill':
+            make_list = lambda: BackfillJobList(costfn, clock=clock)
+        else:
+            raise ValueError('Unknown scheduling policy: %s'
+                             % scheduling_policy)
+        # nodes held and used by each sweep group, if there are several.
+        # Protected by free_cv.
+        if group_status_files is not None or group_weights is not None:
+            self._fair_share = FairShare(group_weights, clock)
+            self.job_list = FairShareJobList(make_list, lambda p: p.group,
+                                             self._fair_share)
+        else:
+            self._fair_share = None
+            self.job_list = make_list()
+
+        # expected (end time, nodes) of running pipelines by id, used by the
+        # backfill policy to compute reservations. Protected by free_cv.
+        self._running_estimates = {}
+
+        # time each pipeline was queued and assigned nodes, by id, for the
+        # trace timeline. Protected by free_cv.
+        self._queued_times = {}
+        self._assigned_times = {}
+        if trace_file is not None:
+            trace.start_trace(trace_file)
 
         self.free_cv = threading.Condition()
         self.free_nodes = max_nodes
 
-        self.pipelines_lock = threading.Lock()
+        # Also used to wait for running pipelines to finish
+        self.pipelines_lock = threading.Condition()
         self.pipelines = []
         self._pipeline_ids = set()
 
         self._running_pipelines = set()
+        # done pipelines with output files still being scanned, protected
+        # by pipelines_lock
+        self._accounting_pipelines = set()
+        self._accounting_pool = WorkerPool(output_accounting_threads,
+                                           'Thread-output-accounting')
         self._process_pipelines = True
         self._allow_new_pipelines = True
         self._killed = False
+        # functions called with (pipeline, state) when a pipeline is done
+        self._done_callbacks = []
+        # time after which kill_all stops waiting for pipelines to exit
+        self._kill_deadline = None
+
+        # relative node names starting with 1, used for creating ERF files.
+        # Protected by free_cv.
+        if share_nodes and scheduling_policy != 'greedy':
+            raise ValueError('node sharing is only supported with the greedy '
+                             'scheduling policy')
+        if gpus_per_node is None:
+            gpus_per_node = _machine_gpus_per_node(machine_name)
+        capacity = (processes_per_node, gpus_per_node, memory_per_node)
+        if node_topology_file is not None:
+            self.node_allocator = NodeAllocator.from_topology_file(
+                                            max_nodes, node_topology_file,
+                                            capacity=capacity,
+                                            share=share_nodes)
+        else:
+            self.node_allocator = NodeAllocator(max_nodes, capacity=capacity,
+                                                share=share_nodes)
 
-        # a queue of allocated nodes
-        self.allocated_nodes = self._get_node_list(machine_name, max_nodes)
+        # samples the cpu, memory and io of the runs if enabled
+        if usage_sample_interval:
+            self.usage_sampler = UsageSampler(usage_sample_interval)
+        else:
+            self.usage_sampler = None
 
-    def _get_node_list(self, machine_name, max_nodes):
-        """Get a list of hostnames in this allocation.
-        Currently supported for Summit only. Hostnames start with 'host1'"""
+        self.use_metadata_store = metadata_store
 
-        q = Queue()
-        # if machine_name.lower() == 'summit':
-        # add relative node names starting with 1 for creating ERF files
-        for i in range(max_nodes):
-            q.put('{}'.format(i+1))
-        return q
+        # reads the output of the runs if capture is enabled
+        if output_cap:
+            self.output_collector = OutputCollector(output_cap)
+        else:
+            self.output_collector = None
+
+        # time since there have been nodes that no pipeline is using,
+        # protected by free_cv
+        self._nodes_free_since = None
+        self._launch_times = deque()
+        self.metrics = MetricsRegistry()
+        self._init_metrics()
+        if metrics_file is not None or metrics_port is not None:
+            self._metrics_publisher = MetricsPublisher(
+                            self.metrics, metrics_file, http_port=metrics_port)
+        else:
+            self._metrics_publisher = None
+
+    def _init_metrics(self):
+        m = self.metrics
+        m.gauge('max_nodes', 'Nodes in the job', lambda: self.max_nodes)
+        m.gauge('free_nodes', 'Nodes not used by any pipeline',
+                lambda: self.free_nodes)
+        m.gauge('node_fragmentation', 'Fraction of the free nodes outside '
+                'the largest range of consecutive free nodes',
+                self.node_allocator.fragmentation)
+        m.gauge('job_queue_length', 'Pipelines waiting to be started',
+                lambda: len(self.job_list))
+        m.gauge('running_pipelines', 'Pipelines that have been started and '
+                'are not done', lambda: len(self._running_pipelines))
+        m.gauge('output_accounting_pending', 'Done pipelines with output '
+                'files still being scanned',
+                lambda: len(self._accounting_pipelines))
+        m.gauge('launches_per_minute', 'Pipelines started in the last 60 '
+                'seconds', self._launches_per_minute)
+        self._m_started = m.counter('pipelines_started_total',
+                                    'Pipelines started')
+        self._m_finished = m.counter('pipelines_finished_total',
+                                     'Pipelines done, by state and reason',
+                                     ('state', 'reason'))
+        self._m_killed = m.counter('runs_killed_total', 'Runs killed, by '
+                                   'reason (timeout, partial_failure or '
+                                   'kill_all)', ('reason',))
+        self._m_deferred = m.counter('pipelines_deferred_total', 'Pipelines '
+                                     'left for the next submission because '
+                                     'they would not be done before the '
+                                     'job deadline')
+        self._m_idle = m.summary('node_idle_seconds', 'Time from nodes '
+                                 'becoming free to the next pipeline launch')
+        status_write = m.summary('status_write_seconds', 'Time to write a '
+                                 'batch of state changes to the status '
+                                 'journal, including compaction')
+        if self._status is not None:
+            self._status.write_summary = status_write
+
+    def _launches_per_minute(self):
+        with self.free_cv:
+            self._trim_launch_times(self._clock())
+            return len(self._launch_times)
+
+    def _trim_launch_times(self, now):
+        """Must be called with free_cv acquired."""
+        while self._launch_times and self._launch_times[0] < now - 60:
+            self._launch_times.popleft()
+
+    @property
+    def killed(self):
+        return self._killed
+
+    def add_done_callback(self, fn):
+        """Call fn(pipeline, state) when a pipeline is done and its output
+        has been scanned, or when it is removed from the queue without
+        being run, because it could not be loaded or would not be done
+        before the deadline. state is the final PipelineState. Called from
+        consumer, reaper and output accounting threads, sometimes with locks
+        held, so fn must not block or call the consumer."""
+        self._done_callbacks.append(fn)
+
+    def _execute_done_callbacks(self, pipeline, state):
+        for fn in self._done_callbacks:
+            try:
+                fn(pipeline, state)
+            except Exception:
+                _log.exception("pipeline %s done callback failed",
+                               pipeline.id)
 
     def add_pipeline(self, p):
+        """Queue a pipeline to be run. Returns False if it can't run on the
+        nodes of the job, and raises ValueError after stop or kill_all."""
         with self.pipelines_lock:
             if not self._allow_new_pipelines:
                 raise ValueError(
@@ -86,21 +314,40 @@ class PipelineRunner(object):
             # set_total_nodes() is deprecated. Leave it here for now.
             # p.set_total_nodes()
 
-            if p.get_nodes_used() > self.max_nodes:
+            if not self.node_allocator.fits(p.get_resources()):
                 _log.error(
-                    "pipeline '%s' requires %d nodes > max %d, skipping",
-                    p.id, p.get_nodes_used(), self.max_nodes)
+                    "pipeline '%s' requires %s > max %d nodes with %s "
+                    "(cpus, gpus, memory) each, skipping",
+                    p.id, p.get_resources(), self.max_nodes,
+                    self.node_allocator.capacity)
                 if self._status is not None:
                     state = p.get_state()
                     state.reason = status.REASON_NOFIT
                     self._status.set_state(state)
-                return
+                return False
             elif self._status is not None:
                 self._status.set_state(p.get_state())
 
+        # reads files of the pipeline, and of the group the first time, so
+        # it is done without holding the locks the consumer thread needs
+        walltime = None
+        needs_estimate = (self.deadline is not None
+                          or self.scheduling_policy == 'backfill')
+        if needs_estimate:
+            walltime = self._estimator.estimate(p)
+
+        with self.free_cv:
+            self._queued_times[p.id] = self._clock()
+            if needs_estimate:
+                self._queued_walltimes[p.id] = walltime
+            if self.deadline is not None and walltime is not None:
+                heapq.heappush(self._latest_starts,
+                               (self.deadline - self.walltime_margin
+                                - walltime, p.id))
         with self.job_list_cv:
-            self.job_list.add_job(p)
+            self.job_list.add_job(p, walltime)
             self.job_list_cv.notify()
+        return True
 
     def stop(self):
         """Signal to stop when all pipelines are finished. Don't allow adding
@@ -113,7 +360,11 @@ class PipelineRunner(object):
 
     def kill_all(self):
         """Kill all running processes spawned by this consumer and don't
-        start any new processes."""
+        start any new processes. Does not block. All pipelines are killed
+        at once, processes that are still running after half of the kill
+        timeout are sent SIGKILL, and the consumer thread stops waiting for
+        pipelines and saves the final status once the kill timeout is
+        reached."""
 
         _log.warning("killing all pipelines and exiting consumer")
 
@@ -121,7 +372,10 @@ class PipelineRunner(object):
             self._killed = True
             self._allow_new_pipelines = False
             self._process_pipelines = False
+            if self._kill_deadline is None:
+                self._kill_deadline = time.time() + self.kill_timeout
             still_running = list(self._running_pipelines)
+            self.pipelines_lock.notify_all()
 
         # signal both cvs to stop waiting in main thread
         with self.free_cv:
@@ -131,69 +385,124 @@ class PipelineRunner(object):
             self.job_list_cv.notify()
 
         for pipe in still_running:
-            # Release allocated nodes. Don't really need to do this as all
-            # pipelines are being killed.
-            # Return nodes used by the pipeline
-            while not pipe.nodes_assigned.empty():
-                pipe_node = pipe.nodes_assigned.get()
-                self.allocated_nodes.put(pipe_node)
-
-            pipe.force_kill_all()
-            _log.debug("killed pipeline {}, free nodes {} -> {}".format(
-                pipe.id, self.free_nodes, self.free_nodes + pipe.total_nodes))
+            # Nodes are returned by pipeline_finished when the killed runs
+            # are done.
+            pipe.force_kill_all(self.kill_timeout / 2)
+            _log.debug("killed pipeline %s", pipe.id,
+                       extra=log_fields(pipe.id))
         # NB: the run_pipelines methods will block waiting for the
         # pipelines, so we don't need to do that here. Callers that want
         # to block can call join on the consumer thread.
 
-    def run_finished(self, run):
-        """TO BE DEPRECATED.
-        Monitor thread(s) should call this as runs
-        complete. To be deprecated, as the functionality fails when
-        node_layout is set to node-sharing.
-
-        This means that for node_exclusive, resources held by a run are not
-        released when the run terminates. For kill_on_partial_failure=False,
-        this could lead to unused resources, which is ok."""
-        # with self.free_cv:
-        #     _log.debug("finished run, free nodes %d -> %d",
-        #                self.free_nodes, self.free_nodes + run.get_nodes_used())
-        #     self.free_nodes += run.get_nodes_used()
-        #     self.free_cv.notify()
-        pass
+    def nodes_released(self, pipeline, nodes):
+        """Pipelines call this when runs finish and the nodes they used are
+        not needed by any other run in the pipeline, so new pipelines can be
+        started on them before the whole pipeline is done."""
+        with self.free_cv:
+            self._return_nodes(pipeline, nodes)
+            self.free_cv.notify()
+
+    def _return_nodes(self, pipeline, nodes):
+        """Must be called with free_cv acquired."""
+        self.node_allocator.free(nodes, pipeline.id)
+        if self._fair_share is not None:
+            self._fair_share.release(pipeline.group, len(nodes))
+        now = self._clock()
+        for node in nodes:
+            trace.node_span(node, pipeline.id,
+                            self._assigned_times.get(pipeline.id), now)
+        _log.debug("pipeline %s released nodes %s, free nodes %d -> %d",
+                   pipeline.id, nodes, self.free_nodes,
+                   self.node_allocator.free_count,
+                   extra=log_fields(pipeline.id, node_ids=nodes))
+        self.free_nodes = self.node_allocator.free_count
+        if self._nodes_free_since is None:
+            self._nodes_free_since = now
+
+        estimate = self._running_estimates.get(pipeline.id)
+        if estimate is not None:
+            end_time, held = estimate
+            self._running_estimates[pipeline.id] = (end_time,
+                                                    held - len(nodes))
 
     def pipeline_finished(self, pipeline):
         """Monitor thread(s) should call this as pipelines complete."""
 
-        # Get the sizes of all output adios files
-        self._get_adios_metadata(pipeline)
-
-        # Free resources used by the pipeline
+        # Free resources still held by the pipeline
         with self.free_cv:
-            # Return nodes used by the pipeline
-            while not pipeline.nodes_assigned.empty():
-                pipe_node = pipeline.nodes_assigned.get()
-                self.allocated_nodes.put(pipe_node)
-
-            _log.debug("finished pipeline {}, free nodes {} -> {}".format(
-                pipeline.id, self.free_nodes, self.free_nodes +
-                                              pipeline.total_nodes))
-            self.free_nodes += pipeline.total_nodes
-
+            _log.debug("finished pipeline %s", pipeline.id,
+                       extra=log_fields(pipeline.id))
+            self._release_pipeline(pipeline, pipeline.release_held_nodes())
             self.free_cv.notify()
 
-        # Remove pipeline from list of running pipelines
+        # Remove pipeline from list of running pipelines, and get the sizes
+        # of all output adios files in the background
         with self.pipelines_lock:
             self._running_pipelines.remove(pipeline)
+            self._accounting_pipelines.add(pipeline)
+            state = pipeline.get_state()
             if self._status is not None:
-                self._status.set_state(pipeline.get_state())
+                state.output_accounting = status.OUTPUT_PENDING
+                self._status.set_state(state)
+            self.pipelines_lock.notify_all()
+        self._count_finished(pipeline, state)
+        self._accounting_pool.submit(self._account_output, pipeline)
+
+    def _count_finished(self, pipeline, state):
+        self._m_finished.inc(state=state.state, reason=state.reason or '')
+        for run in pipeline.runs:
+            try:
+                if run.exception or not run.killed and not run.timed_out:
+                    continue
+            except ValueError:
+                # not done, e.g. never started
+                continue
+            if run.timed_out:
+                self._m_killed.inc(reason='timeout')
+            elif run.killed:
+                if state.state == status.KILLED:
+                    self._m_killed.inc(reason='kill_all')
+                else:
+                    self._m_killed.inc(reason='partial_failure')
+
+    def _account_output(self, pipeline):
+        """Executed in the output accounting pool."""
+        try:
+            self._get_adios_metadata(pipeline)
+        except Exception:
+            _log.exception("failed to get output file sizes for pipeline %s",
+                           pipeline.id)
+        with self.pipelines_lock:
+            self._accounting_pipelines.discard(pipeline)
+            state = pipeline.get_state()
+            if self._status is not None:
+                self._status.set_state(state)
+            self.pipelines_lock.notify_all()
+        self._execute_done_callbacks(pipeline, state)
 
     def pipeline_fatal(self, pipeline):
-        _log.error("fatal error in pipeline '%s'" % pipeline.id)
+        _log.error("fatal error in pipeline '%s'", pipeline.id,
+                   extra=log_fields(pipeline.id))
         self.kill_all()
 
     def run_pipelines(self):
         """Main loop of consumer thread. Does not return until all child
-        threads are complete."""
+        threads are complete and the final status has been saved."""
+        with self.free_cv:
+            self._nodes_free_since = self._clock()
+        if self._metrics_publisher is not None:
+            self._metrics_publisher.start()
+        try:
+            self._run_pipelines()
+        finally:
+            if self._status is not None:
+                self._status.close()
+            if self._metrics_publisher is not None:
+                self._metrics_publisher.close()
+            trace.stop_trace()
+            close_metadata_stores()
+
+    def _run_pipelines(self):
         while True:
             # wait until a job is available or end has been signaled
             nodes_assigned = []
@@ -211,29 +520,28 @@ class PipelineRunner(object):
 
             # wait until nodes are available or quit has been signaled
             with self.free_cv:
-                pipeline = self.job_list.pop_job(self.free_nodes)
+                pipeline = self._pop_pipeline()
                 while pipeline is None:
                     if not self._process_pipelines:
                         break
+                    if len(self.job_list) == 0:
+                        # the rest don't fit before the deadline
+                        break
                     self.free_cv.wait()
-                    pipeline = self.job_list.pop_job(self.free_nodes)
-
-                if self._process_pipelines:
-                    _log.debug("starting pipeline %s, free nodes %d -> %d",
-                               pipeline.id, self.free_nodes,
-                               self.free_nodes - pipeline.get_nodes_used())
-                    self.free_nodes -= pipeline.get_nodes_used()
+                    pipeline = self._pop_pipeline()
 
-                    # Get a list of node names from the allocated nodes and
-                    # assign it to the pipeline
-                    for i in range(pipeline.total_nodes):
-                        nodes_assigned.append(self.allocated_nodes.get())
-                    _log.debug("pipeline {0} allocated nodes {1}".format(
-                        pipeline.id, nodes_assigned))
+                if self._process_pipelines and pipeline is not None:
+                    nodes_assigned = self._assign_nodes(pipeline)
 
             if not self._process_pipelines:
                 self._join_running_pipelines()
                 return
+            if pipeline is None:
+                continue
+
+            pipeline = self._load_pipeline(pipeline, nodes_assigned)
+            if pipeline is None:
+                continue
 
             with self.pipelines_lock:
                 pipeline.start(self, nodes_assigned, self.runner)
@@ -243,18 +551,184 @@ class PipelineRunner(object):
 
         self._join_running_pipelines()
 
+    def _assign_nodes(self, pipeline):
+        """Allocate nodes for a pipeline popped from the job list and
+        return the list of node names. Must be called with free_cv
+        acquired."""
+        self._add_running_estimate(pipeline)
+        self._queued_walltimes.pop(pipeline.id, None)
+        nodes_assigned = self.node_allocator.allocate(
+                                    pipeline.total_nodes,
+                                    pipeline.get_resources(), pipeline.id)
+        if self._fair_share is not None:
+            self._fair_share.acquire(pipeline.group, len(nodes_assigned))
+        _log.debug("starting pipeline %s, free nodes %d -> %d",
+                   pipeline.id, self.free_nodes,
+                   self.node_allocator.free_count,
+                   extra=log_fields(pipeline.id, node_ids=nodes_assigned))
+        self.free_nodes = self.node_allocator.free_count
+        self._record_launch()
+        now = self._clock()
+        self._assigned_times[pipeline.id] = now
+        trace.pipeline_span('queued', self._queued_times.pop(pipeline.id, None),
+                            now, pipeline.id, nodes=list(nodes_assigned))
+        if _log.isEnabledFor(logging.DEBUG):
+            # computing the fragmentation walks the free nodes
+            _log.debug("pipeline %s allocated nodes %s, fragmentation %.2f",
+                       pipeline.id, nodes_assigned,
+                       self.node_allocator.fragmentation(),
+                       extra=log_fields(pipeline.id, node_ids=nodes_assigned))
+        return nodes_assigned
+
+    def _release_pipeline(self, pipeline, nodes):
+        """Return the last nodes of a pipeline that is done or could not be
+        started. Must be called with free_cv acquired."""
+        self._return_nodes(pipeline, nodes)
+        self._running_estimates.pop(pipeline.id, None)
+        self._assigned_times.pop(pipeline.id, None)
+
+    def _record_launch(self):
+        """Update the launch metrics when nodes are assigned to a pipeline.
+        Must be called with free_cv acquired."""
+        now = self._clock()
+        self._m_started.inc()
+        self._launch_times.append(now)
+        self._trim_launch_times(now)
+        if self._nodes_free_since is not None:
+            self._m_idle.observe(now - self._nodes_free_since)
+        if self.node_allocator.usable_count() > 0:
+            self._nodes_free_since = now
+        else:
+            self._nodes_free_since = None
+
+    def _load_pipeline(self, job, nodes_assigned):
+        """Create the Pipeline for a job popped from the job list, which may
+        be a PipelineDescriptor. If it can't be created, the nodes are
+        returned and None is returned."""
+        if not isinstance(job, PipelineDescriptor):
+            return job
+        try:
+            pipeline = job.load()
+        except Exception:
+            _log.exception("failed to load pipeline %s", job.id)
+            pipeline = None
+        if pipeline is None:
+            _log.error("pipeline %s is not valid, skipping", job.id,
+                       extra=log_fields(job.id))
+            with self.free_cv:
+                self._release_pipeline(job, nodes_assigned)
+                self.free_cv.notify()
+            self._execute_done_callbacks(job, job.get_state())
+        return pipeline
+
+    def _pop_pipeline(self):
+        """Get the next pipeline to run according to the scheduling policy,
+        or None if no pipeline can be started now. Must be called with
+        free_cv acquired."""
+        self._drop_late_pipelines()
+        if len(self.job_list) == 0:
+            return None
+        if self.scheduling_policy == 'backfill':
+            return self.job_list.pop_job(self.free_nodes,
+                                         self._running_estimates.values(),
+                                         self._fits_deadline)
+        return self.job_list.pop_job(self.node_allocator.usable_count(),
+                                     self._resources_available)
+
+    def _resources_available(self, pipeline):
+        return (self.node_allocator.can_allocate(pipeline.get_resources())
+                and self._fits_deadline(pipeline))
+
+    def _fits_deadline(self, pipeline):
+        """True if the pipeline is expected to be done before the deadline
+        minus the margin, or if the deadline or walltime is not known. Must
+        be called with free_cv acquired."""
+        if self.deadline is None:
+            return True
+        walltime = self._queued_walltimes.get(pipeline.id)
+        if walltime is None:
+            return True
+        return (self._clock() + walltime
+                <= self.deadline - self.walltime_margin)
+
+    def _drop_late_pipelines(self):
+        """Remove the queued pipelines that can't be done before the
+        deadline, and return them. Time only runs out, so they can't be
+        started later in this job, and are left not_started for the next
+        submission. Must be called with free_cv acquired."""
+        now = self._clock()
+        late = set()
+        while self._latest_starts and self._latest_starts[0][0] < now:
+            _, pipe_id = heapq.heappop(self._latest_starts)
+            # ignore pipelines that have been started
+            if pipe_id in self._queued_walltimes:
+                late.add(pipe_id)
+        if not late:
+            return []
+        dropped = self.job_list.remove_if(lambda p: p.id in late)
+        if dropped:
+            _log.warning("%d pipelines can't be done in the %d seconds left "
+                         "in the job, leaving them for the next submission",
+                         len(dropped), max(0, self.deadline - now))
+            self._m_deferred.inc(len(dropped))
+        for pipeline in dropped:
+            _log.info("pipeline %s deferred, estimated walltime %s",
+                      pipeline.id, self._queued_walltimes.get(pipeline.id),
+                      extra=log_fields(pipeline.id))
+            self._queued_times.pop(pipeline.id, None)
+            self._queued_walltimes.pop(pipeline.id, None)
+            self._execute_done_callbacks(pipeline, pipeline.get_state())
+        return dropped
+
+    def _add_running_estimate(self, pipeline):
+        """Record when the pipeline is expected to release its nodes. Must
+        be called with free_cv acquired."""
+        if self.scheduling_policy != 'backfill':
+            return
+        walltime = self._queued_walltimes.get(pipeline.id)
+        end_time = None
+        if walltime is not None:
+            end_time = self._clock() + walltime
+        self._running_estimates[pipeline.id] = (end_time,
+                                                pipeline.get_nodes_used())
+
     def _join_running_pipelines(self):
-        """Wait for any pipelines that are still running to complete. Use
-        a copy since the monitor threads may be removing pipelines as
-        they complete (and joining an already complete pipeline is
-        harmless).
+        """Wait for any pipelines that are still running to complete,
+        including their post process scripts and output accounting. Use a
+        copy since pipelines are removed as they complete (and joining an
+        already complete pipeline is harmless). If kill_all is called, stop
+        waiting when the kill timeout is reached and save the pipelines that
+        are still running as killed.
 
         This must be called without any locks held, since the Pipeline and
-        Run threads may need to acquire them in the callback functions set
-        by the consumer."""
-        still_running = list(self._running_pipelines)
+        Run callbacks may need to acquire them."""
+        with self.pipelines_lock:
+            still_running = list(self._running_pipelines)
+            while self._running_pipelines or self._accounting_pipelines:
+                timeout = self._kill_time_left()
+                if timeout == 0:
+                    break
+                self.pipelines_lock.wait(timeout)
+
         for pipeline in still_running:
-            pipeline.join_all()
+            pipeline.join_all(self._kill_time_left())
+
+        with self.pipelines_lock:
+            for pipeline in self._running_pipelines:
+                _log.error("pipeline %s did not exit before kill timeout",
+                           pipeline.id, extra=pipeline.log_fields)
+                if self._status is not None:
+                    self._status.set_state(pipeline.get_state())
+            for pipeline in self._accounting_pipelines:
+                _log.warning("output accounting for pipeline %s did not "
+                             "finish before kill timeout", pipeline.id)
+
+    def _kill_time_left(self):
+        """Seconds until the kill timeout is reached, or None if kill_all
+        has not been called."""
+        if self._kill_deadline is None:
+            return None
+        return max(0, self._kill_deadline - time.time())
 
     def _get_adios_metadata(self, pipeline):
         """
@@ -286,8 +760,11 @@ class PipelineRunner(object):
                 dest = os.path.join(pipeline.working_dir, output_name)
                 copyfile(str(profile.absolute()), dest)
 
+        if pipeline._record_metadata('record_pipeline', pipeline.local_id,
+                                     None, adios_f_d):
+            return
+
         # Write dict to file
-        out_fname = os.path.join(pipeline.working_dir,
-                                 ".codar.adios_file_sizes.out.json")
+        out_fname = os.path.join(pipeline.working_dir, OUTPUT_SIZES_NAME)
         with open(out_fname, 'w') as f:
             f.write(json.dumps(adios_f_d))
@@ -0,0 +1,102 @@
+import os
+import time
+import threading
+
+from codar.savanna import status
+from codar.savanna.consumer import PipelineRunner
+from codar.savanna.pipeline import Pipeline
+from codar.savanna.reaper import set_child_subreaper
+from codar.savanna.utils import RETURN_NAME
+
+
+# like savanna, so orphaned members of the process groups are reaped as soon
+# as they exit
+set_child_subreaper()
+
+
+def _pipeline(base_dir, pipe_id, scripts, sleep_after=None):
+    """Pipeline running a bash script per run on its own node, without a
+    runner. scripts is a list of (run name, script) pairs."""
+    working_dir = os.path.join(base_dir, pipe_id)
+    os.mkdir(working_dir)
+    runs = []
+    for name, script in scripts:
+        script_path = os.path.join(working_dir, name + '.sh')
+        with open(script_path, 'w') as f:
+            f.write(script)
+        runs.append(dict(name=name, exe='bash', args=[script_path],
+                         sched_args=None, nprocs=1,
+                         sleep_after=(sleep_after or {}).get(name)))
+    return Pipeline.from_data(dict(
+                id=pipe_id, working_dir=working_dir, apps_dir='/usr/bin',
+                machine_name='local', total_nodes=len(runs),
+                node_layout=[{name: 1} for name, _ in scripts], runs=runs))
+
+
+def _wait_for(path, timeout=5):
+    end = time.time() + timeout
+    while not os.path.exists(path):
+        assert time.time() < end, 'timed out waiting for %s' % path
+        time.sleep(0.02)
+
+
+def test_kill_all_timeout(tmpdir):
+    base_dir = str(tmpdir)
+    started = os.path.join(base_dir, 'started')
+    status_file = os.path.join(base_dir, 'status.json')
+    consumer = PipelineRunner(None, 3, 'local', 1, status_file=status_file,
+                              kill_timeout=4)
+    stubborn = _pipeline(base_dir, 'stubborn',
+                         [('sim', "trap '' TERM\ntouch %s\nsleep 60\n"
+                                  % started)])
+    sleeping = _pipeline(base_dir, 'sleeping',
+                         [('sim', 'true\n'), ('ana', 'true\n')],
+                         sleep_after={'sim': 60})
+    consumer.add_pipeline(sleeping)
+    consumer.add_pipeline(stubborn)
+    t = threading.Thread(target=consumer.run_pipelines, daemon=True)
+    t.start()
+    _wait_for(started)
+    _wait_for(os.path.join(sleeping.working_dir, RETURN_NAME + '.sim'))
+
+    start = time.time()
+    consumer.kill_all()
+    t.join(consumer.kill_timeout + 1)
+    assert not t.is_alive()
+    # the stubborn run is sent SIGKILL after half of the kill timeout
+    assert time.time() - start < consumer.kill_timeout
+    for pipeline in (stubborn, sleeping):
+        assert pipeline.get_state().state == status.KILLED
+    saved = status.load_workflow_status(status_file)
+    assert set(saved) == {'stubborn', 'sleeping'}
+    assert all(data['state'] == status.KILLED for data in saved.values())
+    # the run after the sleep_after delay is never started
+    assert not os.path.exists(sleeping.runs[1].return_path)
+
+
+def test_release_nodes_of_finished_runs(tmpdir):
+    base_dir = str(tmpdir)
+    long_done = os.path.join(base_dir, 'long-done')
+    started = os.path.join(base_dir, 'started')
+    consumer = PipelineRunner(None, 2, 'local', 1)
+    two = _pipeline(base_dir, 'two',
+                    [('short', 'true\n'),
+                     ('long', 'sleep 3\ntouch %s\n' % long_done)])
+    one = _pipeline(base_dir, 'one', [('sim', 'touch %s\n' % started)])
+    # greedy starts the biggest pipeline first, the other one waits for
+    # a free node
+    consumer.add_pipeline(one)
+    consumer.add_pipeline(two)
+    consumer.stop()
+    t = threading.Thread(target=consumer.run_pipelines, daemon=True)
+    t.start()
+    _wait_for(started)
+    # started on the node of the short run, before the long run exited
+    assert not os.path.exists(long_done)
+    assert one.nodes_assigned == two.runs[0].node_ids
+    t.join(10)
+    assert not t.is_alive()
+    assert os.path.exists(long_done)
+    assert consumer.free_nodes == 2
+    for pipeline in (one, two):
+        assert pipeline.get_state().reason == status.REASON_SUCCEEDED
@@ -0,0 +1,81 @@
+"""
+Helpers for dependencies between the runs of a pipeline, which form a
+directed acyclic graph. A run can depend on any number of other runs, and
+is started once all of them are done. Used by both Cheetah, when grouping
+codes onto nodes, and Savanna, when ordering and launching runs.
+"""
+
+from collections import deque
+
+
+class CyclicDependencyError(ValueError):
+    pass
+
+
+def topological_sort(nodes, get_parents, get_name=str):
+    """Return a list of the nodes in an order where every node comes after
+    all of its parents. The order is deterministic, nodes without parents
+    come first in input order. get_parents(node) must return the nodes
+    that node depends on, all of which must be in nodes. Raises
+    CyclicDependencyError if there is a cycle, naming the nodes in or after
+    the cycle with get_name. O(V+E)."""
+    nodes = list(nodes)
+    pending = {}
+    children = {node: [] for node in nodes}
+    for node in nodes:
+        parents = set(get_parents(node))
+        pending[node] = len(parents)
+        for parent in parents:
+            if parent not in children:
+                raise KeyError('unknown dependency %r of %r' % (parent, node))
+            children[parent].append(node)
+
+    # Kahn's algorithm. Children lists are in input order, since they are
+    # built by iterating over nodes.
+    ready = deque(node for node in nodes if pending[node] == 0)
+    ordered = []
+    while ready:
+        node = ready.popleft()
+        ordered.append(node)
+        for child in children[node]:
+            pending[child] -= 1
+            if pending[child] == 0:
+                ready.append(child)
+
+    if len(ordered) < len(nodes):
+        cycle = [node for node in nodes if pending[node] > 0]
+        raise CyclicDependencyError('cyclic dependency between %s'
+                                    % ', '.join(get_name(n) for n in cycle))
+    return ordered
+
+
+def group_with_parents(groups, get_parents, get_name=str):
+    """Given a list of groups of nodes (e.g. the codes that share a compute
+    node), move each node that depends on another node into the group of its
+    first parent, so runs that are executed one after another reuse the same
+    nodes. Chains end up in the group of their root. Returns a dict of
+    node -> group index. Raises CyclicDependencyError if there is a
+    cycle."""
+    group_of = {}
+    for i, group in enumerate(groups):
+        for node in group:
+            group_of[node] = i
+    for node in topological_sort(group_of.keys(), get_parents, get_name):
+        parents = get_parents(node)
+        if parents:
+            group_of[node] = group_of[parents[0]]
+    return group_of
+
+
+def ancestors(nodes, get_parents, get_name=str):
+    """Return a dict of node -> set of the nodes it depends on, directly or
+    through other nodes. Raises CyclicDependencyError if there is a
+    cycle."""
+    result = {}
+    for node in topological_sort(nodes, get_parents, get_name):
+        node_ancestors = set()
+        for parent in get_parents(node):
+            node_ancestors.add(parent)
+            node_ancestors |= result[parent]
+        result[node] = node_ancestors
+    return result
@@ -0,0 +1,40 @@
+from codar.savanna.dag import topological_sort, group_with_parents, \
+    ancestors, CyclicDependencyError
+
+
+def _parents_fn(deps):
+    return lambda node: deps.get(node, [])
+
+
+def test_topological_sort_fan_in():
+    deps = {'reduce': ['ana1', 'ana2', 'ana3'], 'ana1': ['sim'],
+            'ana2': ['sim'], 'ana3': ['sim']}
+    nodes = ['reduce', 'ana3', 'ana2', 'ana1', 'sim']
+    ordered = topological_sort(nodes, _parents_fn(deps))
+    assert ordered[0] == 'sim'
+    assert ordered[-1] == 'reduce'
+    assert ordered[1:4] == ['ana3', 'ana2', 'ana1']
+
+
+def test_topological_sort_cycle():
+    deps = {'a': ['c'], 'b': ['a'], 'c': ['b'], 'd': []}
+    try:
+        topological_sort(['a', 'b', 'c', 'd'], _parents_fn(deps))
+    except CyclicDependencyError as e:
+        assert 'a, b, c' in str(e)
+    else:
+        assert False, 'expected CyclicDependencyError'
+
+
+def test_group_with_parents():
+    deps = {'ana': ['sim'], 'viz': ['ana', 'sim2']}
+    groups = [['viz'], ['sim2'], ['ana'], ['sim']]
+    group_of = group_with_parents(groups, _parents_fn(deps))
+    assert group_of == {'sim': 3, 'ana': 3, 'viz': 3, 'sim2': 1}
+
+
+def test_ancestors():
+    deps = {'ana': ['sim'], 'viz': ['ana', 'sim2'], 'sim2': []}
+    result = ancestors(['viz', 'ana', 'sim', 'sim2'], _parents_fn(deps))
+    assert result == {'sim': set(), 'sim2': set(), 'ana': {'sim'},
+                      'viz': {'ana', 'sim', 'sim2'}}
@@ -0,0 +1,165 @@
+"""
+Content addressed snapshots of the environment runs are launched with.
+
+The environment is almost always the same for every run in a sweep group,
+so each distinct environment is written once to the group directory, in
+ENVIRONMENT_DIR_NAME/<sha256>.json, and each launched run appends a line to
+ENVIRONMENT_INDEX_NAME in the same directory with the snapshot hash and the
+variables that differ from it:
+
+    {"id": "run-0.iteration-0", "run": "sim", "snapshot": "<sha256>",
+     "set": {"PATH": "..."}, "unset": []}
+
+The index only grows; if a run is launched again, e.g. when a group is
+resubmitted, the last line for the run wins. load_run_environment rebuilds
+the full environment from the index and snapshot, and also reads the per
+run RUN_ENVIRON_NAME files written by older versions of savanna.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import logging
+
+
+ENVIRONMENT_DIR_NAME = '.codar.savanna.environments'
+ENVIRONMENT_INDEX_NAME = 'index.jsonl'
+
+# Full environment of a run, written by older versions of savanna to the run
+# working directory
+RUN_ENVIRON_NAME = '.codar.savanna.{}.environment.json'
+
+
+_log = logging.getLogger('codar.savanna.environment')
+
+
+class EnvironmentStore(object):
+    """Writes environment snapshots and the run index for a sweep group.
+    Thread safe. Use get_environment_store to share one instance per
+    group within the process."""
+
+    def __init__(self, group_dir):
+        self.group_dir = group_dir
+        self.env_dir = os.path.join(group_dir, ENVIRONMENT_DIR_NAME)
+        self._lock = threading.Lock()
+        self._written = set()
+        self._index = None
+
+    def record(self, pipe_id, run_name, env, base_env=None):
+        """Record the environment env of a run. The snapshot is made of
+        base_env, os.environ by default, and only the differences between
+        base_env and env are saved for the run. Returns the snapshot
+        hash."""
+        if base_env is None:
+            base_env = os.environ
+        base_env = dict(base_env)
+        data = json.dumps(base_env, sort_keys=True)
+        snapshot = hashlib.sha256(data.encode('utf8')).hexdigest()
+        entry = dict(id=pipe_id, run=run_name, snapshot=snapshot,
+                     set={k: v for k, v in env.items()
+                          if base_env.get(k) != v},
+                     unset=sorted(k for k in base_env if k not in env))
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self._lock:
+            if snapshot not in self._written:
+                self._write_snapshot(snapshot, data)
+                self._written.add(snapshot)
+            if self._index is None:
+                self._index = open(os.path.join(self.env_dir,
+                                                ENVIRONMENT_INDEX_NAME), 'a')
+            self._index.write(line)
+            self._index.flush()
+        return snapshot
+
+    def _write_snapshot(self, snapshot, data):
+        os.makedirs(self.env_dir, exist_ok=True)
+        path = os.path.join(self.env_dir, snapshot + '.json')
+        if os.path.exists(path):
+            return
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        with self._lock:
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_environment_store(group_dir):
+    """Get the process wide store for the group directory, creating it if
+    needed."""
+    group_dir = os.path.normpath(group_dir)
+    with _stores_lock:
+        store = _stores.get(group_dir)
+        if store is None:
+            store = EnvironmentStore(group_dir)
+            _stores[group_dir] = store
+        return store
+
+
+def load_environment_index(group_dir):
+    """Read the environment index of a group. Returns a dict of
+    (pipeline id, run name) -> index entry, empty if the group has no
+    index. Unparseable lines, e.g. a partial line left by a crash, are
+    ignored."""
+    entries = {}
+    path = os.path.join(group_dir, ENVIRONMENT_DIR_NAME,
+                        ENVIRONMENT_INDEX_NAME)
+    try:
+        f = open(path)
+    except FileNotFoundError:
+        return entries
+    with f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                entries[(entry['id'], entry['run'])] = entry
+            except (ValueError, KeyError, TypeError):
+                continue
+    return entries
+
+
+def load_snapshot(group_dir, snapshot):
+    with open(os.path.join(group_dir, ENVIRONMENT_DIR_NAME,
+                           snapshot + '.json')) as f:
+        return json.load(f)
+
+
+def rebuild_environment(group_dir, entry):
+    """Get the full environment for an index entry."""
+    env = load_snapshot(group_dir, entry['snapshot'])
+    for k in entry.get('unset', []):
+        env.pop(k, None)
+    env.update(entry.get('set', {}))
+    return env
+
+
+def load_run_environment(group_dir, pipe_id, run_name, index=None):
+    """Get the full environment a run was launched with, or None if it was
+    not recorded. index can be passed to avoid reading the index again when
+    loading the environment of many runs, see load_environment_index."""
+    if index is None:
+        index = load_environment_index(group_dir)
+    entry = index.get((pipe_id, run_name))
+    if entry is not None:
+        try:
+            return rebuild_environment(group_dir, entry)
+        except (OSError, ValueError):
+            _log.warning('could not read environment snapshot %s in %s',
+                         entry['snapshot'], group_dir)
+            return None
+    legacy_path = os.path.join(group_dir, pipe_id,
+                               RUN_ENVIRON_NAME.format(run_name))
+    try:
+        with open(legacy_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
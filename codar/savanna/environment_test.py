@@ -0,0 +1,40 @@
+import os
+import json
+
+from codar.savanna.environment import EnvironmentStore, \
+    ENVIRONMENT_DIR_NAME, RUN_ENVIRON_NAME, load_environment_index, \
+    load_run_environment
+
+
+def test_snapshot_written_once(tmpdir):
+    group_dir = str(tmpdir)
+    store = EnvironmentStore(group_dir)
+    base = dict(PATH='/usr/bin', HOME='/home/u', OLD='1')
+    for i in range(3):
+        env = dict(base, PATH='/apps%d:/usr/bin' % i)
+        del env['OLD']
+        store.record('run-%d' % i, 'sim', env, base_env=base)
+    store.close()
+
+    files = os.listdir(os.path.join(group_dir, ENVIRONMENT_DIR_NAME))
+    assert len([f for f in files if f.endswith('.json')]) == 1
+
+    index = load_environment_index(group_dir)
+    assert len(index) == 3
+    entry = index[('run-1', 'sim')]
+    assert entry['set'] == dict(PATH='/apps1:/usr/bin')
+    assert entry['unset'] == ['OLD']
+
+    env = load_run_environment(group_dir, 'run-2', 'sim')
+    assert env == dict(PATH='/apps2:/usr/bin', HOME='/home/u')
+    assert load_run_environment(group_dir, 'run-3', 'sim') is None
+
+
+def test_legacy_environment_file(tmpdir):
+    group_dir = str(tmpdir)
+    os.mkdir(os.path.join(group_dir, 'run-0'))
+    with open(os.path.join(group_dir, 'run-0',
+                           RUN_ENVIRON_NAME.format('sim')), 'w') as f:
+        json.dump(dict(PATH='/usr/bin'), f)
+    env = load_run_environment(group_dir, 'run-0', 'sim')
+    assert env == dict(PATH='/usr/bin')
@@ -0,0 +1,136 @@
+"""
+Runtime estimates for pipelines, used by scheduling policies that need to
+know how long a pipeline will hold its nodes (e.g. backfill).
+
+Estimates come from the total walltime recorded by earlier runs of a pipeline
+with the same parameters in the same sweep group, e.g. the other iterations
+of a run repetition or a previous submission of the group. Only pipelines
+that succeeded count, since the walltime of a killed, timed out or failed
+pipeline says little about how long it needs. If there is no history, the
+per run timeouts give an upper bound.
+"""
+
+import os
+import json
+import threading
+import logging
+
+from codar.savanna import dag
+from codar.savanna.utils import TOTAL_WALLTIME_NAME, RUN_PARAMS_NAME
+from codar.savanna.metadata import load_metadata
+from codar.savanna.status import load_workflow_status, DONE, \
+    REASON_SUCCEEDED
+
+
+_log = logging.getLogger('codar.savanna.estimator')
+
+
+class WalltimeEstimator(object):
+    """Estimate pipeline walltimes from the history of the sweep group. The
+    group directory is scanned once, the first time a pipeline from that group
+    is estimated. Thread safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # group dir -> { params key: [walltime, ...] }
+        self._history = {}
+
+    def estimate(self, pipeline):
+        """Get the estimated walltime in seconds for the pipeline, or None if
+        there is no history and at least one run has no timeout."""
+        walltime = self.historical_walltime(pipeline)
+        if walltime is None:
+            walltime = timeout_bound(pipeline)
+        return walltime
+
+    def historical_walltime(self, pipeline):
+        """Get the max walltime of earlier runs with the same parameters as
+        the pipeline, or None if no such run has completed."""
+        key = _read_params_key(pipeline.working_dir)
+        if key is None:
+            return None
+        group_dir = os.path.dirname(os.path.normpath(pipeline.working_dir))
+        walltimes = self._get_group_history(group_dir).get(key)
+        if not walltimes:
+            return None
+        return max(walltimes)
+
+    def _get_group_history(self, group_dir):
+        with self._lock:
+            history = self._history.get(group_dir)
+            if history is None:
+                history = _scan_group_history(group_dir)
+                self._history[group_dir] = history
+            return history
+
+
+def timeout_bound(pipeline):
+    """Upper bound on the pipeline walltime based on the per run timeouts,
+    the sleep time between launching runs, and the dependencies between runs.
+    Returns None if any run has no timeout."""
+    total_sleep = 0
+    for run in pipeline.runs:
+        if run.timeout is None:
+            return None
+        total_sleep += run.sleep_after or 0
+
+    # longest path through the dependency graph, weighted by timeouts
+    try:
+        ordered = dag.topological_sort(pipeline.runs,
+                                       lambda run: run.depends_on_runs)
+    except (dag.CyclicDependencyError, KeyError):
+        return None
+    end = {}
+    for run in ordered:
+        end[run] = run.timeout + max((end[p] for p in run.depends_on_runs),
+                                     default=0)
+    return total_sleep + max(end.values())
+
+
+def _scan_group_history(group_dir):
+    history = {}
+    try:
+        entries = list(os.scandir(group_dir))
+    except OSError:
+        return history
+    try:
+        states = load_workflow_status(os.path.join(
+                                group_dir, 'codar.workflow.status.json'))
+    except (OSError, ValueError):
+        _log.warning("can't read the status of %s, ignoring its walltime "
+                     "history", group_dir)
+        return history
+    metadata = load_metadata(group_dir)
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        state = states.get(entry.name, {})
+        if (state.get('state') != DONE
+                or state.get('reason') != REASON_SUCCEEDED):
+            continue
+        walltime = None
+        if metadata is not None:
+            walltime = metadata.pipeline_walltime(entry.name)
+        if walltime is None:
+            walltime_path = os.path.join(entry.path, TOTAL_WALLTIME_NAME)
+            try:
+                with open(walltime_path) as f:
+                    walltime = float(f.readline())
+            except (OSError, ValueError):
+                continue
+        key = _read_params_key(entry.path)
+        if key is not None:
+            history.setdefault(key, []).append(walltime)
+    _log.debug("found walltime history for %d parameter sets in %s",
+               len(history), group_dir)
+    return history
+
+
+def _read_params_key(run_dir):
+    """Canonical string of the run parameters, used to match runs with the
+    same parameters. Returns None if the parameters file can't be read."""
+    try:
+        with open(os.path.join(run_dir, RUN_PARAMS_NAME)) as f:
+            return json.dumps(json.load(f), sort_keys=True)
+    except (OSError, ValueError):
+        return None
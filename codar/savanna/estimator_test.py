@@ -0,0 +1,44 @@
+import os
+import json
+
+from codar.savanna.estimator import WalltimeEstimator
+from codar.savanna.pipeline import Pipeline
+from codar.savanna.utils import TOTAL_WALLTIME_NAME, RUN_PARAMS_NAME
+
+
+def _pipeline(group_dir, pipe_id, x, walltime=None):
+    working_dir = os.path.join(group_dir, pipe_id)
+    os.mkdir(working_dir)
+    with open(os.path.join(working_dir, RUN_PARAMS_NAME), 'w') as f:
+        json.dump(dict(sim=dict(x=x)), f)
+    if walltime is not None:
+        with open(os.path.join(working_dir, TOTAL_WALLTIME_NAME), 'w') as f:
+            f.write('%s\n' % walltime)
+    return Pipeline.from_data(dict(
+                id=pipe_id, working_dir=working_dir, apps_dir='/usr/bin',
+                machine_name='local', total_nodes=1,
+                runs=[dict(name='sim', exe='true', args=[], sched_args=None,
+                           nprocs=1, timeout=100)]))
+
+
+def test_history_of_succeeded_pipelines(tmpdir):
+    group_dir = str(tmpdir)
+    _pipeline(group_dir, 'run-0.iteration-0', 0, 10.0)
+    _pipeline(group_dir, 'run-0.iteration-1', 0, 3.0)
+    _pipeline(group_dir, 'run-1.iteration-0', 1, 2.0)
+    with open(os.path.join(group_dir, 'codar.workflow.status.json'),
+              'w') as f:
+        json.dump({'run-0.iteration-0': dict(state='done',
+                                             reason='succeeded'),
+                   'run-0.iteration-1': dict(state='killed',
+                                             reason='exception'),
+                   'run-1.iteration-0': dict(state='done',
+                                             reason='timeout')}, f)
+
+    estimator = WalltimeEstimator()
+    pipeline = _pipeline(group_dir, 'run-0.iteration-2', 0)
+    assert estimator.estimate(pipeline) == 10.0
+    # the walltime of a pipeline that timed out is not used
+    pipeline = _pipeline(group_dir, 'run-1.iteration-1', 1)
+    assert estimator.historical_walltime(pipeline) is None
+    assert estimator.estimate(pipeline) == 100
@@ -0,0 +1,193 @@
+"""
+Asynchronous logging for savanna.
+
+Savanna logs from run threads, run callbacks and while holding the consumer
+locks, so a log file on a slow shared filesystem can delay scheduling.
+AsyncLogHandler puts records on a bounded queue, and a writer thread passes
+them to the handlers that do the actual writing. When the queue is full,
+records below WARNING are dropped by default rather than making the caller
+wait, and the number of dropped records is logged once there is room again.
+
+Records can carry structured fields, see log_fields, which are written by
+JSONLinesFormatter along with the message, one JSON document per line.
+"""
+
+import copy
+import json
+import logging
+import queue
+import threading
+
+
+# Max records waiting to be written
+LOG_QUEUE_SIZE = 10000
+
+# What to do with a record when the queue is full
+OVERFLOW_DROP = 'drop'
+OVERFLOW_BLOCK = 'block'
+
+# Attributes set on log records by log_fields
+FIELDS = ('pipeline_id', 'run_name', 'node_ids')
+
+TEXT_FORMAT = '%(asctime)s:%(levelname)s:%(message)s'
+
+
+def log_fields(pipeline_id=None, run_name=None, node_ids=None):
+    """Get the extra argument of a logging call for the structured fields
+    of a record. Fields that are None are not written."""
+    if node_ids is not None:
+        node_ids = [str(node) for node in node_ids]
+    return dict(pipeline_id=pipeline_id, run_name=run_name,
+                node_ids=node_ids)
+
+
+class AsyncLogHandler(logging.Handler):
+    """Handler that passes records to handlers in a writer thread. The
+    thread is started by the constructor, and close stops it after writing
+    the records still queued.
+
+    With the drop overflow policy, records below block_level are dropped
+    when maxsize records are waiting, and records at block_level and above
+    wait for room in the queue. With the block policy all records wait."""
+
+    def __init__(self, handlers, maxsize=LOG_QUEUE_SIZE,
+                 overflow=OVERFLOW_DROP, block_level=logging.WARNING):
+        if overflow not in (OVERFLOW_DROP, OVERFLOW_BLOCK):
+            raise ValueError('unknown overflow policy: %s' % overflow)
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.overflow = overflow
+        self.block_level = block_level
+        self._queue = queue.Queue(maxsize)
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_records,
+                                        name='Thread-log-0', daemon=True)
+        self._thread.start()
+
+    @property
+    def dropped(self):
+        """Number of records dropped so far."""
+        with self._dropped_lock:
+            return self._dropped
+
+    def emit(self, record):
+        try:
+            record = self._prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if self._closed:
+            self._handle(record)
+        elif (self.overflow == OVERFLOW_BLOCK
+              or record.levelno >= self.block_level):
+            self._queue.put(record)
+        else:
+            try:
+                self._queue.put_nowait(record)
+            except queue.Full:
+                with self._dropped_lock:
+                    self._dropped += 1
+
+    def close(self):
+        """Write the queued records, stop the writer thread and close the
+        handlers. Blocks until done."""
+        with self.lock:
+            closed = self._closed
+            self._closed = True
+        if not closed:
+            self._queue.put(None)
+            self._thread.join()
+            self._report_dropped(self._take_dropped())
+            for handler in self.handlers:
+                handler.close()
+        logging.Handler.close(self)
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    def _prepare(self, record):
+        """Copy of record that can be formatted in the writer thread, with
+        the arguments merged into the message, so objects changed after
+        the logging call are logged as they were."""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                                                            record.exc_info)
+            record.exc_info = None
+        return record
+
+    def _write_records(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            try:
+                self._report_dropped(self._take_dropped())
+                self._handle(record)
+            except Exception:
+                # keep writing, the caller would block once the queue is
+                # full
+                self.handleError(record)
+
+    def _take_dropped(self):
+        with self._dropped_lock:
+            dropped = self._dropped
+            self._dropped = 0
+        return dropped
+
+    def _report_dropped(self, dropped):
+        if not dropped:
+            return
+        record = logging.LogRecord(
+                    'codar.savanna.logs', logging.WARNING, __file__, 0,
+                    '%d log records dropped, log queue full', (dropped,),
+                    None)
+        self._handle(record)
+
+    def _handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """Format records as JSON documents with the time in seconds since the
+    epoch, level, logger name, thread name, message and the structured
+    fields that are set, see log_fields."""
+
+    def format(self, record):
+        data = dict(time=round(record.created, 6), level=record.levelname,
+                    logger=record.name, thread=record.threadName,
+                    message=record.getMessage())
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        if record.stack_info:
+            data['stack'] = record.stack_info
+        return json.dumps(data)
+
+
+def make_log_handler(file_path, log_format='text', queue_size=LOG_QUEUE_SIZE,
+                     overflow=OVERFLOW_DROP):
+    """Create the handler for the savanna log file. log_format is text or
+    json. If queue_size is 0, records are written by the thread making the
+    logging call."""
+    handler = logging.FileHandler(file_path)
+    if log_format == 'json':
+        handler.setFormatter(JSONLinesFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    if queue_size <= 0:
+        return handler
+    return AsyncLogHandler([handler], queue_size, overflow)
@@ -0,0 +1,69 @@
+import json
+import logging
+import threading
+
+from codar.savanna.logs import AsyncLogHandler, JSONLinesFormatter, \
+    log_fields
+
+
+class _SlowHandler(logging.Handler):
+    """Handler that waits for proceed to be set before writing, so records
+    queue up behind the first one."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+
+    def emit(self, record):
+        self.started.set()
+        self.proceed.wait()
+        self.records.append(record)
+
+
+def test_async_log_drop():
+    slow = _SlowHandler()
+    handler = AsyncLogHandler([slow], maxsize=2)
+    logger = logging.getLogger('codar.savanna.logs_test')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    try:
+        fields = ['sim']
+        logger.info('first %s', fields)
+        slow.started.wait(5)
+        # the writer is busy, so the queue is full after two records
+        fields.append('ana')
+        logger.info('second')
+        logger.debug('third')
+        logger.info('dropped')
+        assert handler.dropped == 1
+    finally:
+        slow.proceed.set()
+        logger.removeHandler(handler)
+        handler.close()
+    messages = [r.getMessage() for r in slow.records]
+    # the message is formatted when logged, not when written
+    assert messages == ["first ['sim']",
+                        '1 log records dropped, log queue full',
+                        'second', 'third']
+    assert slow.records[1].levelno == logging.WARNING
+
+
+def test_json_lines_format():
+    logger = logging.getLogger('codar.savanna.logs_test')
+    record = logger.makeRecord(logger.name, logging.INFO, __file__, 1,
+                               '%s start', ('run-1:sim',), None,
+                               extra=log_fields('run-1', 'sim', [3, 4]))
+    data = json.loads(JSONLinesFormatter().format(record))
+    assert data['level'] == 'INFO'
+    assert data['message'] == 'run-1:sim start'
+    assert data['pipeline_id'] == 'run-1'
+    assert data['run_name'] == 'sim'
+    assert data['node_ids'] == ['3', '4']
+
+    record = logger.makeRecord(logger.name, logging.INFO, __file__, 1,
+                               'no fields', (), None)
+    data = json.loads(JSONLinesFormatter().format(record))
+    assert 'pipeline_id' not in data and 'node_ids' not in data
@@ -5,15 +5,27 @@ import argparse
 import threading
 import logging
 import signal
+import time
+import json
 import os
 
-from codar.savanna.producer import JSONFilePipelineReader
-from codar.savanna.consumer import PipelineRunner
+from codar.savanna.producer import JSONFilePipelineReader, \
+    SuccessiveHalvingProducer, get_group_names, interleave, \
+    load_producer_class
+from codar.savanna.consumer import PipelineRunner, KILL_TIMEOUT, \
+    WALLTIME_MARGIN
+from codar.savanna.reaper import set_child_subreaper
+from codar.savanna.metrics import METRICS_NAME
+from codar.savanna.metadata import METADATA_DB_NAME
+from codar.savanna.logs import make_log_handler, LOG_QUEUE_SIZE, \
+    OVERFLOW_DROP, OVERFLOW_BLOCK
 from codar.savanna.runners import mpiexec, aprun, srun, jsrun, mpirunc, mpirung
 
 
 consumer = None
 
+STATUS_NAME = 'codar.workflow.status.json'
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='HPC Worflow script')
@@ -23,17 +35,137 @@ def parse_args():
                                              'jsrun', 'mpirunc', 'mpirung',
                                              'none'],
                         required=True)
-    parser.add_argument('--producer', choices=['file'], default='file')
-    parser.add_argument('--producer-input-file')
+    parser.add_argument('--producer', choices=['file', 'successive-halving'],
+                        default='file',
+                        help='file runs all the pipelines in the producer '
+                             'input file. successive-halving runs a random '
+                             'sample of them and picks the ones to run next '
+                             'from their results, see --producer-options')
+    parser.add_argument('--producer-plugin',
+                        help='use a custom adaptive producer instead, given '
+                             'as module:Class, where module is a module name '
+                             'or a python file and Class a subclass of '
+                             'codar.savanna.producer.AdaptiveProducer')
+    parser.add_argument('--producer-options', type=json.loads, default={},
+                        help='JSON object with options for adaptive '
+                             'producers, e.g. \'{"metric": "error", '
+                             '"budget": "sim.steps"}\'')
+    parser.add_argument('--producer-input-file', nargs='+',
+                        help='fobs file of the sweep group to run. If '
+                             'several are given, the groups share the nodes '
+                             'of the job, and the status of each group is '
+                             'saved in %s in its directory' % STATUS_NAME)
+    parser.add_argument('--group-weights', type=float, nargs='+',
+                        help='share of the nodes given to each group when '
+                             'several have pipelines waiting, in the order '
+                             'of the producer input files. Default is an '
+                             'equal share')
     parser.add_argument('--log-file')
     parser.add_argument('--log-level',
                         choices=['DEBUG','INFO','WARNING','ERROR','CRITICAL'],
                         default='INFO')
+    parser.add_argument('--log-format', choices=['text', 'json'],
+                        default='text',
+                        help='json writes one JSON document per line, with '
+                             'the pipeline id, run name and node ids of the '
+                             'records that have them')
+    parser.add_argument('--log-queue-size', type=int, default=LOG_QUEUE_SIZE,
+                        help='max log records waiting to be written by the '
+                             'log writer thread. 0 writes them in the '
+                             'thread making the logging call')
+    parser.add_argument('--log-overflow',
+                        choices=[OVERFLOW_DROP, OVERFLOW_BLOCK],
+                        default=OVERFLOW_DROP,
+                        help='when the log queue is full, drop records '
+                             'below WARNING, or make the logging thread '
+                             'wait')
     parser.add_argument('--status-file')
     parser.add_argument('--machine-name')
+    parser.add_argument('--scheduling-policy', choices=['greedy', 'backfill'],
+                        default='greedy',
+                        help='greedy starts the biggest pipeline that fits '
+                             'the free nodes. backfill reserves nodes for '
+                             'the biggest waiting pipeline, and only starts '
+                             'smaller pipelines first if their estimated '
+                             'walltime does not delay it')
+    parser.add_argument('--kill-timeout', type=float, default=KILL_TIMEOUT,
+                        help='max seconds to wait for runs to exit when '
+                             'killed by a signal, before saving the final '
+                             'status and exiting. Runs still alive after '
+                             'half of this time are sent SIGKILL')
+    parser.add_argument('--node-topology-file',
+                        help='file listing the nodes connected to each '
+                             'switch or network group, one group per line, '
+                             'e.g. "1-16". Pipelines are placed within a '
+                             'group when possible')
+    parser.add_argument('--gpus-per-node', type=int,
+                        help='GPUs on each node, by default taken from the '
+                             'machine definition if known')
+    parser.add_argument('--memory-per-node', type=int,
+                        help='memory in MB on each node. If set, pipelines '
+                             'are only placed on nodes with enough memory '
+                             'for the memory_per_node of their codes')
+    parser.add_argument('--share-nodes', action='store_true',
+                        help='allow pipelines that do not use all the cpus, '
+                             'GPUs and memory of their nodes to share nodes '
+                             'with other pipelines. The runner must allow '
+                             'several launches on the same node')
+    parser.add_argument('--metrics-file',
+                        help='Prometheus text format file with savanna '
+                             'metrics, updated every few seconds. Default is '
+                             '%s in the producer input file directory'
+                             % METRICS_NAME)
+    parser.add_argument('--metrics-port', type=int,
+                        help='also serve the metrics over HTTP on this local '
+                             'port, at /metrics')
+    parser.add_argument('--usage-sample-interval', type=float,
+                        help='sample the cpu, memory, io and thread usage of '
+                             'the processes of each run every this many '
+                             'seconds, saved in codar.savanna.usage.<code>'
+                             '.csv in the run directory. Off by default')
+    parser.add_argument('--output-cap', type=float,
+                        help='capture the stdout and stderr of each run in '
+                             'gzip files, keeping at most this many MB of '
+                             'each, half from the start and half from the '
+                             'end. Off by default')
+    parser.add_argument('--metadata-store', action='store_true',
+                        help='save the return codes, walltimes and output '
+                             'sizes of the runs in %s in the group '
+                             'directory, instead of small files in each run '
+                             'directory. cheetah export-metadata writes the '
+                             'files from it' % METADATA_DB_NAME)
+    parser.add_argument('--walltime', type=float,
+                        help='seconds the job can run for, used to only '
+                             'start pipelines that will be done in time. '
+                             'Default is CODAR_CHEETAH_GROUP_WALLTIME, or '
+                             'the end time given by the scheduler')
+    parser.add_argument('--walltime-margin', type=float,
+                        default=WALLTIME_MARGIN,
+                        help='seconds before the end of the job that '
+                             'pipelines must be done by')
+    parser.add_argument('--trace-file',
+                        help='write a timeline of the pipelines, runs and '
+                             'node assignments to this file in the Chrome '
+                             'trace event format, which can be opened in '
+                             'Perfetto or chrome://tracing. Off by default')
 
     args = parser.parse_args()
+    inputs = args.producer_input_file or []
+    if args.group_weights is not None:
+        if len(args.group_weights) != len(inputs):
+            parser.error('expected one group weight per producer input file')
+        if any(w <= 0 for w in args.group_weights):
+            parser.error('group weights must be positive')
+    if len(inputs) > 1 and args.status_file is not None:
+        parser.error('--status-file can only be used with a single producer '
+                     'input file')
+    if len(inputs) > 1 and (args.producer != 'file'
+                            or args.producer_plugin is not None):
+        parser.error('adaptive producers only support a single producer '
+                     'input file')
 
+    if args.output_cap is not None and args.output_cap <= 0:
+        parser.error('--output-cap must be positive')
     return args
 
 
@@ -62,9 +194,10 @@ def main():
 
     logger = logging.getLogger('codar.savanna')
     if args.log_file:
-        handler = logging.FileHandler(args.log_file)
-        formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(message)s')
-        handler.setFormatter(formatter)
+        # closed by logging.shutdown at exit, after the consumer thread is
+        # done
+        handler = make_log_handler(args.log_file, args.log_format,
+                                   args.log_queue_size, args.log_overflow)
         logger.addHandler(handler)
         logger.setLevel(args.log_level)
     else:
@@ -72,32 +205,111 @@ def main():
 
     logger.info('starting savanna job %s', get_job_id())
 
+    # adopt processes left behind by run launchers, so the end of each run's
+    # process group can be detected without waiting for init to reap them
+    if not set_child_subreaper():
+        logger.warning('failed to set child subreaper')
+
+    input_files = args.producer_input_file or [None]
+    groups = None
+    group_status_files = group_weights = None
+    if len(input_files) > 1:
+        groups = get_group_names(input_files)
+        group_status_files = dict(
+            (group, os.path.join(os.path.dirname(os.path.abspath(path)),
+                                 STATUS_NAME))
+            for group, path in zip(groups, input_files))
+        group_weights = dict(zip(groups, args.group_weights
+                                 or [1] * len(groups)))
+        for group, path in zip(groups, input_files):
+            logger.info('group %s: %s, weight %g', group, path,
+                        group_weights[group])
+
+    metrics_file = args.metrics_file
+    if metrics_file is None and groups is not None:
+        metrics_file = os.path.abspath(METRICS_NAME)
+    elif metrics_file is None and args.producer_input_file:
+        metrics_file = os.path.join(
+            os.path.dirname(os.path.abspath(input_files[0])),
+            METRICS_NAME)
+
+    output_cap = None
+    if args.output_cap is not None:
+        output_cap = int(args.output_cap * 1024 * 1024)
+
+    deadline = get_job_deadline(args.walltime)
+    if deadline is not None:
+        logger.info('job deadline in %d seconds',
+                    deadline - time.time())
+
+    adaptive_producer = None
+    pipelines = []
+    if args.producer_plugin is not None:
+        producer_class = load_producer_class(args.producer_plugin)
+        adaptive_producer = producer_class(input_files[0],
+                                           args.producer_options)
+    elif args.producer == 'successive-halving':
+        adaptive_producer = SuccessiveHalvingProducer(input_files[0],
+                                                      args.producer_options)
+    elif groups is None:
+        producer = JSONFilePipelineReader(input_files[0])
+        pipelines = producer.read_pipelines()
+    else:
+        # interleave the groups, so they all have pipelines queued from
+        # the start
+        producers = [JSONFilePipelineReader(path, group)
+                     for group, path in zip(groups, input_files)]
+        pipelines = interleave([p.read_pipelines() for p in producers])
+
     consumer = PipelineRunner(runner=runner,
                               max_nodes=args.max_nodes,
                               machine_name=args.machine_name,
                               processes_per_node=args.processes_per_node,
-                              status_file=args.status_file)
-
-    producer = JSONFilePipelineReader(args.producer_input_file)
+                              status_file=args.status_file,
+                              scheduling_policy=args.scheduling_policy,
+                              kill_timeout=args.kill_timeout,
+                              node_topology_file=args.node_topology_file,
+                              gpus_per_node=args.gpus_per_node,
+                              memory_per_node=args.memory_per_node,
+                              share_nodes=args.share_nodes,
+                              metrics_file=metrics_file,
+                              metrics_port=args.metrics_port,
+                              usage_sample_interval=args.usage_sample_interval,
+                              trace_file=args.trace_file,
+                              deadline=deadline,
+                              walltime_margin=args.walltime_margin,
+                              group_status_files=group_status_files,
+                              group_weights=group_weights,
+                              output_cap=output_cap,
+                              metadata_store=args.metadata_store)
 
     t_consumer = threading.Thread(target=consumer.run_pipelines)
     t_consumer.start()
 
-    # producer runs in this main thread
-    for pipeline in producer.read_pipelines():
-        consumer.add_pipeline(pipeline)
-
-    # signal that there are no more pipelines and thread should exit
-    # when reached
-    consumer.stop()
-
-    # set up signal handlers for graceful exit
+    # set up signal handlers for graceful exit. Adaptive producers run
+    # until the last pipeline is done, so this must be done first.
     def handle_signal_kill_consumer(signum, frame):
         consumer.kill_all()
 
     signal.signal(signal.SIGTERM, handle_signal_kill_consumer)
     signal.signal(signal.SIGINT,  handle_signal_kill_consumer)
 
+    # producer runs in this main thread
+    try:
+        if adaptive_producer is not None:
+            adaptive_producer.run(consumer)
+        else:
+            for pipeline in pipelines:
+                consumer.add_pipeline(pipeline)
+    except ValueError as e:
+        if not consumer.killed:
+            raise
+        logger.info('stopped adding pipelines: %s', e)
+
+    # signal that there are no more pipelines and thread should exit
+    # when reached
+    consumer.stop()
+
     # All threads created for workflow are non-daemon, so the
     # interpreter will not exit until all threads exit. Doing an
     # explicit join on the consumer thread is not necessary, and
@@ -120,6 +332,31 @@ def get_job_id():
     return 'PID:%s' % os.getpid()
 
 
+def get_job_deadline(walltime=None):
+    """Get the time the batch job will be killed at, from the walltime in
+    seconds if given, else from the group walltime set by Cheetah and the
+    end time exported by the scheduler, whichever is first. The walltime
+    is counted from the job start time if the scheduler exports it, else
+    from now. Returns None if not known."""
+    start = _env_float('SLURM_JOB_START_TIME') or time.time()
+    if walltime is not None:
+        return start + walltime
+    deadlines = [_env_float(var) for var in ('SLURM_JOB_END_TIME',
+                                             'COBALT_ENDTIME')]
+    group_walltime = _env_float('CODAR_CHEETAH_GROUP_WALLTIME')
+    if group_walltime:
+        deadlines.append(start + group_walltime)
+    deadlines = [d for d in deadlines if d]
+    return min(deadlines) if deadlines else None
+
+
+def _env_float(name):
+    try:
+        return float(os.environ[name])
+    except (KeyError, ValueError):
+        return None
+
+
 # allow this module to be run as a script from within a pip/setuptools
 # installed distribution
 if __name__ == '__main__':
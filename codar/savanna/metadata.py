@@ -0,0 +1,237 @@
+"""
+Optional store for the results of the runs of a sweep group in a single
+SQLite database, METADATA_DB_NAME in the group directory, instead of small
+files in each run directory.
+
+With thousands of runs, the return code and walltime files of each code, the
+total walltime of each pipeline and the output size files add up to a lot
+of metadata operations on a parallel filesystem. The store keeps them in
+two tables, keyed by the pipeline id within the group (see
+Pipeline.local_id):
+
+    runs       pipeline, run, returncode, walltime, snapshot
+    pipelines  pipeline, walltime, output_sizes
+
+where run is the code name or 'post-process', snapshot is the hash of the
+environment snapshot of the run (see environment.py) and output_sizes the
+JSON object of output file sizes. The database is in WAL mode, so each
+result is one append to the write ahead log, and is checkpointed when
+savanna exits. Since WAL needs shared memory, readers on other nodes may
+only see the results once savanna is done.
+
+Readers should use load_metadata, which returns None if the group has no
+store, and fall back to the files. export_metadata writes the files from
+the store, for tools that only read the files.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+import logging
+
+from codar.savanna.utils import RETURN_NAME, WALLTIME_NAME, \
+    TOTAL_WALLTIME_NAME
+
+
+METADATA_DB_NAME = 'codar.savanna.metadata.db'
+
+# Output file sizes of a pipeline, written by the consumer
+OUTPUT_SIZES_NAME = '.codar.adios_file_sizes.out.json'
+
+# Seconds to wait for a lock held by another connection
+BUSY_TIMEOUT = 30.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    pipeline TEXT NOT NULL,
+    run TEXT NOT NULL,
+    returncode INTEGER,
+    walltime REAL,
+    snapshot TEXT,
+    PRIMARY KEY (pipeline, run)
+);
+CREATE TABLE IF NOT EXISTS pipelines (
+    pipeline TEXT PRIMARY KEY,
+    walltime REAL,
+    output_sizes TEXT
+);
+"""
+
+
+_log = logging.getLogger('codar.savanna.metadata')
+
+
+class MetadataStore(object):
+    """Writes run results to the database of a sweep group. Thread safe.
+    Use get_metadata_store to share one instance per group within the
+    process. Values that are None are left unchanged."""
+
+    def __init__(self, group_dir):
+        self.group_dir = group_dir
+        self.path = os.path.join(group_dir, METADATA_DB_NAME)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # durable at checkpoints, a crash only loses the last results,
+        # which are also in the status file
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def record_run(self, pipe_id, run_name, returncode=None, walltime=None,
+                   snapshot=None):
+        self._upsert('runs', ('pipeline', 'run'), (pipe_id, run_name),
+                     returncode=returncode, walltime=walltime,
+                     snapshot=snapshot)
+
+    def record_pipeline(self, pipe_id, walltime=None, output_sizes=None):
+        if output_sizes is not None:
+            output_sizes = json.dumps(output_sizes)
+        self._upsert('pipelines', ('pipeline',), (pipe_id,),
+                     walltime=walltime, output_sizes=output_sizes)
+
+    def close(self):
+        """Checkpoint the write ahead log into the database and close it."""
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            except sqlite3.Error:
+                _log.exception('failed to checkpoint %s', self.path)
+            self._conn.close()
+            self._conn = None
+
+    def _upsert(self, table, key_names, key, **values):
+        values = dict((k, v) for k, v in values.items() if v is not None)
+        names = list(key_names) + list(values)
+        sql = ('INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO UPDATE '
+               'SET %s' % (table, ', '.join(names),
+                           ', '.join('?' * len(names)), ', '.join(key_names),
+                           ', '.join('%s = excluded.%s' % (k, k)
+                                     for k in values)))
+        if not values:
+            sql = ('INSERT OR IGNORE INTO %s (%s) VALUES (%s)'
+                   % (table, ', '.join(names), ', '.join('?' * len(names))))
+        with self._lock:
+            if self._conn is None:
+                # callers fall back to writing files
+                raise sqlite3.ProgrammingError('%s is closed' % self.path)
+            with self._conn:
+                self._conn.execute(sql, tuple(key) + tuple(values.values()))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_metadata_store(group_dir):
+    """Get the process wide store for the group directory, creating it if
+    needed."""
+    group_dir = os.path.normpath(group_dir)
+    with _stores_lock:
+        store = _stores.get(group_dir)
+        if store is None:
+            store = MetadataStore(group_dir)
+            _stores[group_dir] = store
+        return store
+
+
+def close_metadata_stores():
+    """Close the stores opened by get_metadata_store."""
+    with _stores_lock:
+        stores = list(_stores.values())
+        _stores.clear()
+    for store in stores:
+        store.close()
+
+
+class GroupMetadata(object):
+    """Results read from the store of a group, see load_metadata. runs is a
+    dict of (pipeline id, run name) -> dict with the returncode, walltime
+    and snapshot, pipelines a dict of pipeline id -> dict with the walltime
+    and output_sizes."""
+
+    def __init__(self, runs, pipelines):
+        self.runs = runs
+        self.pipelines = pipelines
+
+    def run_walltime(self, pipe_id, run_name):
+        return self.runs.get((pipe_id, run_name), {}).get('walltime')
+
+    def pipeline_walltime(self, pipe_id):
+        return self.pipelines.get(pipe_id, {}).get('walltime')
+
+
+def load_metadata(group_dir):
+    """Read the store of a group. Returns a GroupMetadata, or None if the
+    group has no store or it can't be read."""
+    path = os.path.join(group_dir, METADATA_DB_NAME)
+    if not os.path.isfile(path):
+        return None
+    try:
+        conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True,
+                               timeout=BUSY_TIMEOUT)
+    except sqlite3.Error:
+        _log.warning('could not open %s', path)
+        return None
+    try:
+        runs = {}
+        for pipe_id, run_name, returncode, walltime, snapshot in conn.execute(
+                'SELECT pipeline, run, returncode, walltime, snapshot '
+                'FROM runs'):
+            runs[(pipe_id, run_name)] = dict(returncode=returncode,
+                                             walltime=walltime,
+                                             snapshot=snapshot)
+        pipelines = {}
+        for pipe_id, walltime, output_sizes in conn.execute(
+                'SELECT pipeline, walltime, output_sizes FROM pipelines'):
+            if output_sizes is not None:
+                output_sizes = json.loads(output_sizes)
+            pipelines[pipe_id] = dict(walltime=walltime,
+                                      output_sizes=output_sizes)
+    except (sqlite3.Error, ValueError):
+        _log.warning('could not read %s', path)
+        return None
+    finally:
+        conn.close()
+    return GroupMetadata(runs, pipelines)
+
+
+def export_metadata(group_dir):
+    """Write the return code, walltime and output size files of each run
+    of the group from its store, as savanna writes them without the store.
+    Returns the number of files written."""
+    metadata = load_metadata(group_dir)
+    if metadata is None:
+        return 0
+    count = 0
+    for (pipe_id, run_name), values in sorted(metadata.runs.items()):
+        run_dir = os.path.join(group_dir, pipe_id)
+        if values['returncode'] is not None:
+            _write_value(os.path.join(run_dir, RETURN_NAME + '.' + run_name),
+                         values['returncode'])
+            count += 1
+        if values['walltime'] is not None:
+            _write_value(os.path.join(run_dir,
+                                      WALLTIME_NAME + '.' + run_name),
+                         values['walltime'])
+            count += 1
+    for pipe_id, values in sorted(metadata.pipelines.items()):
+        run_dir = os.path.join(group_dir, pipe_id)
+        if values['walltime'] is not None:
+            _write_value(os.path.join(run_dir, TOTAL_WALLTIME_NAME),
+                         values['walltime'])
+            count += 1
+        if values['output_sizes'] is not None:
+            with open(os.path.join(run_dir, OUTPUT_SIZES_NAME), 'w') as f:
+                f.write(json.dumps(values['output_sizes']))
+            count += 1
+    return count
+
+
+def _write_value(path, value):
+    with open(path, 'w') as f:
+        f.write(str(value) + '\n')
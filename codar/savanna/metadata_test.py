@@ -0,0 +1,51 @@
+import os
+import json
+
+from codar.savanna.metadata import MetadataStore, load_metadata, \
+    export_metadata, OUTPUT_SIZES_NAME
+from codar.savanna.utils import RETURN_NAME, WALLTIME_NAME, \
+    TOTAL_WALLTIME_NAME
+
+
+def test_record_and_load(tmpdir):
+    group_dir = str(tmpdir)
+    assert load_metadata(group_dir) is None
+
+    store = MetadataStore(group_dir)
+    store.record_run('run-0', 'sim', snapshot='abc')
+    store.record_run('run-0', 'sim', returncode=0, walltime=1.5)
+    store.record_run('run-1', 'sim', returncode=3, walltime=2.0)
+    store.record_pipeline('run-0', walltime=4.25)
+    store.record_pipeline('run-0', output_sizes={'out.bp': 10})
+    store.close()
+
+    metadata = load_metadata(group_dir)
+    # later calls leave the values they don't set unchanged
+    assert metadata.runs[('run-0', 'sim')] == dict(returncode=0,
+                                                  walltime=1.5,
+                                                  snapshot='abc')
+    assert metadata.run_walltime('run-1', 'sim') == 2.0
+    assert metadata.run_walltime('run-2', 'sim') is None
+    assert metadata.pipeline_walltime('run-0') == 4.25
+    assert metadata.pipelines['run-0']['output_sizes'] == {'out.bp': 10}
+
+
+def test_export(tmpdir):
+    group_dir = str(tmpdir)
+    os.mkdir(os.path.join(group_dir, 'run-0'))
+    store = MetadataStore(group_dir)
+    store.record_run('run-0', 'sim', returncode=0, walltime=1.5)
+    store.record_pipeline('run-0', walltime=4.25,
+                          output_sizes={'out.bp': 10})
+    store.close()
+
+    assert export_metadata(group_dir) == 4
+    run_dir = os.path.join(group_dir, 'run-0')
+    with open(os.path.join(run_dir, RETURN_NAME + '.sim')) as f:
+        assert f.read().strip() == '0'
+    with open(os.path.join(run_dir, WALLTIME_NAME + '.sim')) as f:
+        assert float(f.read()) == 1.5
+    with open(os.path.join(run_dir, TOTAL_WALLTIME_NAME)) as f:
+        assert float(f.read()) == 4.25
+    with open(os.path.join(run_dir, OUTPUT_SIZES_NAME)) as f:
+        assert json.load(f) == {'out.bp': 10}
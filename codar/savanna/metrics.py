@@ -0,0 +1,229 @@
+"""
+Counters and gauges describing what a running savanna instance is doing,
+published in the Prometheus text format.
+
+The consumer keeps the metrics in a MetricsRegistry. A MetricsPublisher
+thread writes them to a file every few seconds, replacing it atomically so
+readers never see a partial file, and can optionally serve them over HTTP
+on a local port at /metrics. Dashboards and scripts can use either without
+parsing the log.
+"""
+
+import os
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+METRICS_NAME = 'codar.savanna.metrics.prom'
+
+# Seconds between writes of the metrics file
+PUBLISH_INTERVAL = 5.0
+
+
+_log = logging.getLogger('codar.savanna.metrics')
+
+
+class Counter(object):
+    """Monotonic count, optionally split by label values."""
+
+    type_name = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        if not self.labels:
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Gauge(object):
+    """Value that can go up and down. If fn is given, it is called to get
+    the value each time the metrics are rendered, and must not block."""
+
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, fn=None):
+        self.name = name
+        self.help = help_text
+        self._fn = fn
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def get(self):
+        if self._fn is not None:
+            return self._fn()
+        return self._value
+
+    def samples(self):
+        yield self.name, {}, self.get()
+
+
+class Summary(object):
+    """Count and sum of observed values, e.g. durations."""
+
+    type_name = 'summary'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._count = 0
+        self._sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._count += 1
+            self._sum += value
+
+    def samples(self):
+        with self._lock:
+            count, total = self._count, self._sum
+        yield self.name + '_count', {}, count
+        yield self.name + '_sum', {}, total
+
+
+class MetricsRegistry(object):
+    """Named collection of metrics, rendered in registration order."""
+
+    def __init__(self, prefix='savanna_'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(self.prefix + name, help_text, labels))
+
+    def gauge(self, name, help_text, fn=None):
+        return self._add(Gauge(self.prefix + name, help_text, fn))
+
+    def summary(self, name, help_text):
+        return self._add(Summary(self.prefix + name, help_text))
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Get all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type_name))
+            try:
+                samples = list(metric.samples())
+            except Exception:
+                _log.exception('failed to get metric %s', metric.name)
+                continue
+            for name, labels, value in samples:
+                if labels:
+                    name += '{%s}' % ','.join(
+                        '%s="%s"' % (k, _escape(v))
+                        for k, v in sorted(labels.items()))
+                lines.append('%s %s' % (name, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsPublisher(threading.Thread):
+    """Thread that writes the metrics file every interval seconds. If
+    http_port is not None, the metrics are also served at
+    http://<http_host>:<port>/metrics, port 0 picks a free port. Call close
+    when done to write the final values."""
+
+    def __init__(self, registry, file_path=None, interval=PUBLISH_INTERVAL,
+                 http_port=None, http_host='127.0.0.1'):
+        threading.Thread.__init__(self, name='Thread-metrics', daemon=True)
+        self.registry = registry
+        self.file_path = file_path
+        self.interval = interval
+        self._closed = threading.Event()
+        self._server = None
+        if http_port is not None:
+            self._server = ThreadingHTTPServer((http_host, http_port),
+                                               _handler_class(registry))
+            self._server.daemon_threads = True
+            self.http_port = self._server.server_address[1]
+            threading.Thread(target=self._server.serve_forever,
+                             name='Thread-metrics-http', daemon=True).start()
+            _log.info('serving metrics at http://%s:%d/metrics', http_host,
+                      self.http_port)
+
+    def run(self):
+        while not self._closed.wait(self.interval):
+            self.write()
+
+    def write(self):
+        if self.file_path is None:
+            return
+        tmp_path = self.file_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self.registry.render())
+            os.replace(tmp_path, self.file_path)
+        except OSError:
+            _log.exception('failed to write metrics file')
+
+    def close(self):
+        self._closed.set()
+        if self.is_alive():
+            self.join()
+        self.write()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _handler_class(registry):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            _log.debug('metrics request: ' + format, *args)
+
+    return MetricsHandler
@@ -0,0 +1,29 @@
+from codar.savanna.metrics import MetricsRegistry, MetricsPublisher
+
+
+def test_render():
+    m = MetricsRegistry()
+    m.gauge('free_nodes', 'Free nodes', lambda: 3)
+    c = m.counter('killed_total', 'Kills', ('reason',))
+    c.inc(reason='timeout')
+    c.inc(2, reason='kill_all')
+    s = m.summary('idle_seconds', 'Idle')
+    s.observe(0.5)
+    lines = m.render().splitlines()
+    assert '# TYPE savanna_free_nodes gauge' in lines
+    assert 'savanna_free_nodes 3' in lines
+    assert 'savanna_killed_total{reason="kill_all"} 2' in lines
+    assert 'savanna_killed_total{reason="timeout"} 1' in lines
+    assert 'savanna_idle_seconds_count 1' in lines
+    assert 'savanna_idle_seconds_sum 0.5' in lines
+
+
+def test_publish_file(tmpdir):
+    m = MetricsRegistry()
+    m.counter('started_total', 'Started').inc()
+    path = str(tmpdir.join('metrics.prom'))
+    p = MetricsPublisher(m, path, interval=60)
+    p.start()
+    p.close()
+    with open(path) as f:
+        assert 'savanna_started_total 1\n' in f.read()
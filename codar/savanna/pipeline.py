@@ -3,24 +3,33 @@ import subprocess
 import os
 import shutil
 import math
+import functools
 import threading
 import signal
 import logging
 import json
+import sqlite3
 import warnings
 from queue import Queue
 import psutil
 import pdb
 
-from codar.savanna import tau, status, machines, summit_helper, \
-    deepthought2_helper
+from codar.savanna import tau, status, machines, summit_helper, dag, \
+    deepthought2_helper, trace
 from codar.savanna.error_messages import err_msg
 from codar.savanna.exc import SavannaException
 from codar.savanna.node_layout import NodeLayout, NodeConfig
-from codar.savanna.run import Run
+from codar.savanna.run import Run, KILL_WAIT
 from codar.savanna.utils import get_path, STDOUT_NAME, STDERR_NAME, \
-    RETURN_NAME, WALLTIME_NAME
+    RETURN_NAME, WALLTIME_NAME, TOTAL_WALLTIME_NAME
 from codar.savanna.templates import EXE_LAUNCH_FILE_TEMPLATE
+from codar.savanna.reaper import get_reaper
+from codar.savanna.environment import get_environment_store
+from codar.savanna.resources import layout_resources
+from codar.savanna.logs import log_fields
+from codar.savanna.metadata import get_metadata_store
+
+POST_PROCESS_TIMEOUT = 120
 
 _log = logging.getLogger('codar.savanna.pipeline')
 
@@ -32,8 +41,13 @@ class Pipeline(object):
                  post_process_script=None,
                  post_process_args=None,
                  post_process_stop_on_failure=False,
-                 node_layout=None, launch_mode=None):
-        self.id = pipe_id
+                 node_layout=None, launch_mode=None, group=None):
+        # pipelines from several sweep groups can be run by one savanna job,
+        # the id is then prefixed by the group name to make it unique, and
+        # local_id is the id in the group fobs and status files
+        self.group = group
+        self.local_id = pipe_id
+        self.id = status.group_pipeline_id(group, pipe_id)
         self.runs = runs
         self.working_dir = working_dir
         self.apps_dir = apps_dir
@@ -49,38 +63,63 @@ class Pipeline(object):
         self._force_killed = False
         self._active_runs = set()
 
-        self._pipe_thread = None
-        self._post_thread = None
+        # index of the next run to start, and the reaper timer that will
+        # start it after a sleep_after delay, and when the delay started
+        self._next_run = 0
+        self._start_timer = None
+        self._sleep_time = None
+
+        # Set when the post process script is done or was not started
+        self._post_done = threading.Event()
+        self._post_done.set()
         self.done_callbacks = set()
         self.fatal_callbacks = set()
         self.total_procs = 0
         self.log_prefix = self.id
         self._start_time = None
-        self._walltime_path = self.working_dir+"/codar.savanna.total.walltime"
-
+        self._walltime_path = os.path.join(self.working_dir,
+                                           TOTAL_WALLTIME_NAME)
+        # Set in start if results are saved in the metadata store of the
+        # group, see metadata.py
+        self.metadata_store = None
+
+        environment_store = get_environment_store(
+                                os.path.dirname(os.path.normpath(working_dir)))
         for run in runs:
             self.total_procs += run.nprocs
             run.log_prefix = "%s:%s" % (self.id, run.name)
+            run.pipeline_id = self.id
+            run.local_pipeline_id = self.local_id
+            run.environment_store = environment_store
         # requires ppn to determine, in case node layout is not specified
         self.total_nodes = total_nodes
         self.launch_mode = launch_mode
 
         # List of node IDs assigned to this pipeline. Gets initialized in
         # start()
-        self.nodes_assigned = Queue()
+        self.nodes_assigned = []
+
+        # Reference counts for nodes shared between runs. Maps each node
+        # to the set of runs that have not finished and use the node, and
+        # each run to the nodes it uses. Nodes are returned to the consumer
+        # as soon as the last run using them is done. Nodes not used by any
+        # run, or all nodes if the layout could not be mapped to nodes, are
+        # held until the pipeline is done.
+        self._node_refs = {}
+        self._run_nodes = {}
+        self._held_nodes = set()
+        self.release_callbacks = set()
 
         # Keep a copy of the nodes assigned. Pop nodes from this queue to
-        # assign to Runs. When a Run is done, it can push the node back into
-        # this queue, but Runs that share nodes may add the same node to the
-        # Queue multiple times. We need a SetQueue for this, or a way to
-        # have all Runs in a shared node release nodes just once.
+        # assign to Runs when parsing the node layout.
         self._nodes_assigned = Queue()
 
     @classmethod
-    def from_data(cls, data):
+    def from_data(cls, data, group=None):
         """Create Pipeline instance from dictionary data structure, containing
         at least "id" and "runs" keys. The "runs" key must have a list of dict,
-        and each dict is parsed using Run.from_data.
+        and each dict is parsed using Run.from_data. group is the name of
+        the sweep group, if savanna runs several groups.
         Raises KeyError if a required key is missing."""
 
         runs_data = data["runs"]
@@ -93,6 +132,7 @@ class Pipeline(object):
 
         # Run working dir defaults to pipeline working dir, and can be
         # specified relative to pipeline working dir.
+        machine = machines.get_by_name(data["machine_name"])
         for rd in runs_data:
             run_working_dir = rd.get("working_dir")
             if run_working_dir is None:
@@ -103,7 +143,7 @@ class Pipeline(object):
             rd["tau_profiling"] = tau_profiling
             rd["tau_tracing"] = tau_tracing
             rd["apps_dir"] = apps_dir
-            rd["machine"] = machines.get_by_name(data["machine_name"])
+            rd["machine"] = machine
         if not isinstance(runs_data, list):
             _log.error("'runs' key must be a list of dictionaries")
             return None
@@ -112,16 +152,24 @@ class Pipeline(object):
 
         # Get run objects on which each run depends
         # Replace run names in depends_on_runs with object references
+        runs_by_name = dict((run.name, run) for run in runs)
         for run in runs:
-            if run.depends_on_runs is not None:
-                for tmp_run in runs:
-                    if run.depends_on_runs == tmp_run.name:
-                        run.depends_on_runs = tmp_run
-                        break
-                if run.depends_on_runs is None:
+            parents = []
+            for name in run.depends_on_runs:
+                parent = runs_by_name.get(name)
+                if parent is None:
                     _log.error("Internal failure in dependency management "
-                               "in %s", working_dir)
+                               "in %s: unknown run '%s'", working_dir, name)
                     return None
+                if parent not in parents:
+                    parents.append(parent)
+            run.depends_on_runs = parents
+        try:
+            dag.topological_sort(runs, lambda run: run.depends_on_runs,
+                                 lambda run: run.name)
+        except dag.CyclicDependencyError as e:
+            _log.error("%s in %s", str(e), working_dir)
+            return None
 
         launch_mode = data.get("launch_mode")
         kill_on_partial_failure = data.get("kill_on_partial_failure", False)
@@ -144,70 +192,85 @@ class Pipeline(object):
                         node_layout=node_layout,
                         launch_mode=launch_mode,
                         total_nodes=total_nodes,
-                        machine_name=machine_name)
+                        machine_name=machine_name,
+                        group=group)
 
     def reorder_runs_by_dependencies(self):
         """
         Reorder the runs list so that runs appear in the order in which they
-        must be launched.
-        This requires parsing their dependencies information.
-
-        Keep iterating through the runs list, finding the root-level run at
-        every iteration (one with no dependencies) until all runs are examined.
-        Watch out for cyclic dependencies.
-
-        This algorithm will work as far as there is only one code on which a
-        code can depend on.
+        must be launched, i.e. every run comes after all the runs it depends
+        on. Raises dag.CyclicDependencyError if there is a cycle.
         """
-        ordered_runs = []
-        while len(ordered_runs) < len(self.runs):
-            cyclic_dep = True
-
-            # first retrieve all runs with no dependencies
-            for run in self.runs:
-                if run in ordered_runs:
-                    continue
-                if run.depends_on_runs is None:
-                    cyclic_dep = False
-                    ordered_runs.append(run)
-
-            # now get all runs whose depends_on are in ordered_runs
-            # this order of processing is important
+        self.runs = dag.topological_sort(self.runs,
+                                         lambda run: run.depends_on_runs,
+                                         lambda run: run.name)
+
+    def resume(self, succeeded):
+        """Mark the runs that succeeded in an earlier job as resumed, so
+        they are not launched again. succeeded is a collection of run
+        names, from the status file. A run is only resumed if the runs it
+        depends on are resumed, and every run that is launched again depends
+        on it. Runs that were running at the same time as a run that is
+        launched again may be coupled with it, so they are launched again
+        too. MPMD pipelines are always run in full. Returns the names of the
+        resumed runs."""
+        if (self.launch_mode or '').lower() == 'mpmd':
+            return []
+        run_ancestors = dag.ancestors(self.runs,
+                                      lambda run: run.depends_on_runs,
+                                      lambda run: run.name)
+        rerun = set(run for run in self.runs if run.name not in succeeded)
+        changed = True
+        while changed:
+            changed = False
             for run in self.runs:
-                if run in ordered_runs:
+                if run in rerun:
                     continue
-                if run.depends_on_runs in ordered_runs:
-                    cyclic_dep = False
-                    ordered_runs.append(run)
-
-            assert not cyclic_dep, "Cyclic dependency found amongst " \
-                                   "applications"
-
-        self.runs = ordered_runs
+                if (any(parent in rerun for parent in run.depends_on_runs)
+                        or any(run not in run_ancestors[other]
+                               for other in rerun)):
+                    rerun.add(run)
+                    changed = True
+        resumed = [run.name for run in self.runs if run not in rerun]
+        for run in self.runs:
+            run.resumed = run not in rerun
+        if resumed:
+            _log.info("pipeline %s resuming, not launching runs %s",
+                      self.id, ', '.join(resumed), extra=self.log_fields)
+        return resumed
 
     def start(self, consumer, nodes_assigned, runner=None):
         # Mark all runs as active before they are actually started
         # in a separate thread, so other methods know the state.
+        setup_time = time.time()
 
         # Reorder the runs list so that runs are listed according to their
         # dependencies
         self.reorder_runs_by_dependencies()
 
-        for node_name in nodes_assigned:
-            self.nodes_assigned.put(node_name)
-            # self.nodes_assigned.put(machine.node_class(node_name))
+        self.nodes_assigned = list(nodes_assigned)
+        self._held_nodes = set(nodes_assigned)
 
-        # Make a copy of the nodes_assigned. copy.deepcopy does not work
-        # self._nodes_assigned = copy.deepcopy(self.nodes_assigned)
-        for node in list(self.nodes_assigned.queue):
+        # Queue of nodes that are handed out to runs by the node layout. The
+        # consumer assigns the nodes in topology order, so taking them in
+        # order keeps the nodes of each run next to each other.
+        for node in self.nodes_assigned:
             self._nodes_assigned.put(node)
 
         self.add_done_callback(consumer.pipeline_finished)
         self.add_fatal_callback(consumer.pipeline_fatal)
+        self.add_release_callback(consumer.nodes_released)
+
+        if consumer.use_metadata_store:
+            self.metadata_store = get_metadata_store(
+                            os.path.dirname(os.path.normpath(self.working_dir)))
 
         with self._state_lock:
             for run in self.runs:
                 run.set_runner(runner)
+                run.usage_sampler = consumer.usage_sampler
+                run.output_collector = consumer.output_collector
+                run.metadata_store = self.metadata_store
                 run.app_sh_setup()
 
             # Parse the node layout and set the run information.
@@ -246,33 +309,106 @@ class Pipeline(object):
                 self.runs.insert(0, jsm_r)
             # -------------------------------------------------------------- #
 
-            for run in self.runs:
-                # Commenting out the callback to consumer.run_finished that
-                # releases the nodes held by a run.
-                # Now this is called when the pipeline finishes
-
-                # run.add_callback(consumer.run_finished)
+            self._map_nodes_to_runs(layout_type == 'NodeConfig')
 
+            for run in self.runs:
                 run.add_callback(self.run_finished)
                 self._active_runs.add(run)
             self._running = True
+        trace.pipeline_span('setup', setup_time, time.time(), self.id,
+                            nodes=len(self.nodes_assigned))
 
-            # Next start pipeline runs in separate thread and return
-            # immediately, so we can inject a wait time between starting runs.
-            self._pipe_thread = threading.Thread(target=self._start)
-            self._pipe_thread.start()
+        # Start pipeline runs and return immediately. Wait times between
+        # starting runs are reaper timers.
+        self._start()
 
     def _start(self):
-        """Start all runs in the pipeline, along with threads that monitor
-        their progress and signal consumer when finished. Use join_all to
+        """Start all runs in the pipeline. The reaper monitors their
+        progress and they signal the consumer when finished. Use join_all to
         wait until they are all finished."""
 
-        _log.debug("Pipeline {} launching run components".format(self.id))
+        _log.debug("Pipeline %s launching run components", self.id,
+                   extra=self.log_fields)
         self._start_time = time.time()
-        for run in self.runs:
+        self._start_runs(0)
+
+    def _start_runs(self, i):
+        """Start runs from index i, until a run has a sleep_after, in which
+        case the remaining runs are started by a reaper timer. If the
+        pipeline has been force killed, the remaining runs are started
+        without delay, which marks them as done without launching them.
+        Does nothing if the runs from index i have already been started, so
+        it is safe to call from both the timer and force_kill_all."""
+        with self._state_lock:
+            if i != self._next_run:
+                return
+            self._start_timer = None
+            sleep_time, self._sleep_time = self._sleep_time, None
+        trace.pipeline_span('sleep_after', sleep_time, time.time(), self.id)
+        while i < len(self.runs):
+            run = self.runs[i]
             run.start()
-            if run.sleep_after:
-                time.sleep(run.sleep_after)
+            i += 1
+            with self._state_lock:
+                self._next_run = i
+                if (run.sleep_after and i < len(self.runs)
+                        and not self._force_killed and not run.resumed):
+                    self._start_timer = get_reaper().call_later(
+                                run.sleep_after, self._start_runs, i)
+                    self._sleep_time = time.time()
+                    return
+
+    def _map_nodes_to_runs(self, node_config_layout):
+        """Set up the reference counts used to release nodes when runs
+        finish. Must be called after the final list of runs is known."""
+        if node_config_layout:
+            run_nodes = {}
+            for run in self.runs:
+                nodes = set()
+                for r in (run.child_runs or [run]):
+                    nodes.update(r.nodes_assigned or [])
+                if nodes:
+                    run_nodes[run] = nodes
+        else:
+            run_nodes = self._map_dict_layout_nodes()
+
+        self._run_nodes = run_nodes
+        self._node_refs = {}
+        for run, nodes in run_nodes.items():
+            run.node_ids = sorted(nodes)
+            for node in nodes:
+                self._node_refs.setdefault(node, set()).add(run)
+
+    def _map_dict_layout_nodes(self):
+        """For layouts that give a node count per run, map the runs onto the
+        pipeline nodes the same way Cheetah counted them: a run that depends
+        on other runs reuses the nodes of the first one, all other runs get
+        their own nodes. The runner picks the actual hosts, so this only
+        tracks how many nodes are in use. Returns an empty dict if the
+        layout does not fit the assigned nodes."""
+        available = list(self.nodes_assigned)
+        child_nodes = {}
+        run_nodes = {}
+        for run in self.runs:
+            nodes = set()
+            for r in (run.child_runs or [run]):
+                if r.nodes is None:
+                    return {}
+                # reuse the nodes of the first parent, the runs are ordered
+                # so it has been mapped already
+                parent = r.depends_on_runs[0] if r.depends_on_runs else None
+                r_nodes = list(child_nodes.get(parent, []))[:r.nodes]
+                while len(r_nodes) < r.nodes:
+                    if not available:
+                        _log.debug("%s node layout does not match total "
+                                   "nodes, holding nodes until done",
+                                   self.log_prefix, extra=self.log_fields)
+                        return {}
+                    r_nodes.append(available.pop(0))
+                child_nodes[r] = r_nodes
+                nodes.update(r_nodes)
+            run_nodes[run] = nodes
+        return run_nodes
 
     def _parse_node_layouts(self):
         """Only for Summit right now."""
@@ -388,37 +524,26 @@ class Pipeline(object):
         Input is a nested list of lists, where the inner lists represents
         codes sharing a compute node.
         This function rearranges those codes by dependencies so that codes
-        that are run in order are placed on the same node.
+        that are run in order are placed on the same node. A code that
+        depends on several codes is placed with the first of them.
         """
-
-        def parse_lists(_nl):
-            """
-            dont judge me
-            """
-            for l in _nl:
-                for code in l:
-                    if code.depends_on_runs:
-                        t = code.depends_on_runs
-                        if t not in l:
-                            for ol in _nl:
-                                if t in ol:
-                                    ol.append(code)
-                                    l.remove(code)
-                                    return False
-            return True
-
-        done = False
-        while not done:
-            done = parse_lists(nl)
+        group_of = dag.group_with_parents(nl,
+                                          lambda run: run.depends_on_runs,
+                                          lambda run: run.name)
+        regrouped = [[] for l in nl]
+        for i, l in enumerate(nl):
+            for code in l:
+                target = group_of[code] if code.depends_on_runs else i
+                if code not in regrouped[target]:
+                    regrouped[target].append(code)
+        nl[:] = regrouped
 
     def run_finished(self, run):
         assert self._running
         run_done_callbacks = False
 
-        # release_nodes doesn't do anything at this time. Runs do not
-        # release nodes back to the pipeline, as it is non-trivial to
-        # release nodes to the pipeline when Runs share nodes.
-        self._release_nodes(run.nodes_assigned)
+        # Return nodes that are no longer used by any run to the consumer
+        self._release_nodes(run)
 
         with self._state_lock:
             self._active_runs.remove(run)
@@ -437,6 +562,8 @@ class Pipeline(object):
                     jsm_r.kill()
             # -------------------------------------------------------------- #
             if not self._active_runs:
+                trace.pipeline_span('runs', self._start_time, time.time(),
+                                    self.id)
                 # save the total runtime here to ensure it is captured
                 # before the post process script is run
                 self.save_walltime()
@@ -444,7 +571,7 @@ class Pipeline(object):
                 run_done_callbacks = True
             elif self.kill_on_partial_failure and not run.succeeded:
                 _log.warning('%s run %s failed, killing remaining',
-                             self.log_prefix, run.name)
+                             self.log_prefix, run.name, extra=run.log_fields)
                 self.save_walltime()
                 # if configured, kill all runs in the pipeline if one of
                 # them has a nonzero exit code. Still allow post process to
@@ -462,57 +589,99 @@ class Pipeline(object):
             return None
         if self._force_killed:
             return None
-        self._post_thread = threading.Thread(target=self._post_process_thread)
-        self._post_thread.start()
+        self._post_done.clear()
+        get_reaper().submit(self._start_post_process)
 
-    def _post_process_thread(self):
+    def _start_post_process(self):
         args = [self.post_process_script] + self.post_process_args
         # TODO: make sure this doesn't conflict with other names
         name = 'post-process'
-        stdout_path = self._get_path(self.working_dir,
-                                STDOUT_NAME + "." + name, None)
-        stderr_path = self._get_path(self.working_dir,
-                                STDERR_NAME + "." + name, None)
-        return_path = self._get_path(self.working_dir,
-                                RETURN_NAME + "." + name, None)
-        walltime_path = self._get_path(self.working_dir,
-                                  WALLTIME_NAME + "." + name, None)
-
-        outf = errf = None
-        start_time = time.time()
+        stdout_path = get_path(self.working_dir,
+                               STDOUT_NAME + "." + name, None)
+        stderr_path = get_path(self.working_dir,
+                               STDERR_NAME + "." + name, None)
+
+        self._post_files = []
+        self._post_start_time = time.time()
         try:
-            outf = open(stdout_path, 'w')
-            errf = open(stderr_path, 'w')
-            rval = None
-            rval = subprocess.call(args, stdout=outf, stderr=errf,
-                                   cwd=self.working_dir, timeout=120)
-        except subprocess.SubprocessError as e:
+            self._post_files = [open(stdout_path, 'w'),
+                                open(stderr_path, 'w')]
+            p = subprocess.Popen(args, stdout=self._post_files[0],
+                                 stderr=self._post_files[1],
+                                 cwd=self.working_dir)
+        except (OSError, subprocess.SubprocessError) as e:
             _log.warning("pipe '%s' failed to run post process script: %s",
-                         self.id, str(e))
+                         self.id, str(e), extra=self.log_fields)
+            self._post_process_done(None)
+            return
+        reaper = get_reaper()
+        timer = reaper.call_later(POST_PROCESS_TIMEOUT, p.kill)
+        reaper.watch_process(p, functools.partial(self._post_process_exited,
+                                                  timer))
+
+    def _post_process_exited(self, timer, p):
+        timer.cancel()
+        if timer.fired:
+            _log.warning("pipe '%s' post process script timed out",
+                         self.id, extra=self.log_fields)
             rval = None
+        else:
+            rval = p.returncode
+        self._post_process_done(rval)
+
+    def _post_process_done(self, rval):
+        name = 'post-process'
+        return_path = get_path(self.working_dir,
+                               RETURN_NAME + "." + name, None)
+        walltime_path = get_path(self.working_dir,
+                                 WALLTIME_NAME + "." + name, None)
+        end_time = time.time()
+        trace.pipeline_span('post_process', self._post_start_time, end_time,
+                            self.id, returncode=rval)
+        try:
+            for f in self._post_files:
+                f.close()
+            if not self._record_metadata('record_run', self.local_id, name,
+                                         rval,
+                                         end_time - self._post_start_time):
+                with open(return_path, 'w') as rf:
+                    rf.write(str(rval))
+                    rf.write('\n')
+                with open(walltime_path, 'w') as wf:
+                    wf.write(str(end_time - self._post_start_time) + '\n')
         finally:
-            end_time = time.time()
-            if outf is not None:
-                outf.close()
-            if errf is not None:
-                errf.close()
-            with open(return_path, 'w') as rf:
-                rf.write(str(rval))
-                rf.write('\n')
-            with open(walltime_path, 'w') as wf:
-                wf.write(str(end_time - start_time) + '\n')
+            self._post_done.set()
         if rval != 0 and self.post_process_stop_on_failure:
             self._execute_fatal_callbacks()
 
     def save_walltime(self):
         """
-        Saves the total runtime of the pipeline in a a file.
+        Saves the total runtime of the pipeline in a file, or in the
+        metadata store if enabled.
         """
 
         walltime = time.time() - self._start_time
+        if self._record_metadata('record_pipeline', self.local_id,
+                                 walltime):
+            return
         with open(self._walltime_path, 'w') as f:
             f.write(str(walltime) + "\n")
 
+    def _record_metadata(self, method, *args):
+        """Save results with the named method of the metadata store.
+        Returns False if the store is not enabled or failed, and files must
+        be written instead."""
+        if self.metadata_store is None:
+            return False
+        try:
+            getattr(self.metadata_store, method)(*args)
+        except sqlite3.Error:
+            _log.exception('%s failed to save results in %s, writing files',
+                           self.log_prefix, self.metadata_store.path,
+                           extra=self.log_fields)
+            return False
+        return True
+
     def add_done_callback(self, fn):
         self.done_callbacks.add(fn)
 
@@ -521,7 +690,8 @@ class Pipeline(object):
 
     def _execute_done_callbacks(self):
         # NOTE: must be called w/o any locks!
-        _log.debug('%s _execute_done_callbacks', self.log_prefix)
+        _log.debug('%s _execute_done_callbacks', self.log_prefix,
+                   extra=self.log_fields)
         for cb in self.done_callbacks:
             cb(self)
 
@@ -533,24 +703,72 @@ class Pipeline(object):
 
     def _execute_fatal_callbacks(self):
         # NOTE: must be called w/o any locks!
-        _log.debug('%s _execute_fatal_callbacks', self.log_prefix)
+        _log.debug('%s _execute_fatal_callbacks', self.log_prefix,
+                   extra=self.log_fields)
         for cb in self.fatal_callbacks:
             cb(self)
 
-    def _release_nodes(self, nodes_assigned_to_run):
-        pass
+    def add_release_callback(self, fn):
+        """Function takes the pipeline and a list of nodes, and is called
+        when runs finish and their nodes are no longer used by any other
+        run in the pipeline."""
+        self.release_callbacks.add(fn)
+
+    def remove_release_callback(self, fn):
+        self.release_callbacks.remove(fn)
+
+    def _release_nodes(self, run):
+        """Drop the references the run holds on its nodes, and pass the
+        nodes that are no longer referenced to the release callbacks."""
+        released = []
+        with self._state_lock:
+            for node in self._run_nodes.pop(run, ()):
+                refs = self._node_refs[node]
+                refs.discard(run)
+                if not refs and node in self._held_nodes:
+                    self._held_nodes.remove(node)
+                    released.append(node)
+        # NOTE: must be done w/o any locks, callbacks acquire consumer locks
+        if released:
+            _log.debug('%s run %s released nodes %s', self.log_prefix,
+                       run.name, released,
+                       extra=log_fields(self.id, run.name, released))
+            for cb in self.release_callbacks:
+                cb(self, released)
+
+    def release_held_nodes(self):
+        """Remove and return all nodes that have not been released yet.
+        Called by the consumer when the pipeline is done."""
+        with self._state_lock:
+            nodes = [node for node in self.nodes_assigned
+                     if node in self._held_nodes]
+            self._held_nodes.clear()
+        return nodes
 
     def _get_run_by_name(self, run_name):
         for run in self.runs:
             if run.name == run_name:
                 return run
 
+    @property
+    def log_fields(self):
+        """Structured fields of the log records about this pipeline."""
+        return log_fields(self.id, node_ids=self.nodes_assigned or None)
+
     def get_nodes_used(self):
         if self.total_nodes is None:
             raise ValueError("set_ppn must be called before getting "
                              "node usage")
         return self.total_nodes
 
+    def get_resources(self):
+        """Get the Resources vector used by the consumer to find nodes for
+        the pipeline."""
+        memory = dict((run.name, run.memory_per_node) for run in self.runs
+                      if run.memory_per_node)
+        return layout_resources(self.get_nodes_used(), self.node_layout,
+                                memory)
+
     def set_ppn(self, ppn):
         """Determine number of nodes needed to run pipeline with the specified
         node layout or full occupancy layout with ppn. Also updates runs
@@ -590,11 +808,19 @@ class Pipeline(object):
     def get_state(self):
         with self._state_lock:
             if not self._running:
-                return status.PipelineState(self.id, status.NOT_STARTED)
-            elif self._force_killed:
-                return status.PipelineState(self.id, status.KILLED)
+                # keep the resumed runs, in case the job ends before the
+                # pipeline is started
+                runs = dict((r.name, status.REASON_SUCCEEDED)
+                            for r in self.runs if r.resumed)
+                return status.PipelineState(self.id, status.NOT_STARTED,
+                                            runs=runs)
+            runs = dict((r.name, r.get_state()) for r in self.runs)
+            if self._force_killed:
+                return status.PipelineState(self.id, status.KILLED,
+                                            runs=runs)
             elif self._active_runs:
-                return status.PipelineState(self.id, status.RUNNING)
+                return status.PipelineState(self.id, status.RUNNING,
+                                            runs=runs)
             # done
             return_codes = dict((r.name, r.get_returncode())
                                 for r in self.runs)
@@ -610,41 +836,56 @@ class Pipeline(object):
             elif any((r.get_returncode() != 0) for r in self.runs):
                 reason = status.REASON_FAILED
             return status.PipelineState(self.id, status.DONE,
-                                        reason, return_codes)
+                                        reason, return_codes, runs=runs)
 
     def get_pids(self):
         assert self._running
         return [run.get_pid() for run in self.runs]
 
-    def force_kill_all(self):
+    def force_kill_all(self, kill_wait=KILL_WAIT):
         """
-        Kill all runs and don't run post processing. Note that this call may
-        block waiting for all runs to be started, to avoid confusing races.
-        If the pipeline is already done, this does nothing. If one or more
-        runs are still active, or have not yet been marked as finished, then
-        it will mark the entire pipeline as killed so it can be re-run from
-        scratch on a restart if desired.
+        Kill all runs and don't run post processing. Does not block. Runs
+        that have not been launched yet are marked as killed and will not
+        start, and runs waiting for a sleep_after delay are marked done
+        right away. If the pipeline is already done, this does nothing. If
+        one or more runs are still active, or have not yet been marked as
+        finished, then it will mark the entire pipeline as killed so it can
+        be re-run from scratch on a restart if desired. Runs that don't exit
+        after SIGTERM are sent SIGKILL after kill_wait seconds.
         """
         assert self._running
-        # Make sure _active_runs is fully populated by start thread.
-        self._pipe_thread.join()
         with self._state_lock:
             if not self._active_runs:
                 # already complete, don't kill
                 return
             self._force_killed = True
+            active_runs = list(self._active_runs)
+            start_timer = self._start_timer
+            next_run = self._next_run
+
+        for run in active_runs:
+            run.kill(kill_wait)
 
-        for run in self._active_runs:
-            run.kill()
+        if start_timer is not None:
+            start_timer.cancel()
+            self._start_runs(next_run)
 
-    def join_all(self):
+    def join_all(self, timeout=None):
+        """Wait for all runs and the post process script to finish. Returns
+        False if timeout seconds passed before they finished."""
         assert self._running
-        self._pipe_thread.join()
+        deadline = None if timeout is None else time.time() + timeout
         for run in self.runs:
-            run.join()
-        # Note: the _post_thread is set in the last run_finished
-        # callback, which will be executed in one of the run threads
-        # joined above, so this is guarenteed to be set if post process
-        # has been configured and force kill was not called.
-        if self._post_thread is not None:
-            self._post_thread.join()
+            if not run.join(_remaining(deadline)):
+                return False
+        # Note: the post process script is started in the last run_finished
+        # callback, which is executed before the run is marked done, so
+        # _post_done is cleared by now if post process has been configured
+        # and force kill was not called.
+        return self._post_done.wait(_remaining(deadline))
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return max(0, deadline - time.time())
@@ -1,48 +1,581 @@
-"""Classes for producing pipelines."""
+"""Classes for producing pipelines.
+
+JSONFilePipelineReader produces the pipelines of a fobs file. Adaptive
+producers, see AdaptiveProducer, choose the pipelines to run from the results
+of the pipelines that are done, and add them to the running consumer in the
+same job. Custom adaptive producers can be loaded with load_producer_class,
+e.g. for Bayesian optimization of a metric.
+"""
 
 import json
 import os
 import logging
+import itertools
+import importlib
+import importlib.util
+import queue
+import random
 from codar.savanna.pipeline import Pipeline
-from codar.savanna.status import DONE, NOT_STARTED
+from codar.savanna.resources import layout_resources
+from codar.savanna.status import DONE, NOT_STARTED, REASON_SUCCEEDED, \
+                                  PipelineState, load_workflow_status, \
+                                  group_pipeline_id
+from codar.savanna.utils import RUN_PARAMS_NAME
+
+# Single level JSON file with results, written by the codes or the post
+# process script of a pipeline in its working dir
+USER_REPORT_NAME = 'cheetah_user_report.json'
+
+# Seconds between checks for kill_all while waiting for pipelines
+ADAPTIVE_POLL_INTERVAL = 1.0
 
 _log = logging.getLogger('codar.savanna.producer')
 
 
 class JSONFilePipelineReader(object):
-    """Load pipelines from a file formatted as a new line separated list of
-    JSON documents. Each JSON document must be a list containing dictionaries,
-    each dictionary discribing a code to run as part of the pipeline."""
+    """Load pipelines from a fobs file, containing a JSON document for each
+    pipeline with a list of dictionaries describing the codes to run as part
+    of the pipeline.
+
+    The file is read one line at a time, see read_fobs for the supported
+    formats. Pipelines are produced as PipelineDescriptor objects, which
+    only keep what is needed for scheduling and load the full Pipeline from
+    the file when it is about to be started.
+
+    Pipelines that are done in the status file are skipped. For the other
+    pipelines, the runs that succeeded according to the per run states in
+    the status file are resumed, see Pipeline.resume.
 
-    def __init__(self, file_path):
+    If savanna runs several sweep groups, group is the name of the group of
+    the fobs file, and the ids of the pipelines are prefixed with it, see
+    Pipeline.local_id."""
+
+    def __init__(self, file_path, group=None):
         self.file_path = file_path
+        self.group = group
 
     def read_pipelines(self):
 
         # If the group has been run before, open status file and get the
-        # status of all runs
+        # ids of all runs that are done, and the runs that succeeded in
+        # pipelines that are not done
         status_file = os.path.join(os.path.dirname(self.file_path),
                                    'codar.workflow.status.json')
+        done_ids = set()
+        succeeded_runs = {}
         try:
-            with open(status_file, 'r') as sf:
-                pipelines_status = json.load(sf)
+            for pipe_id, status_d in load_workflow_status(status_file).items():
+                if status_d.get('state', NOT_STARTED) == DONE:
+                    done_ids.add(pipe_id)
+                    continue
+                names = [name for name, state
+                         in (status_d.get('runs') or {}).items()
+                         if state == REASON_SUCCEEDED]
+                if names:
+                    succeeded_runs[pipe_id] = names
         except:
-            pipelines_status = {}
-
-        with open(self.file_path) as f:
-            all_pipelines = json.load(f)
+            done_ids = set()
+            succeeded_runs = {}
 
-        for pipeline_data in all_pipelines:
+        for offset, pipeline_data in read_fobs(self.file_path):
             # Check if this pipeline has already been run
             pipe_id = pipeline_data['id']
-            status_d = pipelines_status.get(pipe_id, {})
-            status = status_d.get('state', NOT_STARTED)
 
             # Add pipeline if not done
-            if status == DONE:
+            if pipe_id in done_ids:
                 _log.info("pipeline %s already done, skipping", pipe_id)
+                continue
+            if offset is None or pipeline_data.get('total_nodes') is None:
+                # old format file, or the node count must be computed from
+                # the runs
+                pipeline = Pipeline.from_data(pipeline_data, self.group)
             else:
-                pipeline = Pipeline.from_data(pipeline_data)
-                if pipeline:
-                    _log.debug("adding pipeline %s to run queue", pipe_id)
-                    yield pipeline
+                pipeline = PipelineDescriptor.from_data(
+                                    pipeline_data, self.file_path, offset,
+                                    self.group)
+            if pipeline and pipe_id in succeeded_runs:
+                pipeline.resume(succeeded_runs[pipe_id])
+            if pipeline:
+                _log.debug("adding pipeline %s to run queue", pipe_id)
+                yield pipeline
+
+
+def get_group_names(input_files):
+    """Get a unique name for the group of each fobs file, the name of the
+    directory it is in, with a suffix if several directories have the same
+    name."""
+    names = []
+    for path in input_files:
+        name = os.path.basename(os.path.dirname(os.path.abspath(path)))
+        unique = name
+        i = 1
+        while unique in names:
+            i += 1
+            unique = '%s-%d' % (name, i)
+        names.append(unique)
+    return names
+
+
+def interleave(iterables):
+    """Yield the first item of each iterable, then the second, etc."""
+    sentinel = object()
+    for items in itertools.zip_longest(*iterables, fillvalue=sentinel):
+        for item in items:
+            if item is not sentinel:
+                yield item
+
+
+def read_fobs(file_path):
+    """Generator over the pipelines in a fobs file, yielding (offset,
+    pipeline data) pairs where offset is the position of the line with the
+    pipeline in the file. Supports JSON lists with one pipeline per line,
+    as written by Cheetah, and files with one pipeline per line without the
+    enclosing list. For other JSON files, e.g. lists with pipelines over
+    several lines as written by older versions of Cheetah, the whole file
+    is loaded and offset is None."""
+    with open(file_path, 'rb') as f:
+        offset = 0
+        found = False
+        for line in f:
+            line_offset = offset
+            offset += len(line)
+            data = line.strip()
+            if data in (b'', b'[', b']'):
+                continue
+            if data.endswith(b','):
+                data = data[:-1]
+            try:
+                pipeline_data = json.loads(data.decode('utf8'))
+            except ValueError:
+                pipeline_data = None
+            if not isinstance(pipeline_data, dict):
+                if not found:
+                    break
+                raise ValueError('invalid pipeline at offset %d in %s'
+                                 % (line_offset, file_path))
+            found = True
+            yield line_offset, pipeline_data
+        else:
+            return
+
+    # not a one pipeline per line file
+    with open(file_path) as f:
+        all_pipelines = json.load(f)
+    for pipeline_data in all_pipelines:
+        yield None, pipeline_data
+
+
+def read_fob_at(file_path, offset):
+    """Read the pipeline data from the line at offset in a fobs file."""
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        data = f.readline().strip()
+    if data.endswith(b','):
+        data = data[:-1]
+    return json.loads(data.decode('utf8'))
+
+
+class PipelineDescriptor(object):
+    """Placeholder for a pipeline in a fobs file that has not been started
+    yet. Provides what the consumer needs to schedule the pipeline, and
+    creates the Pipeline and Run objects when load is called. This keeps
+    memory use low for groups with a large number of pipelines."""
+
+    __slots__ = ('id', 'total_nodes', 'working_dir', 'runs', 'file_path',
+                 'offset', 'ppn', 'resources', 'succeeded_runs', 'group')
+
+    def __init__(self, pipe_id, total_nodes, working_dir, runs, file_path,
+                 offset, resources=None, group=None):
+        self.group = group
+        self.id = group_pipeline_id(group, pipe_id)
+        self.total_nodes = total_nodes
+        self.working_dir = working_dir
+        # RunSummary objects, used for walltime estimates
+        self.runs = runs
+        self.file_path = file_path
+        self.offset = offset
+        self.ppn = None
+        self.succeeded_runs = None
+        if resources is None:
+            resources = layout_resources(total_nodes, None)
+        self.resources = resources
+
+    @classmethod
+    def from_data(cls, data, file_path, offset, group=None):
+        runs = RunSummary.list_from_data(data['runs'])
+        if runs is None:
+            _log.error("Internal failure in dependency management in %s",
+                       data['working_dir'])
+            return None
+        memory = dict((rd['name'], rd['memory_per_node'])
+                      for rd in data['runs'] if rd.get('memory_per_node'))
+        resources = layout_resources(data['total_nodes'],
+                                     data.get('node_layout'), memory)
+        return cls(str(data['id']), data['total_nodes'], data['working_dir'],
+                   runs, file_path, offset, resources, group)
+
+    def get_nodes_used(self):
+        return self.total_nodes
+
+    def get_resources(self):
+        return self.resources
+
+    def set_ppn(self, ppn):
+        """Save ppn, to be set on the Pipeline when it is loaded."""
+        self.ppn = ppn
+
+    def resume(self, succeeded):
+        """Save the names of the runs that succeeded in an earlier job, to
+        be resumed when the Pipeline is loaded."""
+        self.succeeded_runs = list(succeeded)
+
+    def get_state(self):
+        # keep the succeeded runs, in case the job ends before the pipeline
+        # is started
+        runs = dict((name, REASON_SUCCEEDED)
+                    for name in self.succeeded_runs or [])
+        return PipelineState(self.id, NOT_STARTED, runs=runs)
+
+    def load(self):
+        """Create the Pipeline. Returns None if the pipeline data is not
+        valid, like Pipeline.from_data."""
+        pipeline = Pipeline.from_data(read_fob_at(self.file_path,
+                                                  self.offset), self.group)
+        if pipeline is not None and self.ppn is not None:
+            pipeline.set_ppn(self.ppn)
+        if pipeline is not None and self.succeeded_runs:
+            pipeline.resume(self.succeeded_runs)
+        return pipeline
+
+
+class RunSummary(object):
+    """The run attributes of a pipeline that are used for walltime
+    estimates before the pipeline is loaded."""
+
+    __slots__ = ('name', 'timeout', 'sleep_after', 'depends_on_runs')
+
+    def __init__(self, name, timeout, sleep_after, depends_on_runs):
+        self.name = name
+        self.timeout = timeout
+        self.sleep_after = sleep_after
+        self.depends_on_runs = depends_on_runs
+
+    @classmethod
+    def list_from_data(cls, runs_data):
+        """Returns None if a run depends on a run that doesn't exist."""
+        runs = [cls(rd['name'], rd.get('timeout'), rd.get('sleep_after'),
+                    rd.get('after_rc_done')) for rd in runs_data]
+        runs_by_name = dict((run.name, run) for run in runs)
+        for run in runs:
+            names = run.depends_on_runs or []
+            if isinstance(names, str):
+                names = [names]
+            if any(name not in runs_by_name for name in names):
+                return None
+            run.depends_on_runs = [runs_by_name[name] for name in names]
+        return runs
+
+
+class AdaptiveProducer(object):
+    """Base class for producers that choose the pipelines to run from the
+    results of the pipelines that are done, in the same savanna job.
+
+    Subclasses implement initial_pipelines and pipeline_done, which return
+    lists of pipelines to add to the consumer, as Pipeline or
+    PipelineDescriptor objects or dicts in the fobs format. run is called
+    in the main thread once the consumer is running, and returns when none
+    of the pipelines added are left and pipeline_done did not add more, or
+    when the consumer is killed. The methods are only called from the
+    thread calling run, so subclasses don't need locking.
+
+    input_file is the producer input file, e.g. a fobs file with the
+    candidate pipelines, see read_candidates, and options is a dict of
+    options given on the command line."""
+
+    def __init__(self, input_file=None, options=None):
+        self.input_file = input_file
+        self.options = dict(options or {})
+        self._events = queue.Queue()
+        # ids of the pipelines added that are not done
+        self._outstanding = set()
+
+    def initial_pipelines(self):
+        """Get the pipelines to start with."""
+        raise NotImplementedError()
+
+    def pipeline_done(self, pipeline, state):
+        """Called when a pipeline added by the producer is done, or was
+        removed from the queue without being run, e.g. because it would not
+        be done before the deadline. state is its final PipelineState.
+        Returns the pipelines to add."""
+        return []
+
+    def pipeline_not_queued(self, pipe_id):
+        """Called when a pipeline returned by the producer was not added
+        to the queue, because it does not fit on the nodes of the job or
+        can't be loaded. It will not be run, and pipeline_done is not
+        called for it. Returns the pipelines to add."""
+        return []
+
+    def run(self, consumer):
+        consumer.add_done_callback(
+            lambda pipeline, state: self._events.put((pipeline, state)))
+        if not self._add(consumer, self.initial_pipelines()):
+            return
+        while self._outstanding:
+            try:
+                pipeline, state = self._events.get(
+                                        timeout=ADAPTIVE_POLL_INTERVAL)
+            except queue.Empty:
+                if consumer.killed:
+                    return
+                continue
+            if pipeline.id not in self._outstanding:
+                continue
+            self._outstanding.remove(pipeline.id)
+            if not self._add(consumer, self.pipeline_done(pipeline, state)):
+                return
+
+    def _add(self, consumer, pipelines):
+        """Add pipelines to the consumer, and the pipelines returned by
+        pipeline_not_queued for the ones that are not queued. Returns False
+        if the consumer does not accept new pipelines."""
+        pending = list(pipelines or [])
+        while pending:
+            pipeline = pending.pop(0)
+            if isinstance(pipeline, dict):
+                pipe_id = pipeline.get('id')
+                pipeline = Pipeline.from_data(pipeline)
+                if pipeline is None:
+                    _log.warning("producer: pipeline %s can't be loaded, "
+                                 "not running it", pipe_id)
+                    pending.extend(self.pipeline_not_queued(pipe_id) or [])
+                    continue
+            try:
+                queued = consumer.add_pipeline(pipeline)
+            except ValueError as e:
+                _log.warning("producer stopped: %s", e)
+                return False
+            if queued:
+                self._outstanding.add(pipeline.id)
+            else:
+                pending.extend(self.pipeline_not_queued(pipeline.id) or [])
+        return True
+
+    def read_candidates(self):
+        """Get the pipelines in the input file, including the ones that are
+        done, and a dict of pipeline id to state data from the status file
+        of the group."""
+        candidates = []
+        for offset, data in read_fobs(self.input_file):
+            if offset is None or data.get('total_nodes') is None:
+                pipeline = Pipeline.from_data(data)
+            else:
+                pipeline = PipelineDescriptor.from_data(data, self.input_file,
+                                                        offset)
+            if pipeline is not None:
+                candidates.append(pipeline)
+        status_file = os.path.join(os.path.dirname(self.input_file),
+                                   'codar.workflow.status.json')
+        return candidates, load_workflow_status(status_file)
+
+
+class SuccessiveHalvingProducer(AdaptiveProducer):
+    """Random search with successive halving over the pipelines of a fobs
+    file, e.g. a sweep group where one parameter sets the budget of each
+    run, like a number of iterations or a problem size.
+
+    A random sample of the configurations, i.e. the parameter values other
+    than the budget, is run with the smallest budget. When all of them are
+    done, the best 1/eta of them according to the metric are run with the
+    next budget, and so on until the largest budget. Pipelines that failed
+    or did not report the metric are dropped. Pipelines done in an earlier
+    job are not run again, their results are reused.
+
+    Options:
+      metric    key of the metric in cheetah_user_report.json (required)
+      budget    parameter that sets the budget, as "code.param" (required)
+      mode      "min" or "max", whether lower or higher metric is better,
+                default "min"
+      eta       only the best 1/eta of the configurations go on to the
+                next budget, default 3
+      initial   number of configurations run with the smallest budget,
+                default all
+      seed      random seed for the sample"""
+
+    def __init__(self, input_file=None, options=None):
+        AdaptiveProducer.__init__(self, input_file, options)
+        for name in ('metric', 'budget'):
+            if name not in self.options:
+                raise ValueError("successive halving requires the '%s' "
+                                 "option" % name)
+        self.metric = self.options['metric']
+        self.budget_code, _, self.budget_param = \
+            self.options['budget'].partition('.')
+        self.mode = self.options.get('mode', 'min')
+        if self.mode not in ('min', 'max'):
+            raise ValueError("mode must be 'min' or 'max'")
+        self.eta = self.options.get('eta', 3)
+        if self.eta <= 1:
+            raise ValueError('eta must be greater than 1')
+        self._random = random.Random(self.options.get('seed'))
+        # config key -> { budget: pipeline }, and the sorted budgets
+        self._configs = {}
+        self.budgets = []
+        # index in budgets of the current step, the configs still running
+        # in it, and the metric of the configs that are done
+        self.step = 0
+        self._running = {}
+        self._results = {}
+        self._done_states = {}
+
+    def initial_pipelines(self):
+        candidates, self._done_states = self.read_candidates()
+        budgets = set()
+        for pipeline in candidates:
+            params = _read_run_params(pipeline.working_dir)
+            try:
+                budget = params[self.budget_code].pop(self.budget_param)
+            except (KeyError, TypeError, AttributeError):
+                _log.warning("pipeline %s has no budget parameter %s.%s, "
+                             "skipping", pipeline.id, self.budget_code,
+                             self.budget_param)
+                continue
+            key = json.dumps(params, sort_keys=True)
+            self._configs.setdefault(key, {})[budget] = pipeline
+            budgets.add(budget)
+        self.budgets = sorted(budgets)
+        if not self.budgets:
+            _log.warning("no pipelines to run in %s", self.input_file)
+            return []
+        first = self.budgets[0]
+        keys = sorted(key for key, pipes in self._configs.items()
+                      if first in pipes)
+        n = self.options.get('initial', len(keys))
+        keys = self._random.sample(keys, min(n, len(keys)))
+        _log.info("successive halving: %d configurations, budgets %s",
+                  len(keys), self.budgets)
+        return self._start_step(keys)
+
+    def pipeline_done(self, pipeline, state):
+        key = self._running.pop(pipeline.id, None)
+        if key is None:
+            return []
+        return self._config_done(key, self._read_metric(
+                                    pipeline, state.state, state.reason))
+
+    def pipeline_not_queued(self, pipe_id):
+        # counted as failed, like a pipeline that did not report the metric
+        key = self._running.pop(pipe_id, None)
+        if key is None:
+            return []
+        return self._config_done(key, None)
+
+    def _config_done(self, key, metric):
+        """Save the result of a config in the current step, and start the
+        next step if it was the last one running."""
+        self._results[key] = metric
+        if self._running:
+            return []
+        return self._next_step()
+
+    def _start_step(self, keys):
+        """Get the pipelines to run for the configs in the current step.
+        The ones that are already done are not run again."""
+        budget = self.budgets[self.step]
+        self._running = {}
+        self._results = {}
+        pipelines = []
+        for key in keys:
+            pipeline = self._configs[key].get(budget)
+            if pipeline is None:
+                continue
+            done = self._done_states.get(pipeline.id, {})
+            if done.get('state') == DONE:
+                self._results[key] = self._read_metric(
+                            pipeline, done.get('state'), done.get('reason'))
+            else:
+                self._running[pipeline.id] = key
+                pipelines.append(pipeline)
+        if not self._running:
+            return self._next_step()
+        return pipelines
+
+    def _next_step(self):
+        ranked = sorted((metric, key) for key, metric
+                        in self._results.items() if metric is not None)
+        if self.mode == 'max':
+            ranked.reverse()
+        _log.info("successive halving: budget %s done, %d of %d "
+                  "configurations reported %s", self.budgets[self.step],
+                  len(ranked), len(self._results), self.metric)
+        if ranked:
+            _log.info("successive halving: best %s %s with %s", self.metric,
+                      ranked[0][0], ranked[0][1])
+        if self.step + 1 >= len(self.budgets) or not ranked:
+            return []
+        self.step += 1
+        # failed configurations count towards the size of the step, so they
+        # don't let worse configurations through
+        keep = max(1, int(len(self._results) / self.eta))
+        return self._start_step([key for _, key in ranked[:keep]])
+
+    def _read_metric(self, pipeline, state, reason):
+        """Get the metric reported by a pipeline, or None if it failed or
+        the metric is missing."""
+        if state != DONE or reason != REASON_SUCCEEDED:
+            return None
+        report = read_user_report(pipeline.working_dir)
+        try:
+            return float(report[self.metric])
+        except (TypeError, KeyError, ValueError):
+            _log.warning("pipeline %s did not report %s", pipeline.id,
+                         self.metric)
+            return None
+
+
+def read_user_report(working_dir):
+    """Get the results in the user report of a pipeline, or None if it
+    can't be read."""
+    try:
+        with open(os.path.join(working_dir, USER_REPORT_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_run_params(working_dir):
+    try:
+        with open(os.path.join(working_dir, RUN_PARAMS_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_producer_class(spec):
+    """Load an AdaptiveProducer subclass given as "module:Class", where
+    module is a module name or the path of a python file. Raises ValueError
+    if it can't be loaded."""
+    module_name, _, class_name = spec.rpartition(':')
+    if not module_name or not class_name:
+        raise ValueError("producer plugin must be 'module:Class', got '%s'"
+                         % spec)
+    try:
+        if module_name.endswith('.py'):
+            path = os.path.abspath(module_name)
+            name = os.path.splitext(os.path.basename(path))[0]
+            module_spec = importlib.util.spec_from_file_location(name, path)
+            if module_spec is None:
+                raise ImportError('not a python module: %s' % path)
+            module = importlib.util.module_from_spec(module_spec)
+            module_spec.loader.exec_module(module)
+        else:
+            module = importlib.import_module(module_name)
+        cls = getattr(module, class_name)
+    except (ImportError, OSError, AttributeError) as e:
+        raise ValueError("failed to load producer plugin '%s': %s"
+                         % (spec, e))
+    if not (isinstance(cls, type) and issubclass(cls, AdaptiveProducer)):
+        raise ValueError("producer plugin '%s' is not an AdaptiveProducer"
+                         % spec)
+    return cls
@@ -0,0 +1,165 @@
+import os
+import json
+
+from codar.savanna.producer import read_fobs, read_fob_at, \
+    JSONFilePipelineReader, PipelineDescriptor, SuccessiveHalvingProducer
+from codar.savanna.status import PipelineState, DONE, REASON_SUCCEEDED, \
+    REASON_FAILED
+
+
+def _fob(i):
+    wd = '/tmp/run-%d' % i
+    return dict(id='run-%d' % i, working_dir=wd, apps_dir='/usr/bin',
+                machine_name='local',
+                total_nodes=i + 1, node_layout=[{'sim': 1}, {'ana': 1}],
+                runs=[dict(name='sim', exe='true', args=[], sched_args=None,
+                           nprocs=1, timeout=10, sleep_after=1),
+                      dict(name='ana', exe='true', args=[], sched_args=None,
+                           nprocs=1, timeout=5, after_rc_done='sim')])
+
+
+def test_read_fobs_one_per_line(tmp_path):
+    path = str(tmp_path / 'fobs.json')
+    with open(path, 'w') as f:
+        f.write('[\n' + ',\n'.join(json.dumps(_fob(i)) for i in range(3))
+                + '\n]\n')
+
+    fobs = list(read_fobs(path))
+    assert [data['id'] for _, data in fobs] == ['run-0', 'run-1', 'run-2']
+    for offset, data in fobs:
+        assert read_fob_at(path, offset) == data
+
+    pipelines = list(JSONFilePipelineReader(path).read_pipelines())
+    assert all(isinstance(p, PipelineDescriptor) for p in pipelines)
+    assert [p.get_nodes_used() for p in pipelines] == [1, 2, 3]
+    assert pipelines[1].runs[1].depends_on_runs == [pipelines[1].runs[0]]
+
+    pipeline = pipelines[2].load()
+    assert pipeline.id == 'run-2'
+    assert [run.name for run in pipeline.runs] == ['sim', 'ana']
+
+
+def test_read_fobs_old_format(tmp_path):
+    path = str(tmp_path / 'fobs.json')
+    with open(path, 'w') as f:
+        json.dump([_fob(i) for i in range(2)], f, indent=4)
+    assert list(read_fobs(path)) == [(None, _fob(0)), (None, _fob(1))]
+
+
+def test_resume_succeeded_runs(tmp_path):
+    path = str(tmp_path / 'fobs.json')
+    fobs = [_fob(i) for i in range(3)]
+    # viz runs after sim, at the same time as ana
+    fobs[2]['runs'].append(dict(name='viz', exe='true', args=[],
+                                sched_args=None, nprocs=1,
+                                after_rc_done='sim'))
+    with open(path, 'w') as f:
+        f.write('[\n' + ',\n'.join(json.dumps(fob) for fob in fobs)
+                + '\n]\n')
+    with open(str(tmp_path / 'codar.workflow.status.json'), 'w') as f:
+        json.dump({'run-0': dict(state='done', reason='succeeded'),
+                   'run-1': dict(state='killed',
+                                 runs=dict(sim='succeeded', ana='killed')),
+                   'run-2': dict(state='killed',
+                                 runs=dict(sim='succeeded', ana='failed',
+                                           viz='succeeded'))}, f)
+
+    pipelines = list(JSONFilePipelineReader(path).read_pipelines())
+    assert [p.id for p in pipelines] == ['run-1', 'run-2']
+    assert pipelines[0].get_state().as_data()['runs'] == dict(sim='succeeded')
+
+    run1 = pipelines[0].load()
+    assert [run.resumed for run in run1.runs] == [True, False]
+    assert run1.runs[0].get_returncode() == 0
+
+    # sim can be skipped since ana waits for it, but viz may be coupled
+    # with ana so it is launched again
+    run2 = pipelines[1].load()
+    assert [run.name for run in run2.runs if run.resumed] == ['sim']
+    assert run2.get_state().as_data()['runs'] == dict(sim='succeeded')
+
+
+class _InstantConsumer(object):
+    """Consumer that finishes pipelines as soon as they are added. The
+    metric of each pipeline is its x parameter, and it fails if fail is
+    true for it. Pipelines with ids in nofit are not queued."""
+
+    killed = False
+
+    def __init__(self, fail=lambda params: False, nofit=()):
+        self.fail = fail
+        self.nofit = nofit
+        self.added = []
+        self._callbacks = []
+
+    def add_done_callback(self, fn):
+        self._callbacks.append(fn)
+
+    def add_pipeline(self, pipeline):
+        if pipeline.id in self.nofit:
+            return False
+        self.added.append(pipeline.id)
+        with open(os.path.join(pipeline.working_dir,
+                               'codar.cheetah.run-params.json')) as f:
+            params = json.load(f)['sim']
+        reason = REASON_FAILED if self.fail(params) else REASON_SUCCEEDED
+        with open(os.path.join(pipeline.working_dir,
+                               'cheetah_user_report.json'), 'w') as f:
+            json.dump(dict(error=params['x']), f)
+        for fn in self._callbacks:
+            fn(pipeline, PipelineState(pipeline.id, DONE, reason))
+        return True
+
+
+def test_successive_halving(tmp_path):
+    path = str(tmp_path / 'fobs.json')
+    with open(path, 'w') as f:
+        for x in range(9):
+            for steps in (1, 10, 100):
+                fob = _fob(0)
+                fob['id'] = 'x%d-steps%d' % (x, steps)
+                fob['working_dir'] = str(tmp_path / fob['id'])
+                os.mkdir(fob['working_dir'])
+                with open(os.path.join(fob['working_dir'],
+                          'codar.cheetah.run-params.json'), 'w') as pf:
+                    json.dump(dict(sim=dict(x=x, steps=steps)), pf)
+                f.write(json.dumps(fob) + '\n')
+    with open(str(tmp_path / 'codar.workflow.status.json'), 'w') as f:
+        json.dump({'x4-steps1': dict(state='done', reason='succeeded')}, f)
+    with open(str(tmp_path / 'x4-steps1' / 'cheetah_user_report.json'),
+              'w') as f:
+        json.dump(dict(error=0.5), f)
+
+    # the best third of the configurations go on to the next budget, the
+    # pipelines already done are not run again, and failed ones are
+    # dropped
+    consumer = _InstantConsumer(lambda params: params['x'] == 0)
+    producer = SuccessiveHalvingProducer(
+                        path, dict(metric='error', budget='sim.steps'))
+    producer.run(consumer)
+    assert sorted(consumer.added) == sorted(
+        ['x%d-steps1' % x for x in range(9) if x != 4]
+        + ['x4-steps10', 'x1-steps10', 'x2-steps10', 'x1-steps100'])
+    assert producer.budgets == [1, 10, 100]
+    assert producer.step == 2
+
+    # with a sample of the configurations and higher is better
+    consumer = _InstantConsumer()
+    producer = SuccessiveHalvingProducer(
+                        path, dict(metric='error', budget='sim.steps',
+                                   mode='max', initial=4, eta=2, seed=1))
+    producer.run(consumer)
+    assert sorted(consumer.added) == sorted(
+        ['x0-steps1', 'x1-steps1', 'x2-steps1', 'x8-steps1',
+         'x2-steps10', 'x8-steps10', 'x8-steps100'])
+
+    # pipelines that are not queued are dropped like failed ones, and the
+    # search goes on
+    consumer = _InstantConsumer(nofit=('x5-steps1', 'x1-steps10'))
+    producer = SuccessiveHalvingProducer(
+                        path, dict(metric='error', budget='sim.steps'))
+    producer.run(consumer)
+    assert sorted(consumer.added) == sorted(
+        ['x%d-steps1' % x for x in range(9) if x not in (4, 5)]
+        + ['x4-steps10', 'x0-steps10', 'x0-steps100'])
+    assert producer.step == 2
@@ -0,0 +1,296 @@
+"""
+Event loop that monitors all processes launched by savanna, so the number of
+threads does not grow with the number of concurrent runs.
+
+A single reaper thread waits on pidfds (Linux >= 5.3) of the launched
+processes and the other members of their process groups, or polls the
+launched processes if pidfds are not available, and runs timers for
+run timeouts, kill escalation and the delays between launching runs. Work
+that may block, like launching processes, writing result files and executing
+the Run and Pipeline callbacks, is handed to a fixed size pool of worker
+threads.
+
+Timer functions are executed in the reaper thread and must not block. They
+can hand off slow work with submit.
+"""
+
+import os
+import ctypes
+import heapq
+import functools
+import itertools
+import selectors
+import threading
+import logging
+import time
+import queue
+
+import psutil
+
+
+WORKER_THREADS = 16
+
+# Interval for checking processes when pidfds are not supported
+POLL_INTERVAL = 0.5
+
+
+_log = logging.getLogger('codar.savanna.reaper')
+
+
+class TimerHandle(object):
+    """Returned by ProcessReaper.call_later, can be used to cancel the
+    timer before it fires."""
+    def __init__(self, when, fn, args):
+        self.when = when
+        self._fn = fn
+        self._args = args
+        self._cancelled = False
+        self._fired = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    @property
+    def fired(self):
+        """True if the timer function has been called."""
+        return self._fired
+
+    def _run(self):
+        if not self._cancelled:
+            self._fired = True
+            self._fn(*self._args)
+
+
+class ProcessReaper(object):
+    def __init__(self, workers=WORKER_THREADS):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._timers = []
+        self._seq = itertools.count()
+        # (pidfd, ready function) pairs and (popen, callback) pairs that
+        # are waiting to be registered by the reaper thread. Processes
+        # are polled if pidfd_open is not supported.
+        self._new_watches = []
+        self._new_polls = []
+        self._polled = {}
+        self._workers = WorkerPool(workers, 'Thread-reaper-worker')
+
+    def watch_process(self, popen, callback):
+        """Call callback(popen) in a worker thread once the process has
+        exited. The process is reaped by the reaper, so popen.returncode
+        is set when the callback is executed."""
+        try:
+            pidfd = os.pidfd_open(popen.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        with self._lock:
+            if pidfd is None:
+                self._new_polls.append((popen, callback))
+            else:
+                ready = functools.partial(self._reap, popen, callback)
+                self._new_watches.append((pidfd, ready))
+        self._wakeup()
+
+    def watch_pid(self, pid, callback):
+        """Call callback(pid) in a worker thread once the process with the
+        given pid has exited. The process is not reaped, so this can be used
+        for processes that are not children of savanna. Returns False if
+        the process can't be watched because pidfds are not supported, in
+        which case callback will not be called."""
+        try:
+            pidfd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            self.submit(callback, pid)
+            return True
+        except (AttributeError, OSError):
+            return False
+        with self._lock:
+            self._new_watches.append(
+                (pidfd, functools.partial(self.submit, callback, pid)))
+        self._wakeup()
+        return True
+
+    def call_later(self, delay, fn, *args):
+        """Call fn(*args) in the reaper thread after delay seconds. Returns
+        a TimerHandle that can be used to cancel the call."""
+        handle = TimerHandle(time.time() + delay, fn, args)
+        with self._lock:
+            heapq.heappush(self._timers, (handle.when, next(self._seq),
+                                          handle))
+        self._wakeup()
+        return handle
+
+    def submit(self, fn, *args):
+        """Execute fn(*args) in the worker pool."""
+        self._workers.submit(fn, *args)
+
+    def _wakeup(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='Thread-reaper',
+                                                daemon=True)
+                self._thread.start()
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            # pipe is full, so the reaper will wake up anyway
+            pass
+
+    def _run(self):
+        while True:
+            due = []
+            with self._lock:
+                new_watches = self._new_watches
+                self._new_watches = []
+                self._polled.update(self._new_polls)
+                self._new_polls = []
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    due.append(heapq.heappop(self._timers)[2])
+                timeout = None
+                if self._timers:
+                    timeout = max(0, self._timers[0][0] - now)
+
+            for pidfd, ready in new_watches:
+                self._selector.register(pidfd, selectors.EVENT_READ, ready)
+
+            for handle in due:
+                try:
+                    handle._run()
+                except Exception:
+                    _log.exception('exception in reaper timer')
+
+            if due or new_watches:
+                # timers may have added new work, recompute the timeout
+                continue
+
+            if self._polled:
+                timeout = POLL_INTERVAL if timeout is None \
+                          else min(timeout, POLL_INTERVAL)
+
+            for key, _ in self._selector.select(timeout):
+                if key.fileobj == self._wakeup_r:
+                    self._drain_wakeup()
+                else:
+                    self._selector.unregister(key.fileobj)
+                    os.close(key.fileobj)
+                    key.data()
+
+            for popen, callback in list(self._polled.items()):
+                if popen.poll() is not None:
+                    del self._polled[popen]
+                    self.submit(callback, popen)
+
+    def _reap(self, popen, callback):
+        if popen.poll() is None:
+            # pidfd readable means the process exited, but the status may
+            # not be available yet if another thread is waiting on it
+            self._polled[popen] = callback
+        else:
+            self.submit(callback, popen)
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+class WorkerPool(object):
+    """Fixed size pool of daemon threads executing submitted functions in
+    order. Unlike concurrent.futures, work can still be submitted while the
+    interpreter is waiting for non-daemon threads to exit, which is how the
+    savanna main program waits for the consumer thread."""
+
+    def __init__(self, size, name):
+        self.size = size
+        self.name = name
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, fn, *args):
+        self._queue.put((fn, args))
+        with self._lock:
+            if len(self._threads) < self.size:
+                t = threading.Thread(target=self._work, daemon=True,
+                                     name='%s-%d' % (self.name,
+                                                     len(self._threads)))
+                self._threads.append(t)
+                t.start()
+
+    def _work(self):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn(*args)
+            except Exception:
+                _log.exception('exception in %s', self.name)
+
+
+PR_SET_CHILD_SUBREAPER = 36
+
+
+def set_child_subreaper():
+    """Make this process the subreaper for its descendants, so processes
+    that are orphaned when a launcher exits become children of savanna
+    instead of init, and can be reaped as soon as they exit (see
+    reap_pgroup). Linux only, returns False if it could not be set."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+def reap_pgroup(pgid):
+    """Reap exited children in the process group. Must only be called
+    when the Popen for the group leader, if any, has already been reaped."""
+    while True:
+        try:
+            pid, _ = os.waitpid(-pgid, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+def pgroup_members(pgids):
+    """Get a dict of pgid -> [pid, ...] for the processes in the given
+    process groups."""
+    members = {}
+    if not pgids:
+        return members
+    for pid in psutil.pids():
+        try:
+            pgid = os.getpgid(pid)
+        except OSError:
+            # process exited
+            continue
+        if pgid in pgids:
+            members.setdefault(pgid, []).append(pid)
+    return members
+
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def get_reaper():
+    """Get the process wide reaper instance, creating it if needed."""
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = ProcessReaper()
+        return _reaper
@@ -0,0 +1,55 @@
+import threading
+import subprocess
+
+import pytest
+
+from codar.savanna.reaper import ProcessReaper
+
+
+def test_watch_process():
+    reaper = ProcessReaper(workers=2)
+    done = threading.Event()
+    returncodes = []
+
+    def exited(popen):
+        returncodes.append(popen.returncode)
+        done.set()
+
+    p = subprocess.Popen(['sh', '-c', 'exit 3'])
+    reaper.watch_process(p, exited)
+    assert done.wait(5)
+    assert returncodes == [3]
+
+
+def test_watch_pid():
+    reaper = ProcessReaper(workers=2)
+    done = threading.Event()
+    pids = []
+
+    def exited(pid):
+        pids.append(pid)
+        done.set()
+
+    p = subprocess.Popen(['sleep', '0.2'])
+    try:
+        if not reaper.watch_pid(p.pid, exited):
+            pytest.skip('pidfds not supported')
+        assert done.wait(5)
+        assert pids == [p.pid]
+    finally:
+        p.wait()
+
+
+def test_call_later():
+    reaper = ProcessReaper(workers=2)
+    done = threading.Event()
+    calls = []
+    reaper.call_later(0.2, calls.append, 'b')
+    cancelled = reaper.call_later(0.1, calls.append, 'cancelled')
+    first = reaper.call_later(0.05, calls.append, 'a')
+    reaper.call_later(0.3, done.set)
+    cancelled.cancel()
+    assert done.wait(5)
+    assert calls == ['a', 'b']
+    assert first.fired
+    assert cancelled.cancelled and not cancelled.fired
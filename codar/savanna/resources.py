@@ -0,0 +1,69 @@
+"""
+Resource vectors used to decide which pipelines fit on the free part of the
+job. A pipeline needs a number of nodes, and on each of them a number of
+process slots (cpus), GPUs and memory in MB. These are derived from the node
+layout: NodeConfig layouts map ranks to cpus and GPUs, dict layouts give the
+processes of each code on a node, and the codes can declare how much memory
+they need per node with the memory_per_node code option in Cheetah.
+
+A cpus value of None means the pipeline needs all the cpus of its nodes,
+which is the case when there is no node layout. A capacity of None means the
+resource is not tracked, e.g. if the GPUs per node of the machine are not
+known.
+"""
+
+from collections import namedtuple
+
+
+class Resources(namedtuple('Resources', ['nodes', 'cpus', 'gpus', 'memory'])):
+    """Number of nodes, and cpus, gpus and memory needed on each node."""
+
+    __slots__ = ()
+
+    def per_node(self, capacity):
+        """Get the (cpus, gpus, memory) tuple used on each node, given the
+        (cpus, gpus, memory) capacity of a node. Untracked resources are 0."""
+        cpus = self.cpus if self.cpus is not None else capacity[0]
+        return tuple(0 if cap is None else used
+                     for used, cap in zip((cpus, self.gpus, self.memory),
+                                          capacity))
+
+    def fits_node(self, capacity):
+        """True if the per node resources fit on an empty node with the
+        given (cpus, gpus, memory) capacity."""
+        return all(cap is None or used <= cap
+                   for used, cap in zip(self.per_node(capacity), capacity))
+
+
+def layout_resources(nodes, node_layout, memory_per_node=None):
+    """Get the Resources for a pipeline using the given number of nodes.
+    node_layout is the layout data from the fobs file, or None, and
+    memory_per_node is a dict of code name -> MB per node for the codes
+    that declare it. Codes that are not in the layout are counted on every
+    node."""
+    memory_per_node = memory_per_node or {}
+    if not node_layout:
+        return Resources(nodes, None, 0, sum(memory_per_node.values()))
+
+    cpus = gpus = memory = 0
+    in_layout = set()
+    for node in node_layout:
+        if node.get('__info_type__') == 'NodeConfig':
+            codes = set(rank.split(':')[0] for rank in node.get('cpu', [])
+                        if rank is not None)
+            node_cpus = len([rank for rank in node.get('cpu', [])
+                             if rank is not None])
+            node_gpus = len([ranks for ranks in node.get('gpu', [])
+                             if ranks])
+        else:
+            codes = set(node.keys())
+            node_cpus = sum(node.values())
+            node_gpus = 0
+        in_layout.update(codes)
+        cpus = max(cpus, node_cpus)
+        gpus = max(gpus, node_gpus)
+        memory = max(memory, sum(memory_per_node.get(code, 0)
+                                 for code in codes))
+    memory += sum(mem for code, mem in memory_per_node.items()
+                  if code not in in_layout)
+    return Resources(nodes, cpus, gpus, memory)
@@ -1,6 +1,7 @@
 """
-Classes for tracking pipelines and the runs within each pipeline in separate
-monitor threads that synchronize state.
+Classes for tracking pipelines and the runs within each pipeline. Processes
+are monitored by the shared reaper (see reaper.py), and run state changes
+are handled in its worker threads, so state is synchronized with locks.
 
 Note that there is state tracked in these classes which is not available just
 by looking at the return code. In particular, a run my be killed for several
@@ -37,12 +38,13 @@ This approach ensures that env vars can be set per app in MPMD mode.
 import time
 import subprocess
 import os
-import shutil
 import math
+import functools
 import threading
 import signal
 import logging
 import json
+import sqlite3
 import warnings
 from queue import Queue
 import psutil
@@ -51,30 +53,39 @@ from pathlib import Path
 import stat
 
 from codar.savanna import tau, status, machines, summit_helper, \
-    deepthought2_helper
+    deepthought2_helper, trace
 from codar.savanna.error_messages import err_msg
 from codar.savanna.exc import SavannaException
 from codar.savanna.node_layout import NodeLayout, NodeConfig
-from codar.savanna.utils import get_path, STDOUT_NAME, STDERR_NAME, \
-    WALLTIME_NAME, RETURN_NAME
+from codar.savanna.utils import get_path, find_exe, STDOUT_NAME, \
+    STDERR_NAME, WALLTIME_NAME, RETURN_NAME, USAGE_NAME
 from codar.savanna.templates import EXE_LAUNCH_FILE_TEMPLATE
 from codar.savanna.tau import Tau
+from codar.savanna.reaper import get_reaper, reap_pgroup, pgroup_members
+from codar.savanna.environment import RUN_ENVIRON_NAME
+from codar.savanna.logs import log_fields
+from codar.savanna.capture import CAPTURE_SUFFIX
 
 
-RUN_ENVIRON_NAME = '.codar.savanna.{}.environment.json'
 EXE_INFO_FNAME = '.codar.savanna.{}.exe.info.txt'
 
 KILL_WAIT = 30
 WAIT_DELAY_KILL = 30
 WAIT_DELAY_GIVE_UP = 120
 
+# Interval for checking that the process group still exists, in case member
+# exits are not notified. Doubles after each check up to the max.
+PGROUP_POLL_MIN = 0.1
+PGROUP_POLL_MAX = 5
+
 
 _log = logging.getLogger('codar.savanna.run')
 
-class Run(threading.Thread):
+class Run(object):
     """Manage running a single executable within a pipeline. When start is
-    called, it will launch the process with Popen and call wait in the new
-    thread with a timeout, killing if the process does not finish in time."""
+    called, it will launch the process with Popen in a reaper worker thread,
+    once the run it depends on (if any) is done. The reaper notifies the run
+    when the process exits, and kills it if it does not finish in time."""
     def __init__(self, name, exe, args, sched_args, env,
                  user_env_file, working_dir, apps_dir,
                  machine, timeout=None, nprocs=1, res_set=None,
@@ -83,8 +94,8 @@ class Run(threading.Thread):
                  log_prefix=None, sleep_after=None,
                  depends_on_runs=None, hostfile=None,
                  runner_override=False,
-                 tau_profiling=False, tau_tracing=False, tau_exec='tau_exec'):
-        threading.Thread.__init__(self, name="Thread-Run-" + name)
+                 tau_profiling=False, tau_tracing=False, tau_exec='tau_exec',
+                 exe_pinned=False, memory_per_node=None):
         self.name = name
         self.exe = exe
         self.args = args
@@ -97,13 +108,16 @@ class Run(threading.Thread):
         self.machine = machine
         self.timeout = timeout
         self.nprocs = nprocs
+        # MB needed on each node, used by the consumer to place pipelines
+        self.memory_per_node = memory_per_node
 
         # A script to export user-defined env vars and call the app without
         # any scheduler args. This is the leaf node in the script invokations.
         self.app_sh = None
 
-        # Get the path to the exe
-        self._find_exe()
+        # Get the path to the exe, unless Cheetah already resolved it
+        if not exe_pinned:
+            self._find_exe()
 
         # Check tau options and set self.exe to tau_exec
         self.tau_profiler = None
@@ -124,12 +138,17 @@ class Run(threading.Thread):
                                     name, return_path)
         self.walltime_path = get_path(working_dir, WALLTIME_NAME + "." +
                                       name, walltime_path)
+        self.usage_path = os.path.join(working_dir,
+                                       USAGE_NAME + "." + name + ".csv")
         self.sleep_after = sleep_after
         self._p = None
         self._pgid = None
         self._open_files = []
 
         self._start_time = None
+        # times for the trace timeline, see trace.py
+        self._wait_time = None
+        self._exit_time = None
 
         self._state_lock = threading.Lock()
         self._end_time = None # if set, run is done
@@ -140,18 +159,63 @@ class Run(threading.Thread):
 
         self._exception = False # or python exception in run method
 
+        # Set by the Pipeline if the run succeeded in an earlier job, in
+        # which case it is marked done without being launched again
+        self.resumed = False
+
         self.log_prefix = log_prefix or name
         self.runner = None
+
+        # Set by the Pipeline. If there is no environment store, the full
+        # environment is written to the working dir.
+        self.pipeline_id = None
+        # id of the pipeline in its sweep group, see Pipeline.local_id
+        self.local_pipeline_id = None
+        self.environment_store = None
+        self._env_snapshot = None
+        # Set by the Pipeline if results are saved in the metadata store of
+        # the group, see metadata.py
+        self.metadata_store = None
+        # Set by the Pipeline if resource usage sampling is enabled
+        self.usage_sampler = None
+        # Set by the Pipeline if output capture is enabled, see capture.py
+        self.output_collector = None
+        self._captures = []
+        self._captures_pending = 0
         self.callbacks = set()
 
-        self._kill_thread = None
+        # Set when the run is done and callbacks have been executed. Runs
+        # that depend on this run are started by the done waiters.
+        self._done = threading.Event()
+        self._done_waiters = []
+
+        # reaper timers for the run timeout and SIGKILL after SIGTERM
+        self._timeout_timer = None
+        self._kill_timer = None
+
+        # state for waiting on the process group after the launched
+        # process exits, protected by _pgroup_lock
+        self._pgroup_lock = threading.Lock()
+        self._pgroup_done = False
+        self._pgroup_check_pending = False
+        self._pgroup_kill_sent = False
+        self._pgroup_watched = set()
+        self._pgroup_poll_delay = PGROUP_POLL_MIN
+        self._pgroup_timers = []
 
         # calculated by Pipeline based on node layout
         self.nodes = None
         self.tasks_per_node = None
 
-        # Get a list of runs that self depends on
-        self.depends_on_runs = depends_on_runs
+        # Get a list of runs that self depends on. Initially a list of run
+        # names (a single name is also accepted), which Pipeline replaces
+        # with the Run objects.
+        if depends_on_runs is None:
+            depends_on_runs = []
+        elif isinstance(depends_on_runs, str):
+            depends_on_runs = [depends_on_runs]
+        self.depends_on_runs = list(depends_on_runs)
+        self._parents_pending = 0
 
         # mpi hostfile option
         self.hostfile = hostfile
@@ -159,6 +223,10 @@ class Run(threading.Thread):
         # nodes assigned needed for Summit
         self.nodes_assigned = None
 
+        # Set by the Pipeline to the nodes the run is counted on, for the
+        # log records about the run
+        self.node_ids = None
+
         # node_config for node-sharing on summit
         self.node_config = None
 
@@ -220,7 +288,9 @@ class Run(threading.Thread):
                 hostfile=data.get('hostfile'),
                 runner_override=data.get('runner_override'),
                 tau_profiling=data.get('tau_profiling', False),
-                tau_tracing=data.get('tau_tracing', False))
+                tau_tracing=data.get('tau_tracing', False),
+                exe_pinned=data.get('exe_pinned', False),
+                memory_per_node=data.get('memory_per_node'))
 
         return r
 
@@ -259,6 +329,12 @@ class Run(threading.Thread):
         # Pipeline sets the machine for its runs, so you have to
         # explicitly do it here as well.
         r.machine = runs[0].machine
+        r.pipeline_id = runs[0].pipeline_id
+        r.local_pipeline_id = runs[0].local_pipeline_id
+        r.environment_store = runs[0].environment_store
+        r.usage_sampler = runs[0].usage_sampler
+        r.output_collector = runs[0].output_collector
+        r.metadata_store = runs[0].metadata_store
 
         r.child_runs = runs
         # return r
@@ -365,9 +441,39 @@ class Run(threading.Thread):
             return False
         if self._end_time is None:
             raise ValueError("succeeded state not available until run is done")
+        if self.resumed:
+            return True
         return (not self._killed and not self._timed_out
                 and self._p.returncode == 0)
 
+    @property
+    def log_fields(self):
+        """Structured fields of the log records about this run."""
+        return log_fields(self.pipeline_id, self.name,
+                          self.nodes_assigned or self.node_ids)
+
+    def get_state(self):
+        """Get the state of the run for the status file: not_started,
+        running, killed, or the reason the run is done (succeeded, failed,
+        timeout or exception). Runs resumed from an earlier job keep their
+        succeeded state."""
+        if self._exception:
+            return status.REASON_EXCEPTION
+        with self._state_lock:
+            if self._end_time is None:
+                if self._p is None:
+                    return status.NOT_STARTED
+                return status.RUNNING
+        if self.resumed:
+            return status.REASON_SUCCEEDED
+        if self._timed_out:
+            return status.REASON_TIMEOUT
+        if self._killed:
+            return status.KILLED
+        if self._p.returncode == 0:
+            return status.REASON_SUCCEEDED
+        return status.REASON_FAILED
+
     def add_callback(self, fn):
         """Function takes single argument which is this run instance, and is
         called when the process is complete (either normally or killed by
@@ -390,11 +496,7 @@ class Run(threading.Thread):
         if self.exe is None:
             return
 
-        env = os.environ.copy()
-        env['PATH'] = self.apps_dir + ":" + env['PATH']
-        env.update(self.env)
-
-        exe_path = shutil.which(self.exe, path=env['PATH'])
+        exe_path = find_exe(self.exe, self.apps_dir, self.env)
         if exe_path is not None:
             self.exe = exe_path
 
@@ -432,9 +534,39 @@ class Run(threading.Thread):
         # l = list(tasks_per_gpu.values())
         # self.tasks_per_gpu = l[0]
 
-    def run(self):
+    def start(self):
+        """Launch the process in a reaper worker thread, as soon as all the
+        runs this run depends on are done. Returns immediately."""
+        if self.resumed:
+            # the runs it depends on were resumed too, so they are done
+            _log.info('%s succeeded in an earlier job, not starting',
+                      self.log_prefix, extra=self.log_fields)
+            with self._state_lock:
+                self._end_time = time.time()
+            get_reaper().submit(self._guarded, self._set_done)
+            return
+        if not self.depends_on_runs:
+            self._submit_launch()
+            return
+        self._wait_time = time.time()
+        with self._state_lock:
+            self._parents_pending = len(self.depends_on_runs)
+        for parent in self.depends_on_runs:
+            parent._add_done_waiter(self._parent_done)
+
+    def _parent_done(self):
+        with self._state_lock:
+            self._parents_pending -= 1
+            ready = (self._parents_pending == 0)
+        if ready:
+            self._submit_launch()
+
+    def _submit_launch(self):
+        get_reaper().submit(self._guarded, self._launch)
+
+    def _guarded(self, fn, *args):
         try:
-            self._run()
+            fn(*args)
         except:
             # Treat this as a special type of failure, in case it's
             # something specific to this run or pipeline. If it affects
@@ -443,19 +575,21 @@ class Run(threading.Thread):
             # drastic approach may provide extra information and won't
             # take much longer.
             self._exception = True  # Note: state lock not required
-            _log.exception('exception in Run thread')
-            # attempt to execute callbacks, so more threads could be run
+            _log.exception('exception in Run %s', self.log_prefix,
+                           extra=self.log_fields)
+            if self.usage_sampler is not None:
+                self.usage_sampler.remove(self)
+            # attempt to execute callbacks, so more runs could be started
             try:
-                self._run_callbacks()
+                self._set_done()
             except:
                 _log.exception(
-                       'exception in Run callbacks after Run thread exception')
-
-    def _run(self):
-        # Wait for runs that self depends on to finish
-        if self.depends_on_runs is not None:
-            threading.Thread.join(self.depends_on_runs)
+                       'exception in Run callbacks after Run exception')
 
+    def _launch(self):
+        launch_time = time.time()
+        trace.pipeline_span('dependencies', self._wait_time, launch_time,
+                            self.pipeline_id, self.name)
         # Create ERF file for Summit
         if self.machine.name.lower() == 'summit':
             self.erf_file = self.working_dir + "/" + self.name + ".erf_input"
@@ -476,11 +610,6 @@ class Run(threading.Thread):
         if self.node_config is not None:
             self._set_slurm_opts()  # Set slurm opts if this is a Slurm machine
 
-        # if self.machine.name.lower() == 'summit':
-        #     # are we releasing when the run finishes, or when the pipeline
-        #     # finishes? reqd. for dependency mgmt
-        #     self.add_callback(self._release_nodes)
-
         if self.runner is not None:
             args = self.runner.wrap(self, self.sched_args)
         else:
@@ -491,55 +620,113 @@ class Run(threading.Thread):
         args = ['bash', self.exe_launch_script_path]
 
         self._start_time = time.time()
+        trace.pipeline_span('launch script', launch_time, self._start_time,
+                            self.pipeline_id, self.name)
         with self._state_lock:
             if self._killed:
                 _log.info('%s not starting, killed before start',
-                          self.log_prefix)
+                          self.log_prefix, extra=self.log_fields)
                 self._end_time = time.time()
             else:
                 self._popen(args)
         if self._p is None:
-            self._run_callbacks()
+            self._set_done()
             return
 
-        try:
-            self._p.wait(self.timeout)
-        except subprocess.TimeoutExpired:
-            _log.warning('%s killing (timeout %d)', self.log_prefix,
-                         self.timeout)
-            with self._state_lock:
-                self._timeout_pending = True
-            if not self._killed:
-                self._term_kill()
-                self._p.wait()
-                with self._state_lock:
-                    if self._p.returncode != 0:
-                        # check return code in case it completes while handling
-                        # the exception before kill.
-                        self._timed_out = True
-                    self._timeout_pending = False
-                    # TODO will this call the release_nodes callback?
+        if self.usage_sampler is not None:
+            self.usage_sampler.add(self, self._pgid, self.usage_path)
 
+        reaper = get_reaper()
+        if self.timeout is not None:
+            self._timeout_timer = reaper.call_later(self.timeout,
+                                                    self._timeout_expired)
+        reaper.watch_process(self._p, functools.partial(
+                                self._guarded, self._process_exited))
+
+    def _timeout_expired(self):
+        """Called in the reaper thread when the timeout is reached."""
+        with self._state_lock:
+            if self._killed or self._p.returncode is not None:
+                return
+            self._timeout_pending = True
+        _log.warning('%s killing (timeout %d)', self.log_prefix,
+                     self.timeout, extra=self.log_fields)
+        self._term_kill()
+
+    def _process_exited(self, popen):
+        """Called in a reaper worker thread once the launched process has
+        exited and been reaped."""
+        self._exit_time = time.time()
+        trace.pipeline_span('process', self._start_time, self._exit_time,
+                            self.pipeline_id, self.name,
+                            pid=self._p.pid, returncode=self._p.returncode)
+        if self._timeout_timer is not None:
+            self._timeout_timer.cancel()
+        with self._state_lock:
+            if self._timeout_pending:
+                if self._p.returncode != 0:
+                    # check return code in case it completes while handling
+                    # the timeout before kill.
+                    self._timed_out = True
+                self._timeout_pending = False
         self._pgroup_wait()
+
+    def _finish(self):
+        if self._kill_timer is not None:
+            # the process group is gone, don't signal a reused pgid later
+            self._kill_timer.cancel()
+        if self.usage_sampler is not None:
+            self.usage_sampler.remove(self)
         with self._state_lock:
             self._end_time = time.time()
+        trace.pipeline_span('pgroup wait', self._exit_time, self._end_time,
+                            self.pipeline_id, self.name)
         _log.info('%s done %d %d', self.log_prefix, self._p.pid,
-                  self._p.returncode)
-        self._save_walltime(self._end_time - self._start_time)
-        self._save_returncode(self._p.returncode)
+                  self._p.returncode, extra=self.log_fields)
+        self._save_results(self._end_time - self._start_time,
+                           self._p.returncode)
         self._close_files()
+        if self._captures:
+            # done once the captured output has been written
+            self._close_captures()
+        else:
+            self._set_done()
+
+    def _set_done(self):
+        """Execute callbacks, then mark the run as done and start the runs
+        that are waiting on it."""
+        callback_time = time.time()
         self._run_callbacks()
+        trace.pipeline_span('callbacks', callback_time, time.time(),
+                            self.pipeline_id, self.name)
+        with self._state_lock:
+            self._done.set()
+            waiters = self._done_waiters
+            self._done_waiters = []
+        for fn in waiters:
+            fn()
+
+    def _add_done_waiter(self, fn):
+        """Call fn without arguments once this run is done, or right away
+        if it is already done."""
+        with self._state_lock:
+            if not self._done.is_set():
+                self._done_waiters.append(fn)
+                return
+        fn()
 
     def _run_callbacks(self):
-        _log.debug('%s _run_callbacks', self.log_prefix)
+        _log.debug('%s _run_callbacks', self.log_prefix,
+                   extra=self.log_fields)
         for callback in self.callbacks:
             callback(self)
 
-    def kill(self):
-        """Kill process and cause run thread to complete after the wait
-        returns. If the run is already done, does nothing. If the process is
-        killed, it will mark the state as killed so it can be re-run on
-        workflow restart. Thread safe."""
+    def kill(self, kill_wait=KILL_WAIT):
+        """Kill process and cause the run to complete once the process group
+        has exited. If the run is already done, does nothing. If the process
+        is killed, it will mark the state as killed so it can be re-run on
+        workflow restart. SIGKILL is sent to the process group if it still
+        exists kill_wait seconds after SIGTERM. Thread safe."""
         with self._state_lock:
             if self._killed:
                 # avoid double kill - there is a delay between this
@@ -554,55 +741,129 @@ class Run(threading.Thread):
             self._killed = True
 
         if self._p is not None:
-            _log.warning('%s kill requested', self.log_prefix)
-            self._kill_thread = threading.Thread(target=self._term_kill)
-            self._kill_thread.start()
+            _log.warning('%s kill requested', self.log_prefix,
+                         extra=self.log_fields)
+            self._term_kill(kill_wait)
 
-    def _term_kill(self):
+    def _term_kill(self, kill_wait=KILL_WAIT):
         """Issue signals to entire process group. First give processes a
         chance to exit cleanly with CONT+TERM, then attempt to KILL after
-        a delay."""
-        _log.debug('%s _term_kill', self.log_prefix)
+        kill_wait seconds. Does not block, the KILL is sent by a reaper
+        timer, which is cancelled when the process group is gone."""
+        _log.debug('%s _term_kill', self.log_prefix, extra=self.log_fields)
         try:
             os.killpg(self._pgid, signal.SIGCONT)
             os.killpg(self._pgid, signal.SIGTERM)
-            time.sleep(KILL_WAIT)
-            os.killpg(self._pgid, signal.SIGKILL)
         except ProcessLookupError:
             # this happens if all processes in the pgroup have already
             # exited and the group no longer exists, which is what should
             # happen in most cases
+            return
+        self._kill_timer = get_reaper().call_later(kill_wait,
+                                                   self._send_pgroup_kill)
+
+    def _send_pgroup_kill(self):
+        try:
+            os.killpg(self._pgid, signal.SIGKILL)
+        except ProcessLookupError:
             pass
 
     def _pgroup_wait(self):
-        """Wait until the process group lead by this run no longer exists.
-        Assumes that it should already be exiting normally (e.g. the parent
-        has already exited). If WAIT_DELAY_KILL is reached in expontential
-        back off and the group still exists, SIGKILL is sent to the group.
-        If WAIT_DELAY_GIVE_UP is reached, an error is logged and the function
-        will return. Inspired by proctrack_pgid plugin from slurm."""
-        _log.debug('%s _pgroup_wait max delay %d'
-                   % (self.log_prefix, WAIT_DELAY_GIVE_UP))
-        delay = 1
-        signum = 0  # 0 is the null signal, does error checking only
-        while True:
-            try:
-                os.killpg(self._pgid, signum)
-            except ProcessLookupError:
-                # pgroup no longer exists, we are done waiting
-                _log.debug('%s Checking if pgroup exists .. not found', 
-                           self.log_prefix)
-                break
-            # else pgroup still exists
-            time.sleep(delay)
-            delay *= 2
-            if delay > WAIT_DELAY_KILL:
-                signum = signal.SIGKILL
-                _log.warning('%s pgroup still exists, sending KILL, '
-                             'next delay=%d', self.log_prefix, delay)
-            if delay > WAIT_DELAY_GIVE_UP:
-                _log.error('%s pgroup did not exit', self.log_prefix)
-                break
+        """Wait until the process group lead by this run no longer exists,
+        then finish the run. Assumes that it should already be exiting
+        normally (e.g. the parent has already exited). The remaining members
+        of the group are watched with pidfds, and the group is checked again
+        as soon as one of them exits, with a poll timer as backup. If the
+        group still exists after WAIT_DELAY_KILL seconds, SIGKILL is sent to
+        the group on every check. If WAIT_DELAY_GIVE_UP is reached, an error
+        is logged and the run is finished anyway. Inspired by
+        proctrack_pgid plugin from slurm."""
+        _log.debug('%s _pgroup_wait max delay %d', self.log_prefix,
+                   WAIT_DELAY_GIVE_UP, extra=self.log_fields)
+        reaper = get_reaper()
+        with self._pgroup_lock:
+            self._pgroup_check_pending = True
+            self._pgroup_timers = [
+                reaper.call_later(WAIT_DELAY_KILL, self._pgroup_send_kill),
+                reaper.call_later(WAIT_DELAY_GIVE_UP, self._pgroup_give_up)]
+        self._pgroup_check()
+
+    def _pgroup_request_check(self, pid=None):
+        """Check the process group in a worker thread, unless a check is
+        already pending. Called when a watched member exits and by the poll
+        timer."""
+        with self._pgroup_lock:
+            if self._pgroup_done or self._pgroup_check_pending:
+                return
+            self._pgroup_check_pending = True
+        get_reaper().submit(self._guarded, self._pgroup_check)
+
+    def _pgroup_check(self):
+        with self._pgroup_lock:
+            self._pgroup_check_pending = False
+            if self._pgroup_done:
+                return
+            signum = signal.SIGKILL if self._pgroup_kill_sent else 0
+        # members that were orphaned are children of savanna when it is the
+        # subreaper, and the group exists until they are reaped
+        reap_pgroup(self._pgid)
+        try:
+            # 0 is the null signal, does error checking only
+            os.killpg(self._pgid, signum)
+        except ProcessLookupError:
+            # pgroup no longer exists, we are done waiting
+            _log.debug('%s Checking if pgroup exists .. not found',
+                       self.log_prefix, extra=self.log_fields)
+            self._pgroup_finish()
+            return
+
+        # else pgroup still exists. Watch members that are not watched yet,
+        # including processes forked since the last check.
+        reaper = get_reaper()
+        members = pgroup_members({self._pgid})
+        for pid in members.get(self._pgid, ()):
+            with self._pgroup_lock:
+                if pid in self._pgroup_watched:
+                    continue
+                self._pgroup_watched.add(pid)
+            reaper.watch_pid(pid, self._pgroup_request_check)
+
+        with self._pgroup_lock:
+            if self._pgroup_done:
+                return
+            delay = self._pgroup_poll_delay
+            self._pgroup_poll_delay = min(delay * 2, PGROUP_POLL_MAX)
+            self._pgroup_timers.append(
+                reaper.call_later(delay, self._pgroup_request_check))
+
+    def _pgroup_send_kill(self):
+        with self._pgroup_lock:
+            if self._pgroup_done:
+                return
+            self._pgroup_kill_sent = True
+        _log.warning('%s pgroup still exists after %d seconds, sending KILL',
+                     self.log_prefix, WAIT_DELAY_KILL,
+                     extra=self.log_fields)
+        self._send_pgroup_kill()
+
+    def _pgroup_give_up(self):
+        with self._pgroup_lock:
+            if self._pgroup_done:
+                return
+        _log.error('%s pgroup did not exit', self.log_prefix,
+                   extra=self.log_fields)
+        get_reaper().submit(self._guarded, self._pgroup_finish)
+
+    def _pgroup_finish(self):
+        with self._pgroup_lock:
+            if self._pgroup_done:
+                return
+            self._pgroup_done = True
+            timers = self._pgroup_timers
+            self._pgroup_timers = []
+        for timer in timers:
+            timer.cancel()
+        self._finish()
 
     def _create_launch_script(self, app_launch_command):
         """
@@ -639,9 +900,28 @@ class Run(threading.Thread):
             raise SavannaException(e)
 
     def _popen(self, args):
-        out = open(self.stdout_path, 'w')
-        err = open(self.stderr_path, 'w')
-        self._open_files = [out, err]
+        if self.output_collector is not None:
+            out, out_capture = self.output_collector.open_pipe(
+                                        self.stdout_path + CAPTURE_SUFFIX)
+            err, err_capture = self.output_collector.open_pipe(
+                                        self.stderr_path + CAPTURE_SUFFIX)
+            self._captures = [out_capture, err_capture]
+            # the process has its own copy of the write ends
+            self._open_files = [os.fdopen(out, 'wb'), os.fdopen(err, 'wb')]
+            stale = [self.stdout_path, self.stderr_path]
+        else:
+            out = open(self.stdout_path, 'w')
+            err = open(self.stderr_path, 'w')
+            self._open_files = [out, err]
+            stale = [self.stdout_path + CAPTURE_SUFFIX,
+                     self.stderr_path + CAPTURE_SUFFIX]
+        # remove the output of an earlier attempt written in the other mode,
+        # so it is not mistaken for the output of this one
+        for path in stale:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
         # NOTE: it's important to maintain the calling environment,
         # which can contain LD_LIBRARY_PATH and other variables that are
         # required for modules and normal HPC operation (e.g aprun).
@@ -652,17 +932,24 @@ class Run(threading.Thread):
         # env.update(self.env)
 
         # Write the environment information to file
-        env_out_name = RUN_ENVIRON_NAME.format(self.name)
-        env_out_path = os.path.join(self.working_dir, env_out_name)
+        if self.environment_store is not None:
+            env_out_path = self.environment_store.env_dir
+        else:
+            env_out_path = os.path.join(self.working_dir,
+                                        RUN_ENVIRON_NAME.format(self.name))
         try:
-            with open(env_out_path, 'w') as f:
-                json.dump(env, f, indent=4)
+            if self.environment_store is not None:
+                self._env_snapshot = self.environment_store.record(
+                                self.local_pipeline_id, self.name, env)
+            else:
+                with open(env_out_path, 'w') as f:
+                    json.dump(env, f, indent=4)
         except:  # Continue if it fails, not fatal
             _log.warning(err_msg['rc_env_out_fail'].format(self.name,
                                                            env_out_path))
 
-        _log.debug("{} {}, LD_LIBRARY_PATH:{}".format(
-            self.log_prefix, self.env, env.get('LD_LIBRARY_PATH', '')))
+        _log.debug("%s %s, LD_LIBRARY_PATH:%s", self.log_prefix, self.env,
+                   env.get('LD_LIBRARY_PATH', ''), extra=self.log_fields)
 
         # Flatten the args into a single string, and redirect stdout and
         # stderr using bash options > and 2> . Can't use stdout and stderr in
@@ -682,14 +969,38 @@ class Run(threading.Thread):
         #     self._p = subprocess.Popen(args, env=env, cwd=self.working_dir,
         #                                shell=True, preexec_fn=os.setpgrp)
         # else:
-        self._p = subprocess.Popen(args, env=env, cwd=self.working_dir,
-                                   stdout=out, stderr=err,
-                                   preexec_fn=os.setpgrp)
+        try:
+            self._p = subprocess.Popen(args, env=env, cwd=self.working_dir,
+                                       stdout=out, stderr=err,
+                                       preexec_fn=os.setpgrp)
+        finally:
+            if self._captures:
+                # close the write ends, so the captures see the end of the
+                # output when the processes exit
+                self._close_files()
 
         self._pgid = os.getpgid(self._p.pid)
 
         _log.info('%s start pid=%d pgid=%d args=%r',
-                  self.log_prefix, self._p.pid, self._pgid, args)
+                  self.log_prefix, self._p.pid, self._pgid, args,
+                  extra=self.log_fields)
+
+    def _save_results(self, walltime, rcode):
+        """Save the walltime and return code, in the metadata store if
+        enabled, else in files in the working dir."""
+        if self.metadata_store is not None:
+            try:
+                self.metadata_store.record_run(
+                            self.local_pipeline_id, self.name, rcode,
+                            walltime, self._env_snapshot)
+                return
+            except sqlite3.Error:
+                _log.exception('%s failed to save results in %s, writing '
+                               'files', self.log_prefix,
+                               self.metadata_store.path,
+                               extra=self.log_fields)
+        self._save_walltime(walltime)
+        self._save_returncode(rcode)
 
     def _save_returncode(self, rcode):
         assert rcode is not None
@@ -703,6 +1014,8 @@ class Run(threading.Thread):
             f.write(str(walltime) + "\n")
 
     def get_returncode(self):
+        if self.resumed:
+            return 0
         if self._p is None:
             return None
         return self._p.returncode
@@ -717,10 +1030,36 @@ class Run(threading.Thread):
             f.close()
         self._open_files = []
 
-    def join(self):
-        threading.Thread.join(self)
-        if self._kill_thread is not None:
-            self._kill_thread.join()
+    def _close_captures(self):
+        """Close the captured output, and mark the run as done in a reaper
+        worker once it has been written. Returns immediately, so the worker
+        is not held up by a process that keeps the output open."""
+        captures = self._captures
+        self._captures = []
+        with self._state_lock:
+            self._captures_pending = len(captures)
+        for capture in captures:
+            self.output_collector.close_capture(capture)
+            capture.add_done_callback(self._capture_closed)
+
+    def _capture_closed(self, capture):
+        """Called in the collector thread once the output of capture has
+        been written."""
+        if capture.omitted_bytes:
+            _log.info('%s %d of %d bytes of output omitted from %s',
+                      self.log_prefix, capture.omitted_bytes,
+                      capture.total_bytes, capture.path,
+                      extra=self.log_fields)
+        with self._state_lock:
+            self._captures_pending -= 1
+            last = (self._captures_pending == 0)
+        if last:
+            get_reaper().submit(self._guarded, self._set_done)
+
+    def join(self, timeout=None):
+        """Wait until the run is done and callbacks have been executed.
+        Returns False if the timeout expired first."""
+        return self._done.wait(timeout)
 
     def get_nodes_used(self):
         """Get number of nodes needed to run this app. Requires that the
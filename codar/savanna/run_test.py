@@ -0,0 +1,77 @@
+import os
+import time
+import threading
+
+from codar.savanna import machines
+from codar.savanna.reaper import WORKER_THREADS, set_child_subreaper
+from codar.savanna.run import Run
+
+
+# like savanna, so orphaned members of the process groups are reaped as soon
+# as they exit
+set_child_subreaper()
+
+
+def _make_run(working_dir, name, script):
+    """Run of a bash script, as created by a Pipeline without a runner."""
+    script_path = os.path.join(working_dir, name + '.sh')
+    with open(script_path, 'w') as f:
+        f.write(script)
+    run = Run(name, 'bash', [script_path], None, None, None, working_dir,
+              '/usr/bin', machines.get_by_name('local'))
+    run.app_sh_setup()
+    return run
+
+
+def _wait_for(path, timeout=5):
+    end = time.time() + timeout
+    while not os.path.exists(path):
+        assert time.time() < end, 'timed out waiting for %s' % path
+        time.sleep(0.02)
+
+
+def test_wait_for_process_group(tmpdir):
+    working_dir = str(tmpdir)
+    marker = os.path.join(working_dir, 'child-done')
+    # the launched process exits right away, its child in the same process
+    # group keeps running
+    run = _make_run(working_dir, 'linger',
+                    '(sleep 1; touch %s) &\n' % marker)
+    start = time.time()
+    run.start()
+    assert run.join(10)
+    assert os.path.exists(marker)
+    assert time.time() - start >= 1
+    assert run.succeeded
+
+
+def test_kill_escalation(tmpdir):
+    working_dir = str(tmpdir)
+    started = os.path.join(working_dir, 'started')
+    run = _make_run(working_dir, 'stubborn',
+                    "trap '' TERM\ntouch %s\nsleep 30\n" % started)
+    run.start()
+    _wait_for(started)
+    start = time.time()
+    run.kill(kill_wait=0.5)
+    assert run.join(10)
+    # SIGKILL is sent kill_wait seconds after the ignored SIGTERM
+    assert 0.5 <= time.time() - start < 5
+    assert run.killed
+    assert not run.succeeded
+
+
+def test_thread_count(tmpdir):
+    threads_before = threading.active_count()
+    runs = []
+    for i in range(50):
+        working_dir = str(tmpdir.mkdir('run-%d' % i))
+        runs.append(_make_run(working_dir, 'sim', 'sleep 1\n'))
+    for run in runs:
+        run.start()
+    time.sleep(0.5)
+    # the reaper thread and its workers, not a thread per run
+    assert threading.active_count() <= threads_before + WORKER_THREADS + 1
+    for run in runs:
+        assert run.join(10)
+        assert run.succeeded
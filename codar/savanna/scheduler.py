@@ -1,7 +1,12 @@
 """
-Classes related to finding a job that can run on available resources. Does
-not assume any knowledge of how long each job will take. Designed for greedy
-search of a job that will fit whenever resources are freed.
+Classes related to finding a job that can run on available resources. The
+default JobList does not assume any knowledge of how long each job will take,
+and is designed for greedy search of a job that will fit whenever resources
+are freed. BackfillJobList uses runtime estimates to implement EASY
+backfilling, so the biggest waiting job can't be starved by a stream of
+smaller jobs. FairShareJobList shares the resources between several groups
+of jobs, e.g. the sweep groups of a combined submission, with a job list of
+either kind for each group.
 
 In the context of Cheetah workflows, it's unlikely that there will be more than
 a few hundred jobs, so it's not worth optimizing the python search code very
@@ -13,6 +18,7 @@ nodes.
 
 import bisect
 import threading
+import time
 
 class Scheduler:
     def __init__(self):
@@ -42,27 +48,249 @@ class JobList(object):
             self._costs = []
         self._lock = threading.Lock()
 
-    def add_job(self, job):
+    def add_job(self, job, runtime=None):
+        """Add a job. runtime is the estimated runtime, used by
+        BackfillJobList and ignored here."""
         cost = self._costfn(job)
         with self._lock:
             i = bisect.bisect_right(self._costs, cost)
-            self._costs.insert(i, cost)
-            self._jobs.insert(i, job)
+            self._insert(i, job, cost, runtime)
 
-    def pop_job(self, max_cost):
+    def pop_job(self, max_cost, fits=None):
         """Get the highest cost job that doesn't exceed max_cost, and remove
         it from the job list. Raises IndexError if the job list is empty,
-        returns None if no suitable jobs exist in the list."""
+        returns None if no suitable jobs exist in the list.
+
+        For jobs that need more than one kind of resource, fits is a
+        function that takes a job and returns True if all the resources it
+        needs are available. The cost is then used to order the jobs and
+        as an upper bound, and the highest cost job that fits is
+        returned."""
         with self._lock:
             if len(self) == 0:
                 raise IndexError('pop called on empty job list')
             i = bisect.bisect_right(self._costs, max_cost)
-            if i:
-                job = self._jobs[i-1]
-                del self._jobs[i-1]
-                del self._costs[i-1]
-                return job
+            while i:
+                i -= 1
+                if fits is None or fits(self._jobs[i]):
+                    return self._remove(i)
             return None
 
+    def remove_if(self, fn):
+        """Remove the jobs for which fn(job) is true, and return them in
+        job list order."""
+        removed = []
+        with self._lock:
+            i = len(self._jobs)
+            while i:
+                i -= 1
+                if fn(self._jobs[i]):
+                    removed.append(self._remove(i))
+        removed.reverse()
+        return removed
+
+    def _insert(self, i, job, cost, runtime=None):
+        """Insert job at sorted position i. Must be called with lock
+        acquired."""
+        self._costs.insert(i, cost)
+        self._jobs.insert(i, job)
+
+    def _remove(self, i):
+        """Remove and return the job at position i. Must be called with lock
+        acquired."""
+        job = self._jobs[i]
+        del self._jobs[i]
+        del self._costs[i]
+        return job
+
     def __len__(self):
         return len(self._costs)
+
+
+class BackfillJobList(JobList):
+    """Job list implementing EASY backfill scheduling.
+
+    The highest cost waiting job is the head of the queue. If it doesn't fit
+    in the free resources, it gets a reservation at the earliest time enough
+    running jobs are expected to finish (the shadow time). Smaller jobs are
+    only started ahead of it if they are expected to finish before the shadow
+    time, or if they only use resources that will be left over once the head
+    job starts.
+
+    The estimated runtime of a job in seconds, or None if unknown, is passed
+    to add_job, so it can be computed without holding the lock of the list.
+    If it is not passed, the runtime function is called with the job, if
+    there is one. Jobs with unknown runtime are only backfilled into left
+    over resources. The clock can be replaced to drive the list from a
+    virtual time source."""
+    def __init__(self, costfn, runtimefn=None, initial_jobs=None,
+                 clock=time.time):
+        self._runtimefn = runtimefn
+        self._runtimes = []
+        self._clock = clock
+        JobList.__init__(self, costfn)
+        for job in (initial_jobs or []):
+            self.add_job(job)
+
+    def pop_job(self, max_cost, running=None, fits=None):
+        """Get the highest cost job that can be started now without delaying
+        the reservation of the head job, and remove it from the job list.
+
+        running is an iterable of (end_time, cost) pairs for the jobs
+        currently holding resources, where end_time is the expected absolute
+        completion time (or None if unknown). fits is as for
+        JobList.pop_job, reservations are only computed for the cost.
+        Raises IndexError if the job list is empty, returns None if no
+        suitable jobs exist in the list."""
+        with self._lock:
+            if len(self) == 0:
+                raise IndexError('pop called on empty job list')
+            head_cost = self._costs[-1]
+            if head_cost <= max_cost and (fits is None
+                                          or fits(self._jobs[-1])):
+                return self._remove(len(self) - 1)
+
+            shadow_time, extra_cost = self._reservation(head_cost, max_cost,
+                                                        running or [])
+            now = self._clock()
+            i = bisect.bisect_right(self._costs, max_cost)
+            while i:
+                i -= 1
+                if fits is not None and not fits(self._jobs[i]):
+                    continue
+                runtime = self._runtimes[i]
+                if self._costs[i] <= extra_cost:
+                    return self._remove(i)
+                if runtime is not None and now + runtime <= shadow_time:
+                    return self._remove(i)
+            return None
+
+    def _reservation(self, head_cost, max_cost, running):
+        """Get the (shadow_time, extra_cost) pair for the head job, where
+        extra_cost is the amount of resources that will still be free when
+        the head job starts at shadow_time."""
+        inf = float('inf')
+        free = max_cost
+        ends = sorted((inf if end is None else end, cost)
+                      for end, cost in running)
+        for end, cost in ends:
+            free += cost
+            if free >= head_cost:
+                if end == inf:
+                    break
+                return end, free - head_cost
+        # No reservation can be computed, e.g. running job runtimes are not
+        # known. Don't hold any resources back for the head job.
+        return inf, max_cost
+
+    def add_job(self, job, runtime=None):
+        if runtime is None and self._runtimefn is not None:
+            runtime = self._runtimefn(job)
+        JobList.add_job(self, job, runtime)
+
+    def _insert(self, i, job, cost, runtime=None):
+        JobList._insert(self, i, job, cost)
+        self._runtimes.insert(i, runtime)
+
+    def _remove(self, i):
+        del self._runtimes[i]
+        return JobList._remove(self, i)
+
+
+class FairShare(object):
+    """Track the resources used by groups of jobs sharing a pool, to give
+    each group a share proportional to its weight. The priority of a group
+    is lower the more resources it holds now relative to its weight, and
+    for groups holding the same share, the more resource seconds it has
+    used. Groups not in weights have weight 1. The clock can be replaced
+    as for BackfillJobList. Not thread safe."""
+    def __init__(self, weights=None, clock=time.time):
+        self.weights = dict(weights or {})
+        self._clock = clock
+        self._held = {}
+        self._used = {}
+        self._since = {}
+
+    def acquire(self, group, cost):
+        self._update(group)
+        self._held[group] = self._held.get(group, 0) + cost
+
+    def release(self, group, cost):
+        self._update(group)
+        self._held[group] = self._held.get(group, 0) - cost
+
+    def usage(self, group):
+        """Get the (held, used) resources of the group, divided by its
+        weight."""
+        self._update(group)
+        weight = self.weights.get(group, 1)
+        return (self._held.get(group, 0) / weight,
+                self._used.get(group, 0) / weight)
+
+    def _update(self, group):
+        now = self._clock()
+        since = self._since.get(group)
+        if since is not None:
+            self._used[group] = (self._used.get(group, 0)
+                                 + self._held.get(group, 0) * (now - since))
+        self._since[group] = now
+
+
+class FairShareJobList(object):
+    """Job list for jobs from several groups sharing the same resources.
+    groupfn takes a job and returns its group, and each group has its own
+    job list, created by calling make_list. pop_job tries the groups in
+    order of priority according to the FairShare, and returns the job
+    picked by the list of the first group that can start one, so while
+    several groups have jobs waiting they get resources in proportion to
+    their weight, and otherwise one group can use all of them. The
+    arguments of pop_job are passed to the group lists. With backfill
+    lists, the reservation for the head job of a group only holds back
+    the smaller jobs of the same group."""
+    def __init__(self, make_list, groupfn, share):
+        self._make_list = make_list
+        self._groupfn = groupfn
+        self.share = share
+        self._lists = {}
+        self._lock = threading.Lock()
+
+    def add_job(self, job, runtime=None):
+        group = self._groupfn(job)
+        with self._lock:
+            job_list = self._lists.get(group)
+            if job_list is None:
+                job_list = self._make_list()
+                self._lists[group] = job_list
+        job_list.add_job(job, runtime)
+
+    def pop_job(self, *args, **kwargs):
+        """Get the job to start next from the group with the highest
+        priority that has one, see JobList.pop_job. Raises IndexError if
+        the job list is empty, returns None if no group has a suitable
+        job."""
+        with self._lock:
+            groups = [(self.share.usage(group), group)
+                      for group, job_list in self._lists.items()
+                      if len(job_list)]
+        if not groups:
+            raise IndexError('pop called on empty job list')
+        groups.sort()
+        for _, group in groups:
+            job = self._lists[group].pop_job(*args, **kwargs)
+            if job is not None:
+                return job
+        return None
+
+    def remove_if(self, fn):
+        """Remove the jobs for which fn(job) is true from all groups, and
+        return them."""
+        with self._lock:
+            job_lists = list(self._lists.values())
+        removed = []
+        for job_list in job_lists:
+            removed.extend(job_list.remove_if(fn))
+        return removed
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(job_list) for job_list in self._lists.values())
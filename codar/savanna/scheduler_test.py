@@ -0,0 +1,116 @@
+from codar.savanna.scheduler import JobList, BackfillJobList, FairShare, \
+    FairShareJobList
+
+
+def test_job_list():
+    jl = JobList(lambda x: x, [23, 2, 256, 17, 99])
+    assert jl.pop_job(17) == 17
+    assert jl.pop_job(255) == 99
+    assert jl.pop_job(50) == 23
+    assert jl.pop_job(1024) == 256
+    assert jl.pop_job(1) is None
+    assert jl.pop_job(256) == 2
+
+    assert len(jl) == 0
+    try:
+        jl.pop_job(100)
+    except IndexError as e:
+        assert 'empty' in str(e)
+    else:
+        assert False, 'expected IndexError, got no error'
+
+
+def _backfill_list(jobs, now=0):
+    """Jobs are (nodes, runtime) tuples."""
+    return BackfillJobList(lambda job: job[0], lambda job: job[1], jobs,
+                           clock=lambda: now)
+
+
+def test_backfill_head_fits():
+    jl = _backfill_list([(2, 10), (8, 100)])
+    assert jl.pop_job(8) == (8, 100)
+    assert jl.pop_job(8) == (2, 10)
+
+
+def test_backfill_before_reservation():
+    # 4 nodes free, 4 more released at t=50. The 8 node head job is
+    # reserved at t=50, so only the job that finishes by then can go first.
+    jl = _backfill_list([(2, 60), (3, 40), (8, 100)])
+    running = [(50, 4)]
+    assert jl.pop_job(4, running) == (3, 40)
+    assert jl.pop_job(1, running) is None
+    assert jl.pop_job(4, running) is None
+    assert len(jl) == 2
+
+    # runtimes passed to add_job instead of computed by the list
+    jl = BackfillJobList(lambda job: job[0], clock=lambda: 0)
+    for nodes, runtime in [(2, 60), (3, 40), (8, 100)]:
+        jl.add_job((nodes, 'x'), runtime)
+    assert jl.pop_job(4, running) == (3, 'x')
+    assert jl.pop_job(4, running) is None
+
+
+def test_backfill_extra_nodes():
+    # head needs 6 of the 8 nodes available at t=50, so 2 nodes can be used
+    # by a job of any length.
+    jl = _backfill_list([(2, None), (3, 1000), (6, 100)])
+    running = [(50, 4)]
+    assert jl.pop_job(4, running) == (2, None)
+    assert jl.pop_job(4, running) is None
+
+
+def test_backfill_unknown_running_end():
+    # without an estimate for running jobs there is no reservation, so
+    # behave like the greedy list
+    jl = _backfill_list([(3, 1000), (8, 100)])
+    assert jl.pop_job(4, [(None, 4)]) == (3, 1000)
+
+
+def test_job_list_fits():
+    # jobs are (nodes, gpus) tuples, with 2 gpus free
+    jl = JobList(lambda job: job[0], [(1, 0), (2, 4), (3, 1)])
+    fits = lambda job: job[1] <= 2
+    assert jl.pop_job(3, fits) == (3, 1)
+    assert jl.pop_job(3, fits) == (1, 0)
+    assert jl.pop_job(3, fits) is None
+    assert len(jl) == 1
+
+
+def test_remove_if():
+    jl = _backfill_list([(4, 100), (2, 10), (1, None), (2, 50)])
+    assert jl.remove_if(lambda job: job[1] is None or job[1] > 20) == \
+        [(1, None), (2, 50), (4, 100)]
+    assert len(jl) == 1
+    assert jl.pop_job(4) == (2, 10)
+
+
+def test_fair_share():
+    # jobs are (group, nodes) tuples, group a has three times the share
+    now = [0]
+    share = FairShare({'a': 3, 'b': 1}, clock=lambda: now[0])
+    jl = FairShareJobList(lambda: JobList(lambda job: job[1]),
+                          lambda job: job[0], share)
+    for i in range(4):
+        jl.add_job(('a', 1))
+        jl.add_job(('b', 1))
+    started = []
+    for i in range(4):
+        job = jl.pop_job(1)
+        share.acquire(job[0], job[1])
+        started.append(job[0])
+    assert sorted(started) == ['a', 'a', 'a', 'b']
+    assert len(jl) == 4
+
+    # with the same nodes held, the group that used less goes first
+    now[0] = 10
+    share.release('b', 1)
+    now[0] = 20
+    share.release('a', 3)
+    assert share.usage('a') == (0, 20)
+    assert share.usage('b') == (0, 10)
+    assert jl.pop_job(1) == ('b', 1)
+
+    # groups that can't start a job don't hold back the others
+    assert jl.pop_job(1, lambda job: job[0] == 'a') == ('a', 1)
+    assert jl.remove_if(lambda job: job[0] == 'b') == [('b', 1)] * 2
+    assert len(jl) == 0
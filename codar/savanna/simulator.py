@@ -0,0 +1,285 @@
+"""
+Discrete event simulation of a savanna job, for comparing scheduling
+policies on a fobs file without running anything.
+
+The simulator drives a real PipelineRunner with a virtual clock: pipelines
+are added, popped from the job list and assigned nodes by the same methods
+the consumer thread uses, so the greedy and backfill policies, node
+allocation and sharing behave as they would in production. Instead of
+launching the runs, the simulator advances the clock to the time the next
+pipeline is done and releases its nodes.
+
+The runtime of each pipeline comes from the walltime of earlier runs with
+the same parameters in the sweep group, as used for the backfill estimates,
+or else is drawn from a gamma distribution with the given mean and standard
+deviation. Usage:
+
+    python -m codar.savanna.simulator fobs.json --max-nodes 16 \\
+        --scheduling-policy backfill --runtime-mean 600
+
+Several fobs files can be given to simulate sweep groups sharing the job,
+with --group-weights for their share of the nodes.
+"""
+
+import sys
+import json
+import heapq
+import random
+import logging
+import argparse
+from collections import namedtuple
+
+from codar.savanna.consumer import PipelineRunner
+from codar.savanna.estimator import WalltimeEstimator
+from codar.savanna.pipeline import Pipeline
+from codar.savanna.producer import PipelineDescriptor, read_fobs, \
+    get_group_names, interleave
+from codar.savanna.status import split_group_pipeline_id
+
+
+class VirtualClock(object):
+    """Callable returning the simulated time, in seconds."""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class PipelineRuntimes(object):
+    """Runtime function for the simulator. Uses the historical walltime of
+    the pipeline if there is one, else a sample from a gamma distribution
+    with the given mean and stddev (constant if stddev is 0). Raises
+    ValueError if there is no history and no mean."""
+
+    def __init__(self, mean=None, stddev=0, seed=None, use_history=True):
+        self.mean = mean
+        self.stddev = stddev
+        self._random = random.Random(seed)
+        self._estimator = WalltimeEstimator() if use_history else None
+
+    def __call__(self, pipeline):
+        if self._estimator is not None:
+            walltime = self._estimator.historical_walltime(pipeline)
+            if walltime is not None:
+                return walltime
+        if self.mean is None:
+            raise ValueError("no walltime history for pipeline '%s' and no "
+                             "runtime distribution" % pipeline.id)
+        if not self.stddev:
+            return self.mean
+        shape = (self.mean / self.stddev) ** 2
+        return self._random.gammavariate(shape, self.mean / shape)
+
+
+PipelineResult = namedtuple('PipelineResult',
+                            ['id', 'nodes', 'start', 'end', 'wait'])
+
+
+class SimulationResult(object):
+    """Outcome of a simulation. pipelines is the list of PipelineResult in
+    start order, skipped the ids of the pipelines that can't run on the
+    simulated job, and deferred the ids of the pipelines that were not
+    started because they would not be done before the deadline."""
+
+    def __init__(self, max_nodes, pipelines, skipped, deferred=()):
+        self.max_nodes = max_nodes
+        self.pipelines = pipelines
+        self.skipped = skipped
+        self.deferred = list(deferred)
+
+    @property
+    def makespan(self):
+        return max((p.end for p in self.pipelines), default=0.0)
+
+    @property
+    def utilization(self):
+        """Fraction of the node time of the job used by pipelines."""
+        makespan = self.makespan
+        if not makespan:
+            return 0.0
+        used = sum(p.nodes * (p.end - p.start) for p in self.pipelines)
+        return used / (self.max_nodes * makespan)
+
+    @property
+    def mean_wait(self):
+        if not self.pipelines:
+            return 0.0
+        return sum(p.wait for p in self.pipelines) / len(self.pipelines)
+
+    @property
+    def max_wait(self):
+        return max((p.wait for p in self.pipelines), default=0.0)
+
+    def group_makespans(self):
+        """Time the last pipeline of each group is done, for simulations of
+        several groups."""
+        makespans = {}
+        for p in self.pipelines:
+            group, _ = split_group_pipeline_id(p.id)
+            makespans[group] = max(makespans.get(group, 0.0), p.end)
+        return makespans
+
+    def as_data(self):
+        return dict(makespan=self.makespan, utilization=self.utilization,
+                    mean_wait=self.mean_wait, max_wait=self.max_wait,
+                    skipped=self.skipped, deferred=self.deferred,
+                    pipelines=[p._asdict() for p in self.pipelines])
+
+
+def simulate(pipelines, runtimefn, max_nodes, processes_per_node=1,
+             machine_name='local', scheduling_policy='greedy', **kwargs):
+    """Simulate running the pipelines on a job with max_nodes nodes, all
+    submitted at time 0. runtimefn takes a pipeline and returns its runtime
+    in seconds. Other keyword arguments are passed to PipelineRunner, e.g.
+    node_topology_file, share_nodes, deadline or group_weights. Returns a
+    SimulationResult."""
+    clock = VirtualClock()
+    runner = PipelineRunner(None, max_nodes, machine_name, processes_per_node,
+                            scheduling_policy=scheduling_policy, clock=clock,
+                            **kwargs)
+    queued = []
+    skipped = []
+    for pipeline in pipelines:
+        runner.add_pipeline(pipeline)
+        if len(runner.job_list) > len(queued):
+            queued.append(pipeline.id)
+        else:
+            skipped.append(pipeline.id)
+
+    results = []
+    # (end time, start order, pipeline, nodes) of the running pipelines
+    running = []
+    with runner.free_cv:
+        while True:
+            while len(runner.job_list):
+                pipeline = runner._pop_pipeline()
+                if pipeline is None:
+                    break
+                nodes = runner._assign_nodes(pipeline)
+                start = clock.now
+                end = start + runtimefn(pipeline)
+                results.append(PipelineResult(pipeline.id, len(nodes),
+                                              start, end, start))
+                heapq.heappush(running, (end, len(results), pipeline, nodes))
+            if not running:
+                break
+            end, _, pipeline, nodes = heapq.heappop(running)
+            clock.now = end
+            runner._release_pipeline(pipeline, nodes)
+
+    if len(runner.job_list):
+        # can only happen if the policy never starts a pipeline that fits
+        raise RuntimeError('%d pipelines were never started'
+                           % len(runner.job_list))
+    started = set(p.id for p in results)
+    deferred = [pipe_id for pipe_id in queued if pipe_id not in started]
+    return SimulationResult(max_nodes, results, skipped, deferred)
+
+
+def read_pipelines(file_path, group=None):
+    """Get the pipelines in a fobs file, as for the producer but including
+    the pipelines that are already done."""
+    pipelines = []
+    for offset, data in read_fobs(file_path):
+        if offset is None or data.get('total_nodes') is None:
+            pipeline = Pipeline.from_data(data, group)
+        else:
+            pipeline = PipelineDescriptor.from_data(data, file_path, offset,
+                                                    group)
+        if pipeline is not None:
+            pipelines.append(pipeline)
+    return pipelines
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Simulate the scheduling of the pipelines in a fobs '
+                    'file, and print the makespan, node utilization and '
+                    'wait times')
+    parser.add_argument('fobs_file', nargs='+')
+    parser.add_argument('--group-weights', type=float, nargs='+',
+                        help='share of the nodes of each group, if several '
+                             'fobs files are given')
+    parser.add_argument('--max-nodes', type=int, required=True)
+    parser.add_argument('--processes-per-node', type=int, default=1)
+    parser.add_argument('--machine-name', default='local')
+    parser.add_argument('--scheduling-policy', default='greedy',
+                        choices=['greedy', 'backfill'])
+    parser.add_argument('--node-topology-file')
+    parser.add_argument('--gpus-per-node', type=int)
+    parser.add_argument('--memory-per-node', type=int)
+    parser.add_argument('--share-nodes', action='store_true')
+    parser.add_argument('--runtime-mean', type=float,
+                        help='mean runtime in seconds of pipelines without '
+                             'walltime history')
+    parser.add_argument('--runtime-stddev', type=float, default=0,
+                        help='standard deviation of the runtime of pipelines '
+                             'without walltime history')
+    parser.add_argument('--walltime', type=float,
+                        help='seconds the simulated job can run for, '
+                             'pipelines are only started if they are '
+                             'expected to be done in time')
+    parser.add_argument('--walltime-margin', type=float, default=0)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--no-history', action='store_true',
+                        help='ignore the walltime history of the group')
+    parser.add_argument('--json', action='store_true',
+                        help='print the result with per pipeline details as '
+                             'JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # pipelines that don't fit are counted in the output instead
+    logging.getLogger('codar.savanna').addHandler(logging.NullHandler())
+    runtimes = PipelineRuntimes(args.runtime_mean, args.runtime_stddev,
+                                args.seed, not args.no_history)
+    group_weights = None
+    if len(args.fobs_file) > 1:
+        groups = get_group_names(args.fobs_file)
+        pipelines = list(interleave([read_pipelines(path, group)
+                                      for group, path
+                                      in zip(groups, args.fobs_file)]))
+        group_weights = dict(zip(groups, args.group_weights
+                                 or [1] * len(groups)))
+    else:
+        pipelines = read_pipelines(args.fobs_file[0])
+    try:
+        result = simulate(pipelines, runtimes,
+                          args.max_nodes, args.processes_per_node,
+                          args.machine_name, args.scheduling_policy,
+                          node_topology_file=args.node_topology_file,
+                          gpus_per_node=args.gpus_per_node,
+                          memory_per_node=args.memory_per_node,
+                          share_nodes=args.share_nodes,
+                          deadline=args.walltime,
+                          walltime_margin=args.walltime_margin,
+                          group_weights=group_weights)
+    except ValueError as e:
+        print('Error: %s' % e, file=sys.stderr)
+        return 1
+    if args.json:
+        json.dump(result.as_data(), sys.stdout, indent=2)
+        print()
+        return 0
+    print('pipelines:   %d' % len(result.pipelines))
+    if result.skipped:
+        print('skipped:     %d (too big for the job)' % len(result.skipped))
+    if result.deferred:
+        print('deferred:    %d (not done before the walltime)'
+              % len(result.deferred))
+    print('makespan:    %.1f s' % result.makespan)
+    print('utilization: %.1f%%' % (100 * result.utilization))
+    print('mean wait:   %.1f s' % result.mean_wait)
+    print('max wait:    %.1f s' % result.max_wait)
+    if group_weights is not None:
+        for group, makespan in sorted(result.group_makespans().items()):
+            print('  %s: makespan %.1f s' % (group, makespan))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import json
+
+from codar.savanna.simulator import simulate, read_pipelines, \
+    PipelineRuntimes
+
+
+def _write_fobs(tmpdir, sizes):
+    tmpdir.ensure(dir=True)
+    path = str(tmpdir.join('fobs.json'))
+    with open(path, 'w') as f:
+        for i, (nodes, timeout) in enumerate(sizes):
+            data = dict(id='run-%d' % i, total_nodes=nodes,
+                        working_dir=str(tmpdir.join('run-%d' % i)),
+                        runs=[dict(name='sim', exe='sim', args=[],
+                                   nprocs=nodes, timeout=timeout)])
+            f.write(json.dumps(data) + '\n')
+    return path
+
+
+def test_simulate_policies(tmpdir):
+    sizes = [(1, 100), (4, 10)] + [(1, 10)] * 6
+    pipelines = read_pipelines(_write_fobs(tmpdir, sizes))
+    runtimes = dict((p.id, p.runs[0].timeout) for p in pipelines)
+    runtimefn = lambda p: runtimes[p.id]
+
+    greedy = simulate(read_pipelines(_write_fobs(tmpdir, sizes)), runtimefn,
+                      4)
+    backfill = simulate(pipelines, runtimefn, 4,
+                        scheduling_policy='backfill')
+    assert len(greedy.pipelines) == len(backfill.pipelines) == 8
+    # the 4 node job is started first, then the 1 node jobs four at a
+    # time, and the long job is the last to be started
+    for result in greedy, backfill:
+        assert result.pipelines[0].id == 'run-1'
+        assert result.pipelines[-1].id == 'run-0'
+        assert result.pipelines[-1].wait == 20
+        assert result.makespan == 120
+        assert result.utilization == (4 * 10 + 6 * 10 + 100) / (4 * 120)
+
+
+def test_skipped_and_distribution(tmpdir):
+    pipelines = read_pipelines(_write_fobs(tmpdir, [(2, None), (8, None),
+                                                    (2, None)]))
+    result = simulate(pipelines, PipelineRuntimes(mean=10, stddev=2, seed=1),
+                      2)
+    assert result.skipped == ['run-1']
+    assert len(result.pipelines) == 2
+    first, second = result.pipelines
+    assert first.wait == 0
+    assert second.wait == first.end
+    assert result.utilization == 1.0
+
+
+def test_walltime_admission(tmpdir):
+    sizes = [(1, 100)] + [(1, 10)] * 6
+    pipelines = read_pipelines(_write_fobs(tmpdir, sizes))
+    result = simulate(pipelines, lambda p: p.runs[0].timeout, 1,
+                      deadline=50, walltime_margin=0)
+    # the long pipeline never fits, and the short ones until the deadline
+    assert len(result.pipelines) == 5
+    assert result.makespan == 50
+    assert result.deferred == ['run-0', 'run-1']
+
+
+def test_group_fair_share(tmpdir):
+    # two groups of 1 node pipelines, the first with three times the share
+    pipelines = []
+    for group in 'g1', 'g2':
+        path = _write_fobs(tmpdir.join(group), [(1, 10)] * 12)
+        pipelines.extend(read_pipelines(path, group))
+    result = simulate(pipelines, lambda p: p.runs[0].timeout, 4,
+                      group_weights={'g1': 3, 'g2': 1})
+    first = [p.id.split('/')[0] for p in result.pipelines[:4]]
+    assert sorted(first) == ['g1', 'g1', 'g1', 'g2']
+    assert result.group_makespans() == dict(g1=40, g2=60)
+    assert result.utilization == 1.0
@@ -1,12 +1,26 @@
 """
 Class for maintaining state of all FOB runs that the workflow consumer is
-managing. State is saved in a JSON file, overwritten on each state change.
+managing.
+
+State changes are appended to a journal file next to the JSON status file,
+and a background thread periodically compacts the journal into the JSON
+status file. The status file is replaced atomically, so readers always see
+a complete file. Use load_workflow_status to get the current state, which
+includes the changes that have not been compacted yet.
+
+Journal files contain one JSON document per line, with the pipeline id and
+the pipeline state data. When the journal is compacted it is first renamed
+to the old journal name, so state changes made while the status file is
+being written go to a new journal. Replaying the old journal on top of the
+new status file gives the same result, so it's safe to be interrupted at
+any point.
 """
 
 import json
 import os
 import threading
-from collections import defaultdict
+import logging
+import time
 
 
 NOT_STARTED = 'not_started'
@@ -20,39 +34,233 @@ REASON_SUCCEEDED = 'succeeded'
 REASON_EXCEPTION = 'exception'
 REASON_NOFIT = 'nofit'
 
+OUTPUT_PENDING = 'pending'
+
+# Separates the group name from the pipeline id when savanna runs several
+# sweep groups, see group_pipeline_id
+GROUP_SEPARATOR = '/'
+
+JOURNAL_SUFFIX = '.journal'
+OLD_JOURNAL_SUFFIX = '.journal.old'
+
+# Seconds between writing batches of state changes to the journal
+FLUSH_INTERVAL = 1.0
+
+# Seconds between compacting the journal into the status file
+COMPACT_INTERVAL = 30.0
+
+
+_log = logging.getLogger('codar.savanna.status')
+
 
 class WorkflowStatus(threading.Thread):
-    def __init__(self, file_path):
-        threading.Thread.__init__(self, name='Thread-status-0')
+    """Thread that writes state changes to the journal and compacts it. The
+    thread is started by the constructor. Call close when done to write
+    the final status file."""
+
+    def __init__(self, file_path, flush_interval=FLUSH_INTERVAL,
+                 compact_interval=COMPACT_INTERVAL):
+        threading.Thread.__init__(self, name='Thread-status-0', daemon=True)
         self.file_path = file_path
-        self._lock = threading.Lock()
-        self._state = defaultdict(dict)
+        self.journal_path = file_path + JOURNAL_SUFFIX
+        self.old_journal_path = file_path + OLD_JOURNAL_SUFFIX
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+
+        self._cv = threading.Condition()
+        # state changes not yet written to the journal, by pipeline id.
+        # Only the last change for each pipeline is written.
+        self._pending = {}
+        self._closed = False
+        # If set to a metrics Summary, observes the seconds taken by each
+        # journal write and compaction
+        self.write_summary = None
 
         # If status file exists from a previous run, load it first, so that
-        # you dont overwrite it only with runs from this job
-        if os.path.isfile(file_path):
-            with open(file_path, 'r') as f:
-                self._state = json.load(f)
+        # you dont overwrite it only with runs from this job. Journals left
+        # by a previous job are compacted before starting.
+        self._state = load_workflow_status(file_path)
+        self._write_status_file()
+        _remove_if_exists(self.old_journal_path)
+        _remove_if_exists(self.journal_path)
+        self._journal = open(self.journal_path, 'a')
+        # True if the journal has changes not in the status file
+        self._dirty = False
+
+        self.start()
 
     def set_state(self, pipeline_state):
-        with self._lock:
-            self._state[pipeline_state.id] = pipeline_state.as_data()
-            self._save()
+        with self._cv:
+            self._pending[pipeline_state.id] = pipeline_state.as_data()
+            self._cv.notify()
+
+    def close(self):
+        """Write all pending state changes, compact the journal and stop the
+        thread. Blocks until done."""
+        with self._cv:
+            self._closed = True
+            self._cv.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        last_compact = time.monotonic()
+        while True:
+            with self._cv:
+                self._cv.wait_for(lambda: self._pending or self._closed)
+                if not self._closed:
+                    # coalesce state changes until the next flush
+                    self._cv.wait_for(lambda: self._closed,
+                                      self.flush_interval)
+                pending = self._pending
+                self._pending = {}
+                closed = self._closed
+            try:
+                start = time.monotonic()
+                self._flush(pending)
+                if self._dirty and (closed or start - last_compact
+                                    >= self.compact_interval):
+                    self._compact()
+                    last_compact = time.monotonic()
+                if pending and self.write_summary is not None:
+                    self.write_summary.observe(time.monotonic() - start)
+            except OSError:
+                _log.exception('failed to save workflow status')
+            if closed:
+                self._journal.close()
+                if not self._dirty:
+                    _remove_if_exists(self.journal_path)
+                return
+
+    def _flush(self, pending):
+        """Append state changes to the journal. Called only by the status
+        thread."""
+        if not pending:
+            return
+        lines = []
+        for pipeline_id, data in pending.items():
+            self._state[pipeline_id] = data
+            lines.append(json.dumps(dict(id=pipeline_id, data=data)))
+        self._journal.write('\n'.join(lines) + '\n')
+        self._journal.flush()
+        self._dirty = True
+
+    def _compact(self):
+        """Switch to a new journal and write the status file. Called only by
+        the status thread."""
+        self._journal.close()
+        os.replace(self.journal_path, self.old_journal_path)
+        self._journal = open(self.journal_path, 'a')
+        self._write_status_file()
+        os.remove(self.old_journal_path)
+        self._dirty = False
 
-    def _save(self):
-        """Save state to file_path. Must be called with lock acquired!"""
-        with open(self.file_path, 'w') as f:
+    def _write_status_file(self):
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'w') as f:
             json.dump(self._state, f, indent=2)
+        os.replace(tmp_path, self.file_path)
+
+
+class GroupWorkflowStatus(object):
+    """Status of pipelines from several sweep groups, each saved in its
+    own status file. file_paths is a dict of group name to status file.
+    Pipeline ids must be prefixed with the group name, see
+    group_pipeline_id, and are saved without the prefix."""
+
+    def __init__(self, file_paths, **kwargs):
+        self._statuses = dict((group, WorkflowStatus(path, **kwargs))
+                              for group, path in file_paths.items())
+
+    @property
+    def write_summary(self):
+        return next(iter(self._statuses.values())).write_summary
+
+    @write_summary.setter
+    def write_summary(self, summary):
+        for ws in self._statuses.values():
+            ws.write_summary = summary
+
+    def set_state(self, pipeline_state):
+        group, pipe_id = split_group_pipeline_id(pipeline_state.id)
+        state = PipelineState(pipe_id, pipeline_state.state,
+                              pipeline_state.reason,
+                              pipeline_state.return_codes,
+                              pipeline_state.output_accounting,
+                              pipeline_state.runs)
+        self._statuses[group].set_state(state)
+
+    def close(self):
+        for ws in self._statuses.values():
+            ws.close()
+
+
+def group_pipeline_id(group, pipe_id):
+    """Id of a pipeline within a savanna job running several groups, or the
+    pipeline id if group is None."""
+    if group is None:
+        return pipe_id
+    return group + GROUP_SEPARATOR + pipe_id
+
+
+def split_group_pipeline_id(pipe_id):
+    """Get the (group, pipeline id) pair from an id created by
+    group_pipeline_id. Group names can't contain the separator."""
+    group, _, pipe_id = pipe_id.partition(GROUP_SEPARATOR)
+    return group, pipe_id
+
+
+def load_workflow_status(file_path):
+    """Load the state of all pipelines from the status file and journals.
+    Returns a dict of pipeline id to state data, which is empty if none of
+    the files exist. Lines in the journal that can't be parsed, e.g. a line
+    that is still being written, are ignored."""
+    state = {}
+    if os.path.isfile(file_path):
+        with open(file_path, 'r') as f:
+            state.update(json.load(f))
+    for path in (file_path + OLD_JOURNAL_SUFFIX, file_path + JOURNAL_SUFFIX):
+        try:
+            with open(path, 'r') as f:
+                lines = f.readlines()
+        except OSError:
+            continue
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                state[entry['id']] = entry['data']
+            except (ValueError, KeyError, TypeError):
+                continue
+    return state
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 
 class PipelineState(object):
-    def __init__(self, pipeline_id, state, reason=None, return_codes=None):
+    def __init__(self, pipeline_id, state, reason=None, return_codes=None,
+                 output_accounting=None, runs=None):
         self.id = pipeline_id
         self.state = state
         self.reason = reason
         self.return_codes = return_codes or {}
+        # run name -> run state, see Run.get_state. Used to resume the
+        # pipeline without launching the runs that already succeeded.
+        self.runs = runs or {}
+        # OUTPUT_PENDING while the sizes of the pipeline output files are
+        # being computed after it is done
+        self.output_accounting = output_accounting
 
     def as_data(self):
         # NB: don't include id, that is used as the key
-        return dict(state=self.state, reason=self.reason,
+        data = dict(state=self.state, reason=self.reason,
                     return_codes=self.return_codes)
+        if self.output_accounting is not None:
+            data['output_accounting'] = self.output_accounting
+        if self.runs:
+            data['runs'] = self.runs
+        return data
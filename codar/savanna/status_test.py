@@ -0,0 +1,57 @@
+import os
+import json
+
+from codar.savanna.status import WorkflowStatus, GroupWorkflowStatus, \
+    PipelineState, load_workflow_status, group_pipeline_id, RUNNING, DONE, \
+    REASON_SUCCEEDED
+
+
+def test_journal_and_compact(tmp_path):
+    path = str(tmp_path / 'codar.workflow.status.json')
+    with open(path, 'w') as f:
+        json.dump({'run-0': dict(state=DONE, reason=REASON_SUCCEEDED,
+                                 return_codes={})}, f)
+
+    ws = WorkflowStatus(path, flush_interval=0, compact_interval=3600)
+    ws.set_state(PipelineState('run-1', RUNNING))
+    ws.set_state(PipelineState('run-2', RUNNING))
+    ws.set_state(PipelineState('run-1', DONE, REASON_SUCCEEDED, {'a': 0}))
+
+    # until closed, the changes are only in the journal
+    state = {}
+    while 'run-2' not in state:
+        state = load_workflow_status(path)
+    with open(path) as f:
+        assert set(json.load(f).keys()) == {'run-0'}
+
+    ws.close()
+    assert not os.path.exists(ws.journal_path)
+    with open(path) as f:
+        state = json.load(f)
+    assert state == load_workflow_status(path)
+    assert state['run-0']['state'] == DONE
+    assert state['run-1'] == dict(state=DONE, reason=REASON_SUCCEEDED,
+                                  return_codes={'a': 0})
+    assert state['run-2']['state'] == RUNNING
+
+
+def test_load_partial_journal(tmp_path):
+    path = str(tmp_path / 'codar.workflow.status.json')
+    with open(path + '.journal', 'w') as f:
+        f.write(json.dumps(dict(id='run-0', data=dict(state=RUNNING))) + '\n')
+        f.write('{"id": "run-0", "data": {"sta')
+    assert load_workflow_status(path) == {'run-0': dict(state=RUNNING)}
+
+
+def test_group_status(tmp_path):
+    paths = dict((group, str(tmp_path / (group + '.json')))
+                 for group in ('g1', 'g2'))
+    ws = GroupWorkflowStatus(paths, flush_interval=0)
+    ws.set_state(PipelineState(group_pipeline_id('g1', 'run-0'), RUNNING))
+    ws.set_state(PipelineState(group_pipeline_id('g2', 'run-0'), DONE,
+                               REASON_SUCCEEDED, runs={'sim': 'succeeded'}))
+    ws.close()
+    assert load_workflow_status(paths['g1']) == {
+        'run-0': dict(state=RUNNING, reason=None, return_codes={})}
+    assert load_workflow_status(paths['g2'])['run-0']['runs'] == \
+        {'sim': 'succeeded'}
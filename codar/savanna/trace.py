@@ -0,0 +1,141 @@
+"""
+Optional timeline of savanna scheduling in the Chrome trace event format,
+which can be opened in Perfetto (ui.perfetto.dev) or chrome://tracing.
+
+Tracks:
+- process 0, "nodes": one thread per node, with a slice for each pipeline
+  from the time the node is assigned to the pipeline until it is released,
+  so the allocation is shown as a Gantt chart and idle nodes as gaps;
+- one process per pipeline, named by the pipeline id. Thread 0 has the
+  pipeline level slices (queued, setup, runs, sleep_after, post_process),
+  and there is one thread per run with its slices (dependencies, launch
+  script, process, pgroup wait, callbacks).
+
+Tracing is enabled with start_trace. The module level functions do nothing
+when tracing is not enabled, so they can be called unconditionally. Events
+are written as they are recorded, one per line, in the JSON array format.
+The closing bracket is written by stop_trace, but trace viewers also accept
+a file without it if savanna did not exit cleanly.
+"""
+
+import json
+import time
+import threading
+
+
+NODES_PID = 0
+
+
+class Tracer(object):
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._t0 = time.time()
+        self._file = open(file_path, 'w')
+        self._file.write('[\n')
+        self._first = True
+        # pipeline id -> pid, (pipeline id, run name) -> tid
+        self._pipeline_pids = {}
+        self._run_tids = {}
+        self._node_tids = set()
+        self._write(dict(ph='M', name='process_name', pid=NODES_PID,
+                         args=dict(name='nodes')))
+
+    def span(self, name, start, end, pid, tid, args=None):
+        event = dict(ph='X', name=name, pid=pid, tid=tid,
+                     ts=self._us(start), dur=self._us(end) - self._us(start))
+        if args:
+            event['args'] = args
+        self._write(event)
+
+    def pipeline_track(self, pipe_id, run_name=None):
+        """Get the (pid, tid) for a pipeline, or a run in the pipeline,
+        adding the track names the first time."""
+        meta = []
+        with self._lock:
+            pid = self._pipeline_pids.get(pipe_id)
+            if pid is None:
+                pid = len(self._pipeline_pids) + 1
+                self._pipeline_pids[pipe_id] = pid
+                meta.append(dict(ph='M', name='process_name', pid=pid,
+                                 args=dict(name=pipe_id)))
+                meta.append(dict(ph='M', name='thread_name', pid=pid, tid=0,
+                                 args=dict(name='pipeline')))
+            tid = 0
+            if run_name is not None:
+                key = (pipe_id, run_name)
+                tid = self._run_tids.get(key)
+                if tid is None:
+                    tid = sum(1 for p, _ in self._run_tids if p == pipe_id) + 1
+                    self._run_tids[key] = tid
+                    meta.append(dict(ph='M', name='thread_name', pid=pid,
+                                     tid=tid, args=dict(name=run_name)))
+        for event in meta:
+            self._write(event)
+        return pid, tid
+
+    def node_track(self, node):
+        tid = int(node)
+        with self._lock:
+            new = tid not in self._node_tids
+            self._node_tids.add(tid)
+        if new:
+            self._write(dict(ph='M', name='thread_name', pid=NODES_PID,
+                             tid=tid, args=dict(name='node %s' % node)))
+        return NODES_PID, tid
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.write('\n]\n')
+                self._file.close()
+                self._file = None
+
+    def _us(self, t):
+        return int((t - self._t0) * 1e6)
+
+    def _write(self, event):
+        line = json.dumps(event, separators=(',', ':'))
+        with self._lock:
+            if self._file is None:
+                return
+            if not self._first:
+                self._file.write(',\n')
+            self._first = False
+            self._file.write(line)
+
+
+_tracer = None
+
+
+def start_trace(file_path):
+    global _tracer
+    _tracer = Tracer(file_path)
+    return _tracer
+
+
+def stop_trace():
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+def pipeline_span(name, start, end, pipe_id, run_name=None, **args):
+    """Record a slice on the track of a pipeline, or one of its runs. Does
+    nothing if start is None, e.g. for a step that was skipped."""
+    tracer = _tracer
+    if tracer is None or start is None or pipe_id is None:
+        return
+    pid, tid = tracer.pipeline_track(pipe_id, run_name)
+    tracer.span(name, start, end, pid, tid, args)
+
+
+def node_span(node, pipe_id, start, end):
+    """Record that the node was assigned to the pipeline from start to
+    end."""
+    tracer = _tracer
+    if tracer is None or start is None:
+        return
+    pid, tid = tracer.node_track(node)
+    tracer.span(pipe_id, start, end, pid, tid)
@@ -0,0 +1,42 @@
+import json
+
+from codar.savanna import trace
+
+
+def test_trace_tracks(tmpdir):
+    path = str(tmpdir.join('trace.json'))
+    tracer = trace.start_trace(path)
+    t0 = tracer._t0
+    try:
+        trace.pipeline_span('queued', t0, t0 + 1, 'pipe-1')
+        trace.pipeline_span('process', t0 + 1, t0 + 3, 'pipe-1', 'sim',
+                            returncode=0)
+        trace.pipeline_span('process', t0 + 1, t0 + 2, 'pipe-1', 'ana')
+        trace.pipeline_span('process', t0, t0 + 1, 'pipe-2', 'sim')
+        # skipped steps are not recorded
+        trace.pipeline_span('dependencies', None, t0 + 1, 'pipe-1', 'ana')
+        trace.node_span('3', 'pipe-1', t0 + 1, t0 + 3)
+    finally:
+        trace.stop_trace()
+    # does nothing when tracing is off
+    trace.pipeline_span('queued', t0, t0 + 1, 'pipe-3')
+
+    with open(path) as f:
+        events = json.load(f)
+    names = dict(((e['pid'], e.get('tid')), e['args']['name'])
+                 for e in events if e['ph'] == 'M')
+    assert names[(trace.NODES_PID, None)] == 'nodes'
+    assert names[(trace.NODES_PID, 3)] == 'node 3'
+    assert names[(1, None)] == 'pipe-1'
+    assert names[(1, 1)] == 'sim'
+    assert names[(1, 2)] == 'ana'
+    assert names[(2, 1)] == 'sim'
+
+    spans = [e for e in events if e['ph'] == 'X']
+    assert len(spans) == 5
+    sim = spans[1]
+    assert (sim['pid'], sim['tid']) == (1, 1)
+    assert (sim['ts'], sim['dur']) == (1000000, 2000000)
+    assert sim['args'] == dict(returncode=0)
+    node = spans[-1]
+    assert (node['pid'], node['tid'], node['name']) == (0, 3, 'pipe-1')
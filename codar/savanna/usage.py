@@ -0,0 +1,172 @@
+"""
+Optional sampling of the resources used by the processes of each run.
+
+When enabled, the sampler walks the process group of every running run at a
+fixed interval, and appends a line to a CSV file in the run working dir,
+USAGE_NAME.<run name>.csv, with the columns in USAGE_COLUMNS:
+
+    time           seconds since the run was launched
+    cpu_percent    sum of the CPU utilization of the processes, 100 per core
+    rss            sum of the resident set size of the processes, in bytes
+    read_bytes     bytes read by the processes since the run was launched
+    write_bytes    bytes written by the processes since the run was launched
+    threads        number of threads of the processes
+
+The process table is scanned once per interval for all runs. The sampling is
+done in the reaper worker pool, and the next sample is scheduled once the
+current one is done, so a slow scan delays sampling rather than piling up.
+Use summarize_usage to get the values reported by cheetah generate-report.
+"""
+
+import csv
+import time
+import threading
+import logging
+
+import psutil
+
+from codar.savanna.reaper import get_reaper, pgroup_members
+
+
+USAGE_COLUMNS = ('time', 'cpu_percent', 'rss', 'read_bytes', 'write_bytes',
+                 'threads')
+
+
+_log = logging.getLogger('codar.savanna.usage')
+
+
+class UsageSampler(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        # run -> _RunUsage
+        self._runs = {}
+        self._scheduled = False
+
+    def add(self, run, pgid, path):
+        """Start sampling the process group pgid of the run, writing the
+        samples to path."""
+        try:
+            usage = _RunUsage(path, pgid)
+        except OSError:
+            _log.exception('%s failed to open usage file', run.log_prefix)
+            return
+        with self._lock:
+            self._runs[run] = usage
+            schedule = not self._scheduled
+            self._scheduled = True
+        if schedule:
+            get_reaper().call_later(self.interval, get_reaper().submit,
+                                    self._sample_all)
+
+    def remove(self, run):
+        """Stop sampling the run and close its usage file."""
+        with self._lock:
+            usage = self._runs.pop(run, None)
+        if usage is not None:
+            usage.close()
+
+    def _sample_all(self):
+        """Executed in a reaper worker."""
+        with self._lock:
+            runs = list(self._runs.items())
+        members = pgroup_members(set(usage.pgid for _, usage in runs))
+        for run, usage in runs:
+            try:
+                usage.sample(members.get(usage.pgid, ()))
+            except Exception:
+                _log.exception('%s failed to sample usage', run.log_prefix)
+        with self._lock:
+            if not self._runs:
+                self._scheduled = False
+                return
+        get_reaper().call_later(self.interval, get_reaper().submit,
+                                self._sample_all)
+
+
+class _RunUsage(object):
+    def __init__(self, path, pgid):
+        self.pgid = pgid
+        self._start = time.time()
+        # pid -> psutil.Process, kept between samples so cpu_percent gives
+        # the utilization since the last sample
+        self._procs = {}
+        # last (read, write) bytes of each process, and the total of the
+        # processes that are gone
+        self._io = {}
+        self._io_done = [0, 0]
+        self._lock = threading.Lock()
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(USAGE_COLUMNS)
+        self._file.flush()
+
+    def sample(self, pids):
+        cpu = 0.0
+        rss = threads = 0
+        procs = {}
+        for pid in pids:
+            p = self._procs.get(pid)
+            try:
+                if p is None:
+                    p = psutil.Process(pid)
+                    # first call starts the measurement and returns 0
+                    p.cpu_percent(None)
+                with p.oneshot():
+                    cpu += p.cpu_percent(None)
+                    rss += p.memory_info().rss
+                    threads += p.num_threads()
+                    try:
+                        io = p.io_counters()
+                        self._io[pid] = (io.read_bytes, io.write_bytes)
+                    except (AttributeError, psutil.AccessDenied):
+                        pass
+            except psutil.Error:
+                continue
+            procs[pid] = p
+
+        for pid in list(self._io):
+            if pid not in procs:
+                read, write = self._io.pop(pid)
+                self._io_done[0] += read
+                self._io_done[1] += write
+        self._procs = procs
+        read = self._io_done[0] + sum(r for r, _ in self._io.values())
+        write = self._io_done[1] + sum(w for _, w in self._io.values())
+
+        with self._lock:
+            if self._file is None:
+                return
+            self._writer.writerow(('%.1f' % (time.time() - self._start),
+                                   '%.1f' % cpu, rss, read, write, threads))
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def summarize_usage(path):
+    """Read a usage file and return a dict with peak_rss, mean_cpu_percent,
+    bytes_read and bytes_written, or None if the file has no samples."""
+    peak_rss = 0
+    total_cpu = 0.0
+    count = 0
+    last = None
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            try:
+                peak_rss = max(peak_rss, int(row['rss']))
+                total_cpu += float(row['cpu_percent'])
+            except (TypeError, ValueError):
+                continue
+            count += 1
+            last = row
+    if not count:
+        return None
+    return dict(peak_rss=peak_rss,
+                mean_cpu_percent=round(total_cpu / count, 1),
+                bytes_read=int(last['read_bytes']),
+                bytes_written=int(last['write_bytes']))
@@ -0,0 +1,18 @@
+import os
+
+from codar.savanna.usage import _RunUsage, summarize_usage
+
+
+def test_sample_own_process_group(tmpdir):
+    path = str(tmpdir.join('usage.csv'))
+    usage = _RunUsage(path, os.getpgid(0))
+    usage.sample([os.getpid()])
+    usage.sample([os.getpid()])
+    usage.close()
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'time,cpu_percent,rss,read_bytes,write_bytes,threads'
+    assert len(lines) == 3
+    summary = summarize_usage(path)
+    assert summary['peak_rss'] > 0
+    assert summary['bytes_written'] >= 0
@@ -1,12 +1,44 @@
 import os
+import shutil
 
 STDOUT_NAME = 'codar.workflow.stdout'
 STDERR_NAME = 'codar.workflow.stderr'
 RETURN_NAME = 'codar.workflow.return'
 WALLTIME_NAME = 'codar.workflow.walltime'
+TOTAL_WALLTIME_NAME = 'codar.savanna.total.walltime'
+USAGE_NAME = 'codar.savanna.usage'
+RUN_PARAMS_NAME = 'codar.cheetah.run-params.json'
 
 def get_path(default_dir, default_name, specified_name):
     path = specified_name or default_name
     if not path.startswith("/"):
         path = os.path.join(default_dir, path)
     return path
+
+
+# (exe, apps_dir, PATH, env PATH override) -> resolved path or None
+_exe_cache = {}
+
+
+def find_exe(exe, apps_dir, env=None):
+    """Find the absolute path of exe in apps_dir or $PATH, with apps_dir
+    searched first. If env has a PATH, it replaces both. Returns None if the exe
+    is not found. Results are cached for the life of the process, so each
+    distinct exe and search path is only looked up on the file system
+    once."""
+    env_path = (env or {}).get('PATH')
+    sys_path = os.environ.get('PATH', os.defpath)
+    key = (exe, apps_dir, sys_path, env_path)
+    try:
+        return _exe_cache[key]
+    except KeyError:
+        pass
+    if env_path is not None:
+        path = env_path
+    elif apps_dir:
+        path = apps_dir + ":" + sys_path
+    else:
+        path = sys_path
+    exe_path = shutil.which(exe, path=path)
+    _exe_cache[key] = exe_path
+    return exe_path